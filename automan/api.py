@@ -6,7 +6,7 @@ from .automation import (  # noqa
 )
 
 from .utils import ( # noqa
-    compare_runs, dprod, filter_by_name, filter_cases, mdict,
+    CaseSet, compare_runs, dprod, filter_by_name, filter_cases, mdict,
     opts2path
 )
 
@@ -1,8 +1,10 @@
 from __future__ import print_function
 
+from collections import deque
 from fnmatch import fnmatch
 import glob
 import json
+import multiprocessing
 import os
 import shlex
 import shutil
@@ -10,7 +12,8 @@ import sys
 import time
 import traceback
 
-from .jobs import Job
+from .jobs import Job, fetch_file, free_cores, set_fetch_journal
+from .utils import CaseSet
 
 
 class Task(object):
@@ -66,18 +69,140 @@ class WrapperTask(Task):
         return all(r.complete() for r in self.requires())
 
 
+def _run_problem(problem, conn):
+    try:
+        problem.run()
+        conn.send(None)
+    except BaseException:
+        conn.send(traceback.format_exc())
+    finally:
+        conn.close()
+
+
+class PostProcessJob(object):
+    """The `run` method of a problem that is run by a `PostProcessor`.
+    """
+    def __init__(self, problem, processor):
+        self.problem = problem
+        self.processor = processor
+        self.process = None
+        self.conn = None
+        # None while the job is pending, then '' if it succeeded or the
+        # traceback of the error.
+        self.result = None
+
+    def start(self):
+        ctx = multiprocessing.get_context('fork')
+        self.conn, child_conn = ctx.Pipe(duplex=False)
+        # Flush any buffered output so that it is not repeated by the child.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.process = ctx.Process(
+            target=_run_problem, args=(self.problem, child_conn)
+        )
+        self.process.start()
+        child_conn.close()
+
+    def check(self):
+        """Collect the result if the process is done, returns True if it is
+        done.
+        """
+        if self.result is not None:
+            return True
+        if self.process is None:
+            return False
+        alive = self.process.is_alive()
+        if self.conn.poll():
+            try:
+                error = self.conn.recv()
+            except EOFError:
+                error = None
+                alive = False
+            else:
+                self.result = error or ''
+        if self.result is None and not alive:
+            self.process.join()
+            self.result = 'Post-processing exited with code %s.' % (
+                self.process.exitcode
+            )
+        if self.result is not None:
+            self.process.join()
+            self.conn.close()
+        return self.result is not None
+
+    def poll(self):
+        """Return None while the job is pending and the result once it is
+        done.
+        """
+        self.processor.poll()
+        return self.result
+
+
+class PostProcessor(object):
+    """Runs the `run` method of problems in forked processes, at most
+    `max_workers` at a time, so independent problems are post-processed in
+    parallel.
+    """
+    def __init__(self, max_workers=None):
+        """Constructor.
+
+        **Parameters**
+
+        max_workers: int
+            Maximum number of processes to run at a time, defaults to the
+            number of free cores when the first job is submitted.
+        """
+        self.max_workers = max_workers
+        self._pending = deque()
+        self._running = []
+
+    @staticmethod
+    def can_fork():
+        """Return True if the start method of `multiprocessing` is fork.
+
+        Forking a process that has threads is not safe on all platforms, for
+        example on macOS, so the problems are only post-processed in parallel
+        where fork is already the start method.
+        """
+        return multiprocessing.get_start_method() == 'fork'
+
+    def submit(self, problem):
+        """Queue the `run` method of the problem and return the
+        `PostProcessJob`.
+        """
+        if self.max_workers is None:
+            self.max_workers = max(1, int(free_cores()))
+        job = PostProcessJob(problem, self)
+        self._pending.append(job)
+        self.poll()
+        return job
+
+    def poll(self):
+        self._running = [x for x in self._running if not x.check()]
+        while self._pending and len(self._running) < self.max_workers:
+            job = self._pending.popleft()
+            job.start()
+            self._running.append(job)
+
+
 class TaskRunner(object):
     """Run given tasks using the given scheduler.
+
+    If a `PostProcessor` is given, the `run` methods of the problems of the
+    `SolveProblem` tasks are run in parallel in forked processes with it.
     """
-    def __init__(self, tasks, scheduler):
+    def __init__(self, tasks, scheduler, post_processor=None):
         """Constructor.
 
         **Parameters**
 
         tasks: iterable of `Task` instances.
         scheduler: `automan.jobs.Scheduler` instance
+        post_processor: `PostProcessor` instance, if None the `run` methods
+            of the problems are called one after the other in this process.
         """
         self.scheduler = scheduler
+        self.post_processor = post_processor
         self.todo = []
         self.task_status = dict()
         self.task_outputs = set()
@@ -139,6 +264,36 @@ class TaskRunner(object):
                 self.task_outputs.add(output_str)
             return False
 
+    def _prioritize_copies(self):
+        """Copy back first the outputs needed by the problems that are only
+        waiting for their outputs to be copied.
+        """
+        for task in self.todo:
+            if not isinstance(task, SolveProblem):
+                continue
+            pending = [t for t in task.requires()
+                       if self.task_status.get(t) != 'done']
+            if pending and all(isinstance(t, CommandTask) and t.is_copying()
+                               for t in pending):
+                for t in pending:
+                    t.set_copy_priority(1)
+
+    def _update_results_stores(self):
+        """Consolidate the results of the simulations that are done into the
+        results stores of the problems that are waiting for them.
+        """
+        done = set(
+            os.path.normpath(t.output_dir)
+            for t, s in self.task_status.items()
+            if s == 'done' and isinstance(t, CommandTask)
+        )
+        for task in self.todo:
+            if isinstance(task, SolveProblem):
+                try:
+                    task.update_results(done)
+                except Exception:
+                    traceback.print_exc()
+
     def _run(self, task):
         try:
             print("\nRunning task %s..." % task)
@@ -149,6 +304,7 @@ class TaskRunner(object):
             traceback.print_exc()
             status = 'error'
             self.task_status[task] = 'error'
+        self.scheduler.metrics.inc('tasks_started_total', status=status)
         return status
 
     def _show_remaining_tasks(self, replace_line=False):
@@ -164,12 +320,14 @@ class TaskRunner(object):
         print("\nWaiting for already running tasks...")
         running = self._get_tasks_with_status('running')
         while len(running) > 0:
+            self.scheduler.poll()
             for t in running:
                 self._check_status_of_task(t)
             time.sleep(wait)
             running = self._get_tasks_with_status('running')
         errors = self._get_tasks_with_status('error')
         n_err = len(errors)
+        self.scheduler.metrics.set('tasks_with_errors', n_err)
         print("{n_err} jobs had errors.".format(n_err=n_err))
         return n_err
 
@@ -184,6 +342,8 @@ class TaskRunner(object):
         if not task.complete():
             self.todo.append(task)
             self.task_status[task] = 'not started'
+            if isinstance(task, SolveProblem):
+                task.post_processor = self.post_processor
             for req in task.requires():
                 self.add_task(req)
         else:
@@ -196,35 +356,45 @@ class TaskRunner(object):
 
         Returns the number of tasks that had errors.
         '''
-        self._show_remaining_tasks()
-        status = 'running'
-        while len(self.todo) > 0 and status != 'error':
-            to_remove = []
-            for i in range(len(self.todo) - 1, -1, -1):
-                task = self.todo[i]
-                status = self._check_status_of_requires(task)
-                if self._check_error_in_running_tasks():
-                    status = 'error'
-
-                if status == 'error':
-                    break
-                elif status == 'done':
-                    to_remove.append(task)
-                    status = self._run(task)
-
-            for task in to_remove:
-                self.todo.remove(task)
-
+        try:
+            self._show_remaining_tasks()
             if len(self.todo) > 0:
-                self._show_remaining_tasks(replace_line=True)
-                time.sleep(wait)
-
-        n_errors = self._wait_for_running_tasks(wait)
-        if n_errors == 0:
-            print("Finished!")
-        else:
-            print("Please fix the issues and re-run.")
-        return n_errors
+                self.scheduler.start_workers()
+            status = 'running'
+            while len(self.todo) > 0 and status != 'error':
+                self.scheduler.poll()
+                self._prioritize_copies()
+                self._update_results_stores()
+                to_remove = []
+                for i in range(len(self.todo) - 1, -1, -1):
+                    task = self.todo[i]
+                    status = self._check_status_of_requires(task)
+                    if self._check_error_in_running_tasks():
+                        status = 'error'
+
+                    if status == 'error':
+                        break
+                    elif status == 'done':
+                        to_remove.append(task)
+                        status = self._run(task)
+
+                for task in to_remove:
+                    self.todo.remove(task)
+
+                if len(self.todo) > 0:
+                    self._show_remaining_tasks(replace_line=True)
+                    time.sleep(wait)
+
+            n_errors = self._wait_for_running_tasks(wait)
+            if n_errors == 0:
+                print("Finished!")
+            else:
+                print("Please fix the issues and re-run.")
+            return n_errors
+        finally:
+            # Save what the journal recorded since its last save even if the
+            # run is interrupted, so these jobs are not submitted again.
+            self.scheduler.flush()
 
 
 class CommandTask(Task):
@@ -257,6 +427,15 @@ class CommandTask(Task):
         self.job_info = job_info if job_info is not None else {}
         self.job_proxy = None
         self._copy_proc = None
+        self._copy_start = None
+        self._copy_failures = 0
+        # Number of times a failed copy of the output is retried.
+        self.max_copy_retries = 3
+        # Outputs with a higher priority are copied back first.
+        self.copy_priority = 0
+        self._scheduler = None
+        # Time after which a failed job is resubmitted.
+        self._retry_at = None
         # This is a sentinel set to true when the job is finished
         # the data is copied to a local machine and cleaned on the remote.
         self._finished = False
@@ -291,6 +470,8 @@ class CommandTask(Task):
         # Remove the error status file if it exists and we are going to run.
         if os.path.exists(self._error_status_file):
             os.remove(self._error_status_file)
+        self._scheduler = scheduler
+        self._retry_at = None
         self.job_proxy = scheduler.submit(self.job)
 
     def clean(self):
@@ -310,6 +491,20 @@ class CommandTask(Task):
     def requires(self):
         return self.depends
 
+    def is_copying(self):
+        """Return True if the job has finished and its output is being copied
+        back.
+        """
+        return self._copy_proc is not None and not self._finished
+
+    def set_copy_priority(self, priority):
+        """Set the priority of copying back the output of the job, outputs
+        with a higher priority are copied first.
+        """
+        self.copy_priority = priority
+        if hasattr(self._copy_proc, 'priority'):
+            self._copy_proc.priority = priority
+
     # #### Private protocol ###########################################
 
     @property
@@ -334,25 +529,66 @@ class CommandTask(Task):
         proc = self._copy_proc
         if proc is None:
             # Local job so no copy needed.
+            self._release()
             return True
         else:
             if proc.poll() is None:
                 return False
+            elif proc.returncode != 0 and self.job_proxy is not None:
+                self._copy_failures += 1
+                if self._copy_failures > self.max_copy_retries:
+                    raise RuntimeError(
+                        'Unable to copy the output of the task with output '
+                        'in %s.' % self.output_dir
+                    )
+                print('\nCopying output in %s failed, retrying.' %
+                      self.output_dir)
+                self._copy_proc = self._scheduler.copy_output(
+                    self.job_proxy, '.', priority=self.copy_priority
+                )
+                return False
             else:
                 if self.job_proxy is not None:
-                    self.job_proxy.clean()
+                    self._scheduler.record_copy(
+                        self.job_proxy, time.time() - self._copy_start
+                    )
+                    if not self.job.lazy:
+                        # The output not copied is left on the worker in
+                        # lazy mode so it can be fetched later.
+                        self.job_proxy.clean()
+                    self._release()
                     self._finished = True
                 return True
 
     def _copy_output_and_check_status(self):
+        if self._retry_at is not None:
+            if time.time() < self._retry_at:
+                return False
+            self._resubmit()
         jp = self.job_proxy
         status = jp.status()
         if status == 'done':
             if self._copy_proc is None:
-                self._copy_proc = jp.copy_output('.')
+                self._copy_start = time.time()
+                self._copy_proc = self._scheduler.copy_output(
+                    jp, '.', priority=self.copy_priority
+                )
             return self._check_if_copy_complete()
+        elif status == 'lost':
+            print('\nHost %s was lost while running %s, resubmitting it.' %
+                  (jp.worker.host, ' '.join(self.command)))
+            self._copy_proc = None
+            self._resubmit()
+            return False
         elif status == 'error':
             cmd = ' '.join(self.command)
+            delay = self._scheduler.retry_delay(jp)
+            if delay is not None:
+                print('\nOn host %s Job %s failed, retrying in %d seconds.' %
+                      (jp.worker.host, cmd, delay))
+                jp.clean()
+                self._retry_at = time.time() + delay
+                return False
             msg = '\n***************** ERROR *********************\n'
             msg += 'On host %s Job %s failed!' % (jp.worker.host, cmd)
             print(msg)
@@ -364,10 +600,20 @@ class CommandTask(Task):
             print('***************** ERROR **********************')
             with open(self._error_status_file, 'w') as fp:
                 fp.write('')
+            self._release()
             self._finished = True
             raise RuntimeError(msg)
         return False
 
+    def _release(self):
+        if self._scheduler is not None and self.job_proxy is not None:
+            self._scheduler.release(self.job_proxy)
+
+    def _resubmit(self):
+        self._retry_at = None
+        avoid = [x['host'] for x in self.job.attempts]
+        self.job_proxy = self._scheduler.submit(self.job, avoid=avoid)
+
 
 class PySPHTask(CommandTask):
     """Convenience class to run a PySPH simulation via an automation
@@ -487,6 +733,18 @@ class Problem(object):
        are to be exeuted before the `run` method is called.
      - `run(self)`: Processes the completed simulations to make plots etc.
 
+    When parallel post-processing is enabled, see `PostProcessor`, the `run`
+    method is called in a forked process so that independent problems are
+    post-processed in parallel, set `run_in_subprocess` to False if this is
+    not safe for the problem. Any changes made to the problem in `run` are
+    then not seen by the automation.
+
+    If `results_keys` is set, the given arrays in the results of the
+    simulations in `self.cases` are consolidated into a single
+    `automan.results.ResultsStore` in the simulation directory of the
+    problem, as the simulations complete. The store is available in `run` as
+    `self.results_store`.
+
     See the `EllipticalDrop` example class below to see a full implementation.
 
     """
@@ -494,6 +752,18 @@ class Problem(object):
     # The Task class to create for the cases, change to suit your needs.
     task_cls = CommandTask
 
+    # Run the `run` method in a forked process when the post-processing is
+    # done in parallel.
+    run_in_subprocess = True
+
+    # Names of the arrays in the results of the cases to consolidate into the
+    # results store, 'all' for all of them or None to not use a store.
+    results_keys = None
+
+    # Minimum interval in seconds between saves of the results store as the
+    # cases complete.
+    results_store_interval = 30.0
+
     def __init__(self, simulation_dir, output_dir):
         """Constructor.
 
@@ -617,6 +887,48 @@ class Problem(object):
             result.append((task_name, task))
         return result
 
+    @property
+    def case_set(self):
+        """The cases as an `automan.utils.CaseSet`, for fast filtering of a
+        large number of cases. This is rebuilt if `self.cases` is replaced.
+        """
+        cases = self.cases if self.cases is not None else []
+        if isinstance(cases, CaseSet):
+            return cases
+        cached = getattr(self, '_case_set', None)
+        if cached is None or cached[0] is not cases or \
+                len(cached[1]) != len(cases):
+            cached = (cases, CaseSet(cases))
+            self._case_set = cached
+        return cached[1]
+
+    @property
+    def results_store(self):
+        """The `automan.results.ResultsStore` with the results of the cases.
+        """
+        if getattr(self, '_results_store', None) is None:
+            from .results import ResultsStore
+            self._results_store = ResultsStore(
+                self.input_path('results_store.npz'),
+                interval=self.results_store_interval
+            )
+        return self._results_store
+
+    def update_results_store(self, cases=None):
+        """Add the results of the given cases, by default all of them, to the
+        results store if they are new or changed. The store is saved at most
+        every `results_store_interval` seconds, and always when all the cases
+        are added. Does nothing if `results_keys` is None.
+        """
+        if self.results_keys is None or self.cases is None:
+            return
+        keys = None if self.results_keys == 'all' else self.results_keys
+        if cases is None:
+            self.results_store.update(self.cases, keys)
+            self.results_store.flush()
+        else:
+            self.results_store.update(cases, keys)
+
     def get_outputs(self):
         """Get a list of outputs generated by this problem.  By default it
         returns the output directory (as a single element of a list).
@@ -706,6 +1018,14 @@ class Simulation(object):
         >>> s = Simlation('outputs/sph', 'pysph run elliptical_drop',
         ...               job_info=dict(n_thread=4))
 
+    If the job is run on a remote worker and only a few of its output files
+    are needed, the others can be left on the worker and fetched by
+    ``input_path`` when they are asked for::
+
+        >>> s = Simlation('outputs/sph', 'pysph run elliptical_drop',
+        ...               job_info=dict(copy_include=['*.info', '*.npz'],
+        ...                             lazy=True))
+
     The object has other methods that are convenient when comparing plots.
     Along with the ``compare_cases``, ``filter_cases`` and ``filter_by_name``
     this is an extremely powerful way to automate and compare results.
@@ -738,8 +1058,15 @@ class Simulation(object):
     def input_path(self, *args):
         """Given any arguments, relative to the simulation dir, return
         the absolute path.
+
+        If the simulation was run in lazy mode on a remote worker and the path
+        does not exist, it is fetched from the worker, see
+        `automan.jobs.fetch_file`.
         """
-        return os.path.join(self.root, *args)
+        path = os.path.join(self.root, *args)
+        if args and not os.path.exists(path):
+            fetch_file(path)
+        return path
 
     @property
     def command(self):
@@ -747,9 +1074,20 @@ class Simulation(object):
 
     @property
     def data(self):
+        """The results of the simulation as a read-only mapping of arrays that
+        are loaded when they are first used, see `automan.results`.
+        """
         if self._results is None:
-            import numpy
-            self._results = numpy.load(self.input_path('results.npz'))
+            from .results import RESULTS_DIR, RESULTS_FILE, Results
+            # Look for the results here before fetching any from a worker.
+            path = os.path.join(self.root, RESULTS_DIR)
+            if not os.path.isdir(path):
+                path = os.path.join(self.root, RESULTS_FILE)
+                if not os.path.exists(path):
+                    path = self.input_path(RESULTS_DIR)
+                    if not os.path.isdir(path):
+                        path = self.input_path(RESULTS_FILE)
+            self._results = Results(path)
         return self._results
 
     def get_labels(self, labels):
@@ -792,6 +1130,11 @@ class SolveProblem(Task):
 
     The force argument specifies that the problem should be cleaned, so as to
     re-run any post-processing.
+
+    If a `PostProcessor` is set as the `post_processor`, which the
+    `TaskRunner` does when it is given one, the problem's `run` method is run
+    with it unless the problem's `run_in_subprocess` is False or processes
+    cannot be forked.
     """
 
     def __init__(self, problem, match='', force=False, depends=None):
@@ -799,6 +1142,11 @@ class SolveProblem(Task):
         self.problem = problem
         self.match = match
         self.force = force
+        # Output directories of the cases added to the results store.
+        self._results_done = set()
+        self.post_processor = None
+        self._post_process_job = None
+        self._error = None
         if self.force:
             self.problem.clean()
         self._requires = [
@@ -830,6 +1178,20 @@ class SolveProblem(Task):
         return 'Problem named %s' % self.problem.get_name()
 
     def complete(self):
+        if self._error is not None:
+            raise RuntimeError(self._error)
+        job = self._post_process_job
+        if job is not None:
+            result = job.poll()
+            if result is None:
+                return False
+            self._post_process_job = None
+            if result:
+                print("\nError in post-processing of %s:\n%s" % (
+                    self, result
+                ))
+                self._error = 'Error in post-processing of %s.' % self
+                raise RuntimeError(self._error)
         if len(self.match) == 0:
             return super(SolveProblem, self).complete()
         else:
@@ -840,11 +1202,32 @@ class SolveProblem(Task):
 
     def run(self, scheduler):
         if len(self.match) == 0:
-            self.problem.run()
+            self.problem.update_results_store()
+            processor = self.post_processor
+            if (processor is not None and processor.can_fork() and
+                    getattr(self.problem, 'run_in_subprocess', True)):
+                self._post_process_job = processor.submit(self.problem)
+            else:
+                self.problem.run()
 
     def requires(self):
         return self._requires + self.depends
 
+    def update_results(self, done):
+        """Add the results of the cases whose output directories are in
+        `done` to the problem's results store.
+        """
+        if self.problem.results_keys is None or self.problem.cases is None:
+            return
+        new = set(done) - self._results_done
+        cases = [
+            x for x in self.problem.cases
+            if os.path.normpath(self.problem.input_path(x.name)) in new
+        ]
+        if cases:
+            self.problem.update_results_store(cases)
+        self._results_done.update(new)
+
 
 class RunAll(WrapperTask):
     """Solves a given collection of problems.
@@ -1029,16 +1412,20 @@ class Automator(object):
             )
             from .cluster_manager import BootstrapError
 
+            failed = []
             if len(args.host) > 0:
                 try:
-                    self.cluster_manager.add_worker(
-                        args.host, args.home, args.nfs
+                    self.cluster_manager.add_workers(
+                        args.host.split(','), args.home, args.nfs
                     )
                 except BootstrapError:
                     pass
                 return
             elif len(args.host) == 0 and args.update_remote:
-                self.cluster_manager.update(not args.no_rebuild)
+                failed = self.cluster_manager.update(not args.no_rebuild)
+                if failed:
+                    print("Not using the hosts that could not be updated: "
+                          "%s" % ', '.join(failed))
             elif len(args.rm_remote_output) > 0:
                 self.cluster_manager.delete(
                     self.simulation_dir, args.rm_remote_output)
@@ -1052,8 +1439,16 @@ class Automator(object):
             )
             self.runall_task = task
 
-            self.scheduler = self.cluster_manager.create_scheduler()
-            self.runner = TaskRunner([task], self.scheduler)
+            self.scheduler = self.cluster_manager.create_scheduler(
+                exclude=failed
+            )
+            set_fetch_journal(self.scheduler.journal)
+            post_processor = None
+            if args.parallel_post_process:
+                post_processor = PostProcessor()
+            self.runner = TaskRunner(
+                [task], self.scheduler, post_processor=post_processor
+            )
 
     def _setup_argparse(self):
         import argparse
@@ -1073,7 +1468,8 @@ class Automator(object):
 
         parser.add_argument(
             '-a', '--add-node', action="store", dest="host", type=str,
-            default='', help="Add a new remote worker."
+            default='',
+            help="Add new remote workers, separate several hosts by commas."
         )
         parser.add_argument(
             '-c', '--config', action="store", dest="config",
@@ -1098,6 +1494,12 @@ class Automator(object):
             '-m', '--match', action="store", type=str, default='',
             dest='match', help="Name of the problem to run (uses fnmatch)"
         )
+        parser.add_argument(
+            '--parallel-post-process', action="store_true",
+            dest="parallel_post_process", default=False,
+            help="Post-process independent problems in parallel in forked "
+            "processes, only where fork is the multiprocessing start method."
+        )
         parser.add_argument(
             '--no-rebuild', action="store_true",
             dest="no_rebuild", default=False,
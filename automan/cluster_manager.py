@@ -7,24 +7,102 @@ This is currently only tested on Linux machines.
 
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+import hashlib
 import json
 import os
 import shlex
+import shutil
 import stat
 import subprocess
 import sys
+import tempfile
 from textwrap import dedent
+import threading
 
 try:
     from urllib import urlopen
 except ImportError:
     from urllib.request import urlopen
 
+from .ssh import ssh_command, ssh_options
+
 
 class BootstrapError(Exception):
     pass
 
 
+def _fingerprint(data):
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+def _parent_dirs(rel):
+    """Return the parent directories of the relative path, outermost first.
+    """
+    parts = rel.split(os.sep)[:-1]
+    return [os.path.join(*parts[:i + 1]) for i in range(len(parts))]
+
+
+class _SyncState(object):
+    """The fingerprints of the sources last synced to each host, saved in a
+    JSON file.
+
+    The listing of the files of each fingerprint that is in use is also saved
+    so the files changed since the last sync to a host can be found.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.hosts = dict()
+        self.manifests = dict()
+        self._lock = threading.Lock()
+        if os.path.exists(fname):
+            with open(fname) as fp:
+                try:
+                    data = json.load(fp)
+                except ValueError:
+                    data = dict()
+            self.hosts = data.get('hosts', dict())
+            self.manifests = data.get('manifests', dict())
+
+    def get(self, host, key):
+        """Return a tuple of the (fingerprint, files) last synced to the host
+        for the given key, either may be None.
+        """
+        with self._lock:
+            fingerprint = self.hosts.get(host, dict()).get(key)
+            return fingerprint, self.manifests.get(fingerprint)
+
+    def record(self, host, key, fingerprint, files=None):
+        with self._lock:
+            self.hosts.setdefault(host, dict())[key] = fingerprint
+            if files is not None:
+                self.manifests[fingerprint] = files
+            self._save()
+
+    def forget(self, host):
+        with self._lock:
+            if self.hosts.pop(host, None) is not None:
+                self._save()
+
+    def _save(self):
+        used = set(
+            x for synced in self.hosts.values() for x in synced.values()
+        )
+        for fingerprint in list(self.manifests):
+            if fingerprint not in used:
+                del self.manifests[fingerprint]
+        dirname = os.path.dirname(self.fname)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(dict(hosts=self.hosts, manifests=self.manifests), fp)
+        os.replace(tmp, self.fname)
+
+
 class ClusterManager(object):
     """The cluster manager class.
 
@@ -54,13 +132,35 @@ class ClusterManager(object):
 
     1. `add_worker(self, host, home, nfs)` which adds a new worker machine by
        bootstrapping the machine with the software and the appropriate source
-       directories.
+       directories. `add_workers` does this for several machines.
 
     2. `update()`, which keeps the directory and software up-to-date.
 
+    If ``"wheelhouse": true`` is set in the configuration, the wheels of
+    automan and of the packages in the project's ``requirements.txt`` are
+    built on this machine with ``pip wheel`` into ``.{self.root}/wheelhouse``,
+    once for each version of the requirements, and copied to every host. The
+    bootstrap and update scripts are then run with pip set to install only
+    from these wheels, so hosts without internet access can be used. The hosts
+    must have the same platform and Python version as this machine.
+
+    The sources are only synced to a host if they changed since they were
+    last synced to it, and then only the changed files are synced. A
+    fingerprint of each source directory, computed from the size and
+    modification time of its files, is stored for each host in
+    ``.{self.root}/sync_state.json``. Remove this file to sync everything.
+
+    The operations on several remote workers are run concurrently on at most
+    `max_parallel` hosts at a time. The output of the commands run for a host
+    is prefixed with the name of the host and a summary of the hosts on which
+    the operation succeeded or failed is printed at the end.
+
     The class variables BOOTSTRAP and UPDATE are the content of scripts
     uploaded to these machines and should be extended by users to do what they
-    wish.
+    wish. ENV_FILES are the files in the project directory that describe the
+    software environment. A hash of these and the scripts is recorded on each
+    host when it is bootstrapped or updated and the update script is only run
+    again when the hash changes.
 
     The class creates a ``config.json`` in the current working directory that
     may be edited by a user. It also creates a directory called
@@ -70,8 +170,9 @@ class ClusterManager(object):
 
     One may override the `_get_python, _get_helper_scripts`, and
     `_get_bootstrap_code, _get_update_code` methods to change this to use other
-    package managers like edm or conda. See the conda_cluster_manager for an
-    example.
+    package managers like edm or conda. The `_prepare_env, _sync_env` methods
+    may be overridden to build something locally and copy it to the hosts
+    before the scripts are run. See the conda_cluster_manager for an example.
 
     """
 
@@ -109,6 +210,10 @@ class ClusterManager(object):
              pip install -r requirements.txt
          fi
          """)
+
+    # Files in the project directory used by the scripts to set up the
+    # software environment.
+    ENV_FILES = ('requirements.txt',)
     #######################################################
 
     def __init__(self, root='automan', sources=None,
@@ -135,10 +240,27 @@ class ClusterManager(object):
         """
         self.root = root
         self.workers = []
+        # Settings for copying back the outputs from "copy" in the config.
+        self.copy_config = dict()
+        # The "speculative" setting of the config, see
+        # `automan.jobs.Scheduler`.
+        self.speculative = None
         self.sources = sources
         self.scripts_dir = os.path.abspath('.' + self.root)
         self.exclude_paths = exclude_paths if exclude_paths else []
         self.testing = testing
+        # Maximum number of hosts that are updated at the same time.
+        self.max_parallel = 8
+        # The host that the current thread is working on, if any.
+        self._local = threading.local()
+        self._print_lock = threading.Lock()
+        # Scans of the source directories, computed once per operation.
+        self._scans = dict()
+        self._scan_lock = threading.Lock()
+        self._sync_state = None
+        # Use a wheelhouse to install the Python packages on the hosts.
+        self.use_wheelhouse = False
+        self._wheelhouse_lock = threading.Lock()
 
         # This is setup by the config and is the name of
         # the project directory.
@@ -164,15 +286,22 @@ class ClusterManager(object):
         abs_root = os.path.join(home, self.root)
         if helper_scripts:
             real_host = '' if self.testing else '{host}:'.format(host=host)
-            cmd = "scp {helper_scripts} {host}{root}".format(
-                host=real_host, root=abs_root, helper_scripts=helper_scripts
+            cmd = "{scp} {helper_scripts} {host}{root}".format(
+                scp=self._scp_command(), host=real_host, root=abs_root,
+                helper_scripts=helper_scripts
             )
             self._run_command(cmd)
 
+        # The host may have been set up afresh, so sync everything.
+        self._get_sync_state().forget(host)
         self._update_sources(host, home)
+        self._sync_env(host, home)
 
-        cmd = "cd {abs_root}; ./{project_name}/.{root}/bootstrap.sh".format(
-            abs_root=abs_root, root=self.root, project_name=self.project_name
+        cmd = ("cd {abs_root}; {pip_env}./{project_name}/.{root}/bootstrap.sh "
+               "&& echo {env_hash} > {hash_file}").format(
+            abs_root=abs_root, root=self.root, project_name=self.project_name,
+            env_hash=self._get_env_hash(), hash_file=self._get_hash_file(),
+            pip_env=self._get_pip_env(home)
         )
         try:
             self._ssh_run_command(host, cmd)
@@ -202,10 +331,10 @@ class ClusterManager(object):
                        scripts_dir=self.scripts_dir,
                        project_name=self.project_name)
             )
-            print(msg)
+            self._print(msg)
             raise BootstrapError(msg)
         else:
-            print("Bootstrapping {host} succeeded!".format(host=host))
+            self._print("Bootstrapping {host} succeeded!".format(host=host))
 
     def _get_bootstrap_code(self):
         return self.BOOTSTRAP.format(project_name=self.project_name)
@@ -245,6 +374,7 @@ class ClusterManager(object):
             self.project_name = data['project_name']
             self.sources = data['sources']
             self.workers = data['workers']
+            self._read_settings(data)
         else:
             if self.sources is None or len(self.sources) == 0:
                 project_dir = os.path.abspath(os.getcwd())
@@ -254,27 +384,345 @@ class ClusterManager(object):
             self._write_config()
         self.scripts_dir = os.path.abspath('.' + self.root)
 
+    def _read_settings(self, data):
+        """Read the optional settings from the configuration `data`.
+        """
+        self.copy_config = data.get('copy', dict())
+        self.speculative = data.get('speculative')
+        self.use_wheelhouse = data.get('wheelhouse', False)
+
+    def _write_settings(self, data):
+        """Add the optional settings that are set to the configuration
+        `data`.
+        """
+        if self.copy_config:
+            data['copy'] = self.copy_config
+        if self.speculative:
+            data['speculative'] = self.speculative
+        if self.use_wheelhouse:
+            data['wheelhouse'] = True
+
+    def _get_project_dir(self):
+        """Return the local directory that is the project directory on the
+        remote hosts.
+        """
+        for src in self.sources:
+            if os.path.basename(src.rstrip('/')) == self.project_name:
+                return src
+        return os.getcwd()
+
+    def _get_env_hash(self):
+        """Return a hash of the `ENV_FILES` and the bootstrap and update
+        scripts.
+        """
+        sha = hashlib.sha1()
+        project_dir = self._get_project_dir()
+        paths = [os.path.join(project_dir, x) for x in self.ENV_FILES]
+        for path in paths + self._get_script_files():
+            sha.update(os.path.basename(path).encode('utf-8'))
+            if os.path.exists(path):
+                with open(path, 'rb') as fp:
+                    sha.update(fp.read())
+            else:
+                sha.update(b'\0')
+        return sha.hexdigest()
+
+    def _get_hash_file(self):
+        """Return the path, relative to the root on the remote, of the file
+        with the hash of the environment that was set up.
+        """
+        return '{project_name}/.{root}/env_hash'.format(
+            project_name=self.project_name, root=self.root
+        )
+
+    def _get_wheelhouse(self):
+        return os.path.join(self.scripts_dir, 'wheelhouse')
+
+    def _build_wheelhouse(self):
+        """Build the wheels of automan and the project's requirements unless
+        they were built for the current requirements. Returns the hash of the
+        requirements.
+        """
+        sha = hashlib.sha1()
+        sha.update(('automan %d.%d' % sys.version_info[:2]).encode('utf-8'))
+        requirements = os.path.join(
+            self._get_project_dir(), 'requirements.txt'
+        )
+        if os.path.exists(requirements):
+            with open(requirements, 'rb') as fp:
+                sha.update(fp.read())
+        req_hash = sha.hexdigest()
+        wheelhouse = self._get_wheelhouse()
+        stamp = os.path.join(wheelhouse, '.hash')
+        with self._wheelhouse_lock:
+            if os.path.exists(stamp):
+                with open(stamp) as fp:
+                    if fp.read().strip() == req_hash:
+                        return req_hash
+            if os.path.exists(wheelhouse):
+                shutil.rmtree(wheelhouse)
+            os.makedirs(wheelhouse)
+            cmd = [sys.executable, '-m', 'pip', 'wheel', '-w', wheelhouse,
+                   'automan']
+            if os.path.exists(requirements):
+                cmd.extend(['-r', requirements])
+            self._print(' '.join(cmd))
+            self._check_call(cmd)
+            with open(stamp, 'w') as fp:
+                fp.write(req_hash)
+        return req_hash
+
+    def _sync_wheelhouse(self, host, home):
+        req_hash = self._build_wheelhouse()
+        state = self._get_sync_state()
+        if state.get(host, 'wheelhouse')[0] == req_hash:
+            return
+        real_host = '' if self.testing else '{host}:'.format(host=host)
+        dest = os.path.join(home, self.root, 'wheelhouse/')
+        self._ssh_run_command(host, 'mkdir -p %s' % dest)
+        cmd = "{rsync} -a --delete {src}/ {host}{dest}".format(
+            rsync=self._rsync_command(), src=self._get_wheelhouse(),
+            host=real_host, dest=dest
+        )
+        self._run_command(cmd)
+        state.record(host, 'wheelhouse', req_hash)
+
+    def _get_pip_env(self, home):
+        """Return the shell code to set pip to install from the wheelhouse
+        on the host, if it is used.
+        """
+        if not self.use_wheelhouse:
+            return ''
+        return 'export PIP_NO_INDEX=1 PIP_FIND_LINKS={path}; '.format(
+            path=os.path.join(home, self.root, 'wheelhouse')
+        )
+
+    def _prepare_env(self):
+        """Prepare anything needed locally to set up the environment on the
+        hosts. This is called once before the hosts are set up concurrently.
+        """
+        if self.use_wheelhouse:
+            self._build_wheelhouse()
+
+    def _sync_env(self, host, home):
+        """Copy anything needed to set up the environment to the host.
+        """
+        if self.use_wheelhouse:
+            self._sync_wheelhouse(host, home)
+
     def _rebuild(self, host, home):
+        self._sync_env(host, home)
         abs_root = os.path.join(home, self.root)
-        base_cmd = "cd {abs_root}; ./{project_name}/.{root}/update.sh".format(
-            abs_root=abs_root, root=self.root, project_name=self.project_name
+        base_cmd = dedent("""\
+            cd {abs_root};
+            if [ "$(cat {hash_file} 2>/dev/null)" = "{env_hash}" ]; then
+                echo "The environment is up to date.";
+            else
+                {pip_env}./{project_name}/.{root}/update.sh &&
+                echo {env_hash} > {hash_file};
+            fi""").format(
+            abs_root=abs_root, root=self.root, project_name=self.project_name,
+            env_hash=self._get_env_hash(), hash_file=self._get_hash_file(),
+            pip_env=self._get_pip_env(home)
         )
         self._ssh_run_command(host, base_cmd)
 
+    def _print(self, msg):
+        """Print the message, prefixing each line with the host that the
+        current thread is working on.
+        """
+        host = getattr(self._local, 'host', None)
+        if host is None:
+            print(msg)
+        else:
+            with self._print_lock:
+                for line in str(msg).splitlines() or ['']:
+                    print('[{host}] {line}'.format(host=host, line=line))
+                sys.stdout.flush()
+
+    def _check_call(self, cmd, **kw):
+        if getattr(self._local, 'host', None) is None:
+            subprocess.check_call(cmd, **kw)
+        else:
+            # Prefix the output with the host.
+            proc = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True, **kw
+            )
+            for line in proc.stdout:
+                self._print(line.rstrip('\n'))
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+
     def _run_command(self, cmd, **kw):
-        print(cmd)
-        subprocess.check_call(shlex.split(cmd), **kw)
+        self._print(cmd)
+        self._check_call(shlex.split(cmd), **kw)
+
+    def _run_on_hosts(self, name, func, workers):
+        """Call `func(host, home)` for each of the given worker configurations
+        concurrently, print a summary and return the hosts for which it
+        failed.
+        """
+        def run(worker):
+            host = worker.get('host')
+            self._local.host = host
+            try:
+                func(host, worker.get('home'))
+            except Exception as e:
+                return host, e
+            finally:
+                self._local.host = None
+            return host, None
+
+        if len(workers) == 0:
+            return []
+        n_threads = max(1, min(self.max_parallel, len(workers)))
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            results = list(pool.map(run, workers))
+        self._print_summary(name, results)
+        return [host for host, error in results if error is not None]
+
+    def _print_summary(self, name, results):
+        width = max(len(host) for host, error in results + [('host', None)])
+        print("\nSummary of {name}:".format(name=name))
+        print("  {host:{width}}  status".format(host='host', width=width))
+        for host, error in results:
+            if error is None:
+                status = 'ok'
+            else:
+                lines = str(error).strip().splitlines()
+                status = 'FAILED: ' + (lines[0] if lines else repr(error))
+            print("  {host:{width}}  {status}".format(
+                host=host, width=width, status=status
+            ))
 
     def _ssh_run_command(self, host, base_cmd):
         if self.testing:
             command = base_cmd
-            print(command)
-            subprocess.check_call(command, shell=True)
+            self._print(command)
+            self._check_call(command, shell=True)
         else:
-            command = "ssh {host} '{cmd}'".format(host=host, cmd=base_cmd)
+            command = "ssh {options} {host} '{cmd}'".format(
+                options=' '.join(ssh_options()), host=host, cmd=base_cmd
+            )
             self._run_command(command)
 
-    def _sync_dir(self, host, src, dest):
+    def _scp_command(self):
+        """Return the scp command that uses the shared connection to the
+        hosts, see `automan.ssh`.
+        """
+        if self.testing:
+            return 'scp'
+        return ' '.join(['scp'] + ssh_options())
+
+    def _rsync_command(self):
+        """Return the rsync command that uses the shared connection to the
+        hosts, see `automan.ssh`.
+        """
+        if self.testing:
+            return 'rsync'
+        return 'rsync -e "{ssh}"'.format(ssh=ssh_command())
+
+    def _get_sync_state(self):
+        if self._sync_state is None:
+            self._sync_state = _SyncState(
+                os.path.join(self.scripts_dir, 'sync_state.json')
+            )
+        return self._sync_state
+
+    def _is_excluded(self, rel):
+        name = os.path.basename(rel)
+        for path in self.exclude_paths:
+            path = path.rstrip('/')
+            if fnmatch(rel, path) or fnmatch(name, path):
+                return True
+        return False
+
+    def _scan_source(self, src):
+        """Return a tuple of the (fingerprint, files) of the source directory,
+        where files maps the path of each file, as it is synced by rsync, to
+        its (size, mtime). The scan is done once for each operation.
+
+        In a git repository only the files listed by ``git ls-files -co
+        --exclude-standard`` are scanned, so ignored files are skipped.
+        """
+        with self._scan_lock:
+            if src not in self._scans:
+                self._scans[src] = self._do_scan_source(src)
+            return self._scans[src]
+
+    def _list_git_files(self, src):
+        """Return the paths, relative to `src`, of the files that git tracks
+        or that are untracked but not ignored, or None if `src` is not a git
+        repository.
+        """
+        if not os.path.isdir(os.path.join(src, '.git')):
+            return None
+        try:
+            output = subprocess.check_output(
+                ['git', '-C', src, 'ls-files', '-co', '--exclude-standard',
+                 '-z'],
+                stderr=subprocess.DEVNULL
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return [os.path.normpath(x) for x in output.decode().split('\0') if x]
+
+    def _walk_source(self, src, skip):
+        """Return the paths, relative to `src`, of all the files in `src`
+        that are not excluded, without going into the directories for which
+        `skip(rel_path)` is True.
+        """
+        paths = []
+        for root, dirs, fnames in os.walk(src):
+            rel_root = os.path.relpath(root, src)
+            dirs[:] = [
+                d for d in dirs
+                if not skip(os.path.normpath(os.path.join(rel_root, d)))
+            ]
+            paths.extend(
+                os.path.normpath(os.path.join(rel_root, fname))
+                for fname in fnames
+            )
+        return paths
+
+    def _do_scan_source(self, src):
+        # rsync copies the directory itself unless src ends with a slash.
+        prefix = '' if src.endswith('/') else os.path.basename(src)
+        # The scripts directory has the sync state, the job journal and
+        # metrics which change all the time, the scripts are synced
+        # separately.
+        scripts_dir = os.path.abspath(self.scripts_dir)
+
+        def skip(rel):
+            return (
+                os.path.basename(rel) == '.git' or
+                os.path.abspath(os.path.join(src, rel)) == scripts_dir or
+                self._is_excluded(rel)
+            )
+
+        paths = self._list_git_files(src)
+        if paths is None:
+            paths = self._walk_source(src, skip)
+        else:
+            # Drop the files that are in the skipped directories.
+            paths = [
+                rel for rel in paths
+                if not any(skip(d) for d in _parent_dirs(rel))
+            ]
+        files = dict()
+        for rel in paths:
+            path = os.path.join(src, rel)
+            if self._is_excluded(rel) or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            files[os.path.join(prefix, rel)] = [st.st_size, int(st.st_mtime)]
+        return _fingerprint(files), files
+
+    def _sync_dir(self, host, src, dest, files=None):
+        """Sync the directory `src` into `dest` on the host. If `files` is
+        given, only these paths, as returned by `_scan_source`, are synced.
+        """
         options = ""
         kwargs = dict()
         if os.path.isdir(os.path.join(src, '.git')):
@@ -289,42 +737,102 @@ class ClusterManager(object):
         if self.exclude_paths:
             for path in self.exclude_paths:
                 options += ' --exclude="%s"' % path
+        # The wheelhouse and packed environments are copied separately.
+        options += ' --exclude=".{root}/wheelhouse/"'.format(root=self.root)
+        options += ' --exclude=".{root}/pack/"'.format(root=self.root)
+
+        if files is not None:
+            with tempfile.NamedTemporaryFile(
+                    'w', suffix='.txt', delete=False) as fp:
+                fp.write('\n'.join(files))
+            options += ' --files-from=%s' % fp.name
+            if not src.endswith('/'):
+                src = os.path.dirname(src) + '/'
 
         real_host = '' if self.testing else '{host}:'.format(host=host)
-        command = "rsync -a {options} {src} {host}{dest} ".format(
-            options=options, src=src, host=real_host, dest=dest
+        command = "{rsync} -a {options} {src} {host}{dest} ".format(
+            rsync=self._rsync_command(), options=options, src=src,
+            host=real_host, dest=dest
         )
-        self._run_command(command, **kwargs)
-
-    def _update_sources(self, host, home):
-        for local_dir in self.sources:
-            remote_dir = os.path.join(home, self.root + '/')
-            self._sync_dir(host, local_dir, remote_dir)
+        try:
+            self._run_command(command, **kwargs)
+        finally:
+            if files is not None:
+                os.remove(fp.name)
+
+    def _get_script_kind(self):
+        """Return the kind of bootstrap and update scripts that are created,
+        the scripts are created again when this changes.
+        """
+        return ''
 
+    def _get_script_files(self):
+        """Return the paths to the bootstrap and update scripts, creating them
+        if they do not exist or were created for another kind of scripts, see
+        `_get_script_kind`.
+        """
         scripts_dir = self.scripts_dir
         bootstrap_code = self._get_bootstrap_code()
         update_code = self._get_update_code()
         scripts = {'bootstrap.sh': bootstrap_code,
                    'update.sh': update_code}
+        kind = self._get_script_kind()
+        kind_file = os.path.join(scripts_dir, 'scripts_kind')
+        last_kind = ''
+        if os.path.exists(kind_file):
+            with open(kind_file) as f:
+                last_kind = f.read().strip()
         for script, code in scripts.items():
             fname = os.path.join(scripts_dir, script)
-            if not os.path.exists(fname):
+            if not os.path.exists(fname) or kind != last_kind:
                 # Create the scripts if they don't exist.
                 with open(fname, 'w') as f:
                     f.write(code)
+        if kind != last_kind:
+            with open(kind_file, 'w') as f:
+                f.write(kind)
 
         script_files = [os.path.join(scripts_dir, x) for x in scripts]
         for fname in script_files:
             mode = os.stat(fname).st_mode
             os.chmod(fname, mode | stat.S_IXUSR | stat.S_IXGRP)
+        return script_files
 
+    def _update_sources(self, host, home):
+        state = self._get_sync_state()
+        for local_dir in self.sources:
+            remote_dir = os.path.join(home, self.root + '/')
+            fingerprint, files = self._scan_source(local_dir)
+            last, last_files = state.get(host, local_dir)
+            if last == fingerprint:
+                self._print("%s is up to date." % local_dir)
+                continue
+            changed = None
+            if last_files is not None:
+                changed = sorted(
+                    rel for rel, info in files.items()
+                    if last_files.get(rel) != info
+                )
+            self._sync_dir(host, local_dir, remote_dir, files=changed)
+            state.record(host, local_dir, fingerprint, files)
+
+        script_files = self._get_script_files()
+        scripts = []
+        for fname in script_files:
+            with open(fname) as fp:
+                scripts.append(fp.read())
+        fingerprint = _fingerprint(scripts)
+        if state.get(host, 'scripts')[0] == fingerprint:
+            return
         path = os.path.join(home, self.root, self.project_name,
                             '.' + self.root)
         real_host = '' if self.testing else '{host}:'.format(host=host)
-        cmd = "scp {script_files} {host}{path}".format(
-            host=real_host, path=path, script_files=' '.join(script_files)
+        cmd = "{scp} {script_files} {host}{path}".format(
+            scp=self._scp_command(), host=real_host, path=path,
+            script_files=' '.join(script_files)
         )
         self._run_command(cmd)
+        state.record(host, 'scripts', fingerprint)
 
     def _delete_outputs(self, host, home, sim_dir):
         path = os.path.join(home, self.root, self.project_name,
@@ -343,39 +851,87 @@ class ClusterManager(object):
             sources=self.sources,
             workers=self.workers
         )
+        self._write_settings(data)
         with open(self.config_fname, 'w') as f:
             json.dump(data, f, indent=2)
 
     # ### Public Protocol ########################################
 
     def add_worker(self, host, home, nfs):
-        if host == 'localhost':
-            self.workers.append(dict(host=host, home=home, nfs=nfs))
-        else:
-            curdir = os.path.basename(os.getcwd())
-            if nfs:
-                python = sys.executable
-                chdir = curdir
+        """Add the given host as a worker and bootstrap it.
+
+        Raises a `BootstrapError` if the bootstrapping failed.
+        """
+        self.add_workers([host], home, nfs)
+
+    def add_workers(self, hosts, home, nfs):
+        """Add the given hosts as workers and bootstrap them concurrently.
+
+        Raises a `BootstrapError` after all the hosts are done if any of them
+        failed to bootstrap.
+        """
+        to_bootstrap = []
+        for host in hosts:
+            if host == 'localhost':
+                worker = dict(host=host, home=home, nfs=nfs)
             else:
-                python = self._get_python(host, home)
-                chdir = os.path.join(home, self.root, curdir)
-            self.workers.append(
-                dict(host=host, home=home, nfs=nfs, python=python, chdir=chdir)
-            )
+                curdir = os.path.basename(os.getcwd())
+                if nfs:
+                    python = sys.executable
+                    chdir = curdir
+                else:
+                    python = self._get_python(host, home)
+                    chdir = os.path.join(home, self.root, curdir)
+                worker = dict(
+                    host=host, home=home, nfs=nfs, python=python, chdir=chdir
+                )
+                if not nfs:
+                    to_bootstrap.append(worker)
+            self.workers.append(worker)
 
         self._write_config()
-        if host != 'localhost' and not nfs:
-            self._bootstrap(host, home)
+        self._scans = dict()
+        if len(to_bootstrap) == 1:
+            self._bootstrap(to_bootstrap[0]['host'], home)
+        elif len(to_bootstrap) > 1:
+            # Prepare the local files once before the concurrent bootstraps.
+            self._get_helper_scripts()
+            self._get_script_files()
+            self._prepare_env()
+            failed = self._run_on_hosts(
+                'bootstrap', self._bootstrap, to_bootstrap
+            )
+            if failed:
+                raise BootstrapError(
+                    'Bootstrapping failed on: %s' % ', '.join(failed)
+                )
+
+    def _remote_workers(self, hosts=None):
+        # SLURM workers share the filesystem of the login node so there is
+        # nothing to sync or bootstrap on them.
+        return [
+            w for w in self.workers
+            if w.get('host') != 'localhost' and not w.get('nfs', False) and
+            w.get('type') != 'slurm' and
+            (hosts is None or w.get('host') in hosts)
+        ]
 
     def update(self, rebuild=True):
-        for worker in self.workers:
-            host = worker.get('host')
-            home = worker.get('home')
-            nfs = worker.get('nfs', False)
-            if host != 'localhost' and not nfs:
-                self._update_sources(host, home)
-                if rebuild:
-                    self._rebuild(host, home)
+        """Update the sources on all the remote workers concurrently and,
+        if `rebuild` is True, run the update script on them.
+
+        Returns the list of hosts that could not be updated.
+        """
+        def _update(host, home):
+            self._update_sources(host, home)
+            if rebuild:
+                self._rebuild(host, home)
+
+        self._scans = dict()
+        self._get_script_files()
+        if rebuild:
+            self._prepare_env()
+        return self._run_on_hosts('update', _update, self._remote_workers())
 
     def delete(self, sim_dir, remotes):
         hosts = [h.get('host') for h in self.workers]
@@ -387,30 +943,55 @@ class ClusterManager(object):
                     print('%s remote is not a worker' % (remote))
                     sys.exit(1)
 
-        for worker in self.workers:
-            host = worker.get('host')
-            home = worker.get('home')
-            nfs = worker.get('nfs', False)
-            if host in remotes:
-                if host != 'localhost' and not nfs:
-                    self._delete_outputs(host, home, sim_dir)
+        def _delete(host, home):
+            self._delete_outputs(host, home, sim_dir)
 
+        return self._run_on_hosts(
+            'delete', _delete, self._remote_workers(remotes)
+        )
 
-    def create_scheduler(self):
+    def create_scheduler(self, exclude=()):
         """Return a `automan.jobs.Scheduler` from the configuration.
+
+        The workers whose host is in `exclude`, for example the hosts that
+        could not be updated, are left out.
         """
         from .jobs import Scheduler
 
-        scheduler = Scheduler(root='.')
+        # The optional "copy" settings of the configuration are
+        # "batch_window", "max_active", "max_per_host" and "bwlimit".
+        kw = dict(('copy_' + k, v) for k, v in self.copy_config.items())
+        scheduler = Scheduler(
+            root='.', metrics_dir=self.scripts_dir,
+            speculative=self.speculative,
+            journal=os.path.join(self.scripts_dir, 'journal.json'), **kw
+        )
         for worker in self.workers:
             host = worker.get('host')
             nfs = worker.get('nfs', False)
+            if host in exclude:
+                continue
             if host == 'localhost':
                 scheduler.add_worker(dict(host='localhost'))
+            elif worker.get('type') == 'slurm':
+                config = dict(host=host, type='slurm')
+                # See `automan.slurm.SlurmWorker` for these settings.
+                for key in ('python', 'partition', 'max_jobs',
+                            'cores_per_node', 'poll_interval', 'sbatch',
+                            'squeue', 'scancel', 'options'):
+                    if key in worker:
+                        config[key] = worker[key]
+                if self.testing:
+                    config['testing'] = True
+                scheduler.add_worker(config)
             else:
                 python = worker.get('python')
                 chdir = worker.get('chdir')
                 config = dict(host=host, python=python, chdir=chdir, nfs=nfs)
+                # Optional settings that are passed on to the worker.
+                for key in ('agent', 'queue_size', 'copy_method'):
+                    if key in worker:
+                        config[key] = worker[key]
                 if self.testing:
                     config['testing'] = True
                 scheduler.add_worker(config)
@@ -424,7 +1005,8 @@ class ClusterManager(object):
 
         parser.add_argument(
             '-a', '--add-node', action="store", dest="host", type=str,
-            default='', help="Add a new remote worker."
+            default='',
+            help="Add new remote workers, separate several hosts by commas."
         )
         parser.add_argument(
             '--home', action="store", dest="home", type=str,
@@ -447,4 +1029,4 @@ class ClusterManager(object):
         if len(args.host) == 0:
             self.update(not args.no_rebuild)
         else:
-            self.add_worker(args.host, args.home, args.nfs)
+            self.add_workers(args.host.split(','), args.home, args.nfs)
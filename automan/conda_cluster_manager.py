@@ -1,10 +1,25 @@
 import os
+import shutil
 from textwrap import dedent
+import threading
 
 from .cluster_manager import ClusterManager
 
 
 class CondaClusterManager(ClusterManager):
+    """Uses conda to set up the environment on the remote hosts.
+
+    By default the environment is created with ``conda env create`` on each
+    host. If ``"conda_pack": true`` is set in the configuration, it is
+    instead built once on this machine, packed with conda-pack into
+    ``.{root}/pack/{project_name}.tar.gz`` and copied to all the hosts, where
+    it is unpacked into ``{root}/envs/{project_name}``. Setting
+    ``"conda_pack"`` to the name of a host builds the environment on that
+    host instead, which is useful when this machine has a different platform.
+    The environment is packed again only when the environment files change.
+    The machine building it needs ``conda-pack`` installed in its base
+    environment.
+    """
 
     # The path to conda root on the remote, this is a relative path
     # and is relative to the home directory.
@@ -49,12 +64,171 @@ class CondaClusterManager(ClusterManager):
     fi
     """)
 
+    # Builds the environment in a prefix and packs it, this is run on the
+    # machine building the environment.
+    PACK = dedent("""\
+    #!/bin/bash
+
+    set -e
+    if hash conda 2>/dev/null; then
+        CONDA=conda
+    else
+        CONDA=~/{conda_root}/bin/conda
+    fi
+    PREFIX={pack_dir}/env
+    ENV_FILE="{project_dir}/environments.yml"
+    rm -rf $PREFIX
+    if [ -f $ENV_FILE ] ; then
+        $CONDA env create -q -f $ENV_FILE -p $PREFIX
+    else
+        $CONDA create -y -q -p $PREFIX psutil execnet pip
+    fi
+
+    $PREFIX/bin/pip install automan
+    if [ -f "{project_dir}/requirements.txt" ] ; then
+        $PREFIX/bin/pip install -r {project_dir}/requirements.txt
+    fi
+    $CONDA pack -q -p $PREFIX -o {pack_dir}/{project_name}.tar.gz --force
+    rm -rf $PREFIX
+    """)
+
+    # Unpacks the packed environment on the remote host.
+    UNPACK = dedent("""\
+    #!/bin/bash
+
+    set -e
+    ENV_DIR=envs/{project_name}
+    rm -rf $ENV_DIR
+    mkdir -p $ENV_DIR
+    tar -xzf pack/{project_name}.tar.gz -C $ENV_DIR
+    $ENV_DIR/bin/conda-unpack
+    """)
+
+    ENV_FILES = ('environments.yml', 'requirements.txt')
+
+    def __init__(self, *args, **kw):
+        # Build the environment once and pack it, this is True to build it
+        # on this machine or the name of the host to build it on.
+        self.conda_pack = False
+        self._pack_lock = threading.Lock()
+        super(CondaClusterManager, self).__init__(*args, **kw)
+
+    # ### Private Protocol ########################################
+    def _read_settings(self, data):
+        super(CondaClusterManager, self)._read_settings(data)
+        self.conda_pack = data.get('conda_pack', False)
+
+    def _write_settings(self, data):
+        super(CondaClusterManager, self)._write_settings(data)
+        if self.conda_pack:
+            data['conda_pack'] = self.conda_pack
+
+    def _get_builder(self):
+        """Return the (host, home) of the host that builds the packed
+        environment or None if it is built on this machine.
+        """
+        if self.conda_pack is True or self.conda_pack == 'localhost':
+            return None
+        for worker in self.workers:
+            if worker.get('host') == self.conda_pack:
+                return self.conda_pack, worker.get('home', '')
+        return self.conda_pack, ''
+
+    def _get_pack_code(self, pack_dir, project_dir):
+        return self.PACK.format(
+            project_name=self.project_name, conda_root=self.CONDA_ROOT,
+            pack_dir=pack_dir, project_dir=project_dir
+        )
+
+    def _get_packed_env(self):
+        return os.path.join(
+            self.scripts_dir, 'pack', self.project_name + '.tar.gz'
+        )
+
+    def _pack_env(self):
+        """Build and pack the environment unless it was packed for the
+        current environment files. Returns the hash of the environment.
+        """
+        env_hash = self._get_env_hash()
+        packed = self._get_packed_env()
+        pack_dir = os.path.dirname(packed)
+        stamp = os.path.join(pack_dir, '.hash')
+        with self._pack_lock:
+            if os.path.exists(stamp) and os.path.exists(packed):
+                with open(stamp) as fp:
+                    if fp.read().strip() == env_hash:
+                        return env_hash
+            if os.path.exists(pack_dir):
+                shutil.rmtree(pack_dir)
+            os.makedirs(pack_dir)
+            builder = self._get_builder()
+            if builder is None:
+                self._print("Packing the environment.")
+                self._check_call(['bash', '-c', self._get_pack_code(
+                    pack_dir, self._get_project_dir()
+                )])
+            else:
+                host, home = builder
+                self._print("Packing the environment on %s." % host)
+                abs_root = os.path.join(home, self.root)
+                remote_dir = os.path.join(abs_root, 'pack')
+                self._update_sources(host, home)
+                self._ssh_run_command(host, 'mkdir -p %s' % remote_dir)
+                self._ssh_run_command(host, self._get_pack_code(
+                    remote_dir, os.path.join(abs_root, self.project_name)
+                ))
+                real_host = '' if self.testing else '{host}:'.format(
+                    host=host
+                )
+                self._run_command("{scp} {host}{src} {dest}".format(
+                    scp=self._scp_command(), host=real_host, dest=packed,
+                    src=os.path.join(remote_dir, os.path.basename(packed))
+                ))
+            with open(stamp, 'w') as fp:
+                fp.write(env_hash)
+        return env_hash
+
+    def _sync_packed_env(self, host, home):
+        env_hash = self._pack_env()
+        state = self._get_sync_state()
+        if state.get(host, 'conda_pack')[0] == env_hash:
+            return
+        builder = self._get_builder()
+        # The builder already has the packed environment in place.
+        if builder is None or builder != (host, home):
+            dest = os.path.join(home, self.root, 'pack')
+            self._ssh_run_command(host, 'mkdir -p %s' % dest)
+            real_host = '' if self.testing else '{host}:'.format(host=host)
+            self._run_command("{scp} {src} {host}{dest}".format(
+                scp=self._scp_command(), src=self._get_packed_env(),
+                host=real_host, dest=dest
+            ))
+        state.record(host, 'conda_pack', env_hash)
+
+    def _prepare_env(self):
+        super(CondaClusterManager, self)._prepare_env()
+        if self.conda_pack:
+            self._pack_env()
+
+    def _sync_env(self, host, home):
+        super(CondaClusterManager, self)._sync_env(host, home)
+        if self.conda_pack:
+            self._sync_packed_env(host, home)
+
     def _get_bootstrap_code(self):
+        if self.conda_pack:
+            return self.UNPACK.format(project_name=self.project_name)
         return self.BOOTSTRAP.format(
             project_name=self.project_name, conda_root=self.CONDA_ROOT
         )
 
+    def _get_script_kind(self):
+        return 'conda_pack' if self.conda_pack else ''
+
     def _get_python(self, host, home):
+        if self.conda_pack:
+            # The packed environment is unpacked like a virtualenv.
+            return super(CondaClusterManager, self)._get_python(host, home)
         return os.path.join(
             home, self.CONDA_ROOT,
             'envs/{project_name}/bin/python'.format(
@@ -63,6 +237,8 @@ class CondaClusterManager(ClusterManager):
         )
 
     def _get_update_code(self):
+        if self.conda_pack:
+            return self.UNPACK.format(project_name=self.project_name)
         return self.UPDATE.format(
             project_name=self.project_name, conda_root=self.CONDA_ROOT
         )
@@ -61,6 +61,8 @@ class EDMClusterManager(ClusterManager):
     fi
     """)
 
+    ENV_FILES = (ENV_FILE, 'requirements.txt')
+
     def _get_bootstrap_code(self):
         return self.BOOTSTRAP.format(
             project_name=self.project_name, edm_root=self.EDM_ROOT,
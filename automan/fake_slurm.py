@@ -0,0 +1,119 @@
+"""Stand-in ``sbatch``, ``squeue`` and ``scancel`` commands that run the batch
+jobs on the local machine.
+
+This is used to test the `automan.slurm.SlurmWorker` without a real cluster.
+It is invoked as::
+
+    python -m automan.fake_slurm sbatch [--parsable] script.sh
+    python -m automan.fake_slurm squeue [-h] [-o '%i %T']
+    python -m automan.fake_slurm scancel job_id
+
+Only the options used by the `SlurmWorker` are supported and any other
+options are ignored. The state of the jobs is kept in the directory given by
+the ``AUTOMAN_FAKE_SLURM_DIR`` environment variable or a directory in the
+system's temporary directory.
+
+"""
+from __future__ import print_function
+
+import getpass
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+
+import psutil
+
+
+def _state_dir():
+    path = os.environ.get('AUTOMAN_FAKE_SLURM_DIR')
+    if path is None:
+        path = os.path.join(
+            tempfile.gettempdir(), 'automan_fake_slurm_' + getpass.getuser()
+        )
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def _new_job_file(state_dir):
+    job_id = len(os.listdir(state_dir)) + 1
+    while True:
+        fname = os.path.join(state_dir, '%d.json' % job_id)
+        try:
+            fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            job_id += 1
+        else:
+            os.close(fd)
+            return job_id, fname
+
+
+def _read_jobs(state_dir):
+    jobs = []
+    for fname in os.listdir(state_dir):
+        with open(os.path.join(state_dir, fname)) as fp:
+            try:
+                jobs.append(json.load(fp))
+            except ValueError:
+                # Still being written by sbatch.
+                pass
+    return sorted(jobs, key=lambda x: x['id'])
+
+
+def _is_running(pid):
+    try:
+        proc = psutil.Process(pid)
+        return proc.status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+def sbatch(args):
+    script = [x for x in args if not x.startswith('-')][-1]
+    state_dir = _state_dir()
+    job_id, fname = _new_job_file(state_dir)
+    with open(os.devnull, 'wb') as null:
+        proc = subprocess.Popen(
+            ['bash', script], stdout=null, stderr=null, stdin=null,
+            start_new_session=True
+        )
+    with open(fname, 'w') as fp:
+        json.dump(dict(id=job_id, pid=proc.pid, script=script), fp)
+    if '--parsable' in args:
+        print(job_id)
+    else:
+        print('Submitted batch job %d' % job_id)
+
+
+def squeue(args):
+    if '-h' not in args:
+        print('JOBID STATE')
+    for job in _read_jobs(_state_dir()):
+        if _is_running(job['pid']):
+            print('%d RUNNING' % job['id'])
+
+
+def scancel(args):
+    ids = set(args)
+    for job in _read_jobs(_state_dir()):
+        if str(job['id']) in ids and _is_running(job['pid']):
+            try:
+                os.killpg(job['pid'], signal.SIGTERM)
+            except OSError:
+                pass
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    commands = dict(sbatch=sbatch, squeue=squeue, scancel=scancel)
+    if not argv or argv[0] not in commands:
+        print(__doc__)
+        sys.exit(1)
+    commands[argv[0]](argv[1:])
+
+
+if __name__ == '__main__':
+    main()
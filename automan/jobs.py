@@ -1,19 +1,34 @@
 # Standard libraray imports
 from __future__ import print_function
 
-from collections import deque
+from collections import defaultdict, deque
+import glob
 import json
 import multiprocessing
 import os
 import shlex
 import shutil
+import statistics
 import subprocess
 import sys
+import threading
 import time
 
 # External module imports.
 import psutil
 
+from .journal import Journal
+from .metrics import Metrics
+from .ssh import ssh_command, ssh_options
+from .transfer import (
+    ChannelTransfer, RsyncTransfer, TransferGroup, TransferManager,
+    find_rsync, is_selected, list_files
+)
+
+
+class WorkerLostError(Exception):
+    pass
+
 
 def _make_command_list(command):
     if not isinstance(command, (list, tuple)):
@@ -47,7 +62,9 @@ def threads_required(n_thread, n_core):
 
 
 class Job(object):
-    def __init__(self, command, output_dir, n_core=1, n_thread=1, env=None):
+    def __init__(self, command, output_dir, n_core=1, n_thread=1, env=None,
+                 memory=None, timeout=None, retry=None, attempts=None,
+                 copy_include=None, copy_exclude=None, lazy=False):
         """Constructor
 
         Note that `n_core` is used to schedule a task on a machine which has
@@ -63,6 +80,30 @@ class Job(object):
         i.e. the product of the number of cores and the negative of the number
         given.
 
+        `memory` (in megabytes or as a string like '4G') and `timeout` (in
+        seconds) are resource requests that are only used by batch system
+        workers like the `automan.slurm.SlurmWorker`.
+
+        `retry` is an optional dictionary specifying how a failed job should
+        be resubmitted by the scheduler. It may have the keys `max_attempts`
+        (the total number of attempts, defaults to 3), `backoff` (the delay in
+        seconds before the first resubmission which is doubled for every
+        subsequent one, defaults to 5) and `exitcodes` (a list of exit codes
+        that may be retried, by default any failure is retried). The host and
+        exit code of each failed attempt is stored in `attempts` and saved in
+        the `job_info.json` file.
+
+        `copy_include` and `copy_exclude` are lists of shell-style patterns,
+        like ``['results.npz', '*.info']``, that select the files of the
+        output copied back from a remote worker, see
+        `automan.transfer.is_selected`. By default all files are copied. If
+        `lazy` is True, the files that are not copied, which is all but the
+        ``job_info.json``, ``stdout.txt``, ``stderr.txt`` and ``*.info``
+        files unless `copy_include` is given, are left on the worker. The
+        worker is recorded in the job journal and any of these files is
+        fetched when it is asked for with
+        `automan.automation.Simulation.input_path`, see `fetch_file`.
+
         """
         self.command = _make_command_list(command)
         self._given_env = env
@@ -74,6 +115,13 @@ class Job(object):
             self.env['OMP_NUM_THREADS'] = str(nt)
         self.n_core = n_core
         self.n_thread = n_thread
+        self.memory = memory
+        self.timeout = timeout
+        self.retry = retry
+        self.attempts = list(attempts) if attempts else []
+        self.copy_include = copy_include
+        self.copy_exclude = copy_exclude
+        self.lazy = lazy
         self.output_dir = output_dir
         self.output_already_exists = os.path.exists(self.output_dir)
         self.stderr = os.path.join(self.output_dir, 'stderr.txt')
@@ -104,8 +152,23 @@ class Job(object):
         for key in ('command', 'output_dir', 'n_core', 'n_thread'):
             state[key] = getattr(self, key)
         state['env'] = self._given_env
+        for key in ('memory', 'timeout'):
+            if getattr(self, key) is not None:
+                state[key] = getattr(self, key)
+        if self.attempts:
+            state['attempts'] = self.attempts
         return state
 
+    def copy_patterns(self):
+        """Return a tuple of the (include, exclude) patterns of the files of
+        the output that are copied back from a remote worker.
+        """
+        include = self.copy_include
+        if include is None and self.lazy:
+            # The info files are needed to tell if a PySPH run completed.
+            include = ['*.info']
+        return include, self.copy_exclude
+
     def pretty_command(self):
         return ' '.join(self.command)
 
@@ -120,7 +183,26 @@ class Job(object):
     def get_info(self):
         return self._read_info()
 
+    def retry_delay(self):
+        """Return the delay in seconds after which the job should be
+        resubmitted given the recorded `attempts` or None if it should not be
+        retried.
+        """
+        if not self.retry or not self.attempts:
+            return None
+        policy = self.retry
+        n_attempts = len(self.attempts)
+        if n_attempts >= policy.get('max_attempts', 3):
+            return None
+        exitcodes = policy.get('exitcodes')
+        if exitcodes is not None and \
+           self.attempts[-1].get('exitcode') not in exitcodes:
+            return None
+        return policy.get('backoff', 5.0)*2**(n_attempts - 1)
+
     def _write_info(self, info):
+        if self.attempts:
+            info = dict(info, attempts=self.attempts)
         with open(self._info_file, 'w') as fp:
             json.dump(info, fp)
 
@@ -187,6 +269,22 @@ class Job(object):
                 self.proc = None
         return info.get('status')
 
+    def kill(self):
+        """Kill the running job.
+        """
+        pid = self._read_info().get('pid')
+        if pid is not None:
+            try:
+                psutil.Process(pid).kill()
+            except psutil.NoSuchProcess:
+                pass
+        if self.proc is not None:
+            self.proc.join(timeout=2)
+            if self.proc.is_alive():
+                self.proc.terminate()
+                self.proc.join()
+            self.proc = None
+
     def clean(self, force=False):
         if self.output_already_exists and not force:
             if os.path.exists(self.stdout):
@@ -196,6 +294,17 @@ class Job(object):
             shutil.rmtree(self.output_dir)
 
 
+def _can_attach(job):
+    """Returns True if the job was started earlier and is either still
+    running or is done, so it need not be run again.
+    """
+    info = job.get_info()
+    if info.get('status') == 'running' and info.get('pid') is None:
+        # The job was never started or its process is unknown.
+        return False
+    return job.status() in ('running', 'done')
+
+
 ############################################
 # This class is meant to be used by execnet alone.
 class _RemoteManager(object):  # pragma: no cover
@@ -228,12 +337,21 @@ class _RemoteManager(object):  # pragma: no cover
         else:
             return 'invalid job id %d' % job_id
 
+    def status_many(self, job_ids):
+        return [self.status(x) for x in job_ids]
+
     def clean(self, job_id, force=False):
         if job_id in self.jobs:
             return self.jobs[job_id].clean(force)
         else:
             return 'invalid job id %d' % job_id
 
+    def kill(self, job_id):
+        if job_id in self.jobs:
+            return self.jobs[job_id].kill()
+        else:
+            return 'invalid job id %d' % job_id
+
     def get_stdout(self, job_id):
         return self.jobs[job_id].get_stdout()
 
@@ -243,19 +361,176 @@ class _RemoteManager(object):  # pragma: no cover
     def get_info(self, job_id):
         return self.jobs[job_id].get_info()
 
+    def attach(self, job_data, job_id=None):
+        job = Job(**job_data)
+        if not _can_attach(job):
+            return None
+        if job_id is None:
+            job_id = self.job_count
+            self.job_count += 1
+        self.jobs[job_id] = job
+        return job_id
+
+    def list_files(self, path):
+        return list_files(path)
+
+    def ping(self):
+        return True
+
+    def set_next_id(self, job_id):
+        self.job_count = max(self.job_count, job_id)
+
 
 def serve(channel):  # pragma: no cover
     """Serve the remote manager via execnet.
+
+    Each message is a tuple of (request_id, method, data) and the reply is a
+    tuple of (request_id, result). This lets the caller send several requests
+    before waiting for the replies. Messages of the form (method, data) are
+    also supported and are replied to with the bare result.
     """
     manager = _RemoteManager()
     while True:
-        msg, data = channel.receive()
-        if msg == 'free_cores':
-            channel.send(free_cores())
-        elif msg == 'total_cores':
-            channel.send(total_cores())
+        msg = channel.receive()
+        if len(msg) == 3:
+            req_id, method, data = msg
+        else:
+            req_id = None
+            method, data = msg
+        if method == 'free_cores':
+            result = free_cores()
+        elif method == 'total_cores':
+            result = total_cores()
+        else:
+            result = getattr(manager, method)(*data)
+        channel.send(result if req_id is None else (req_id, result))
+
+
+class _RemoteAgent(_RemoteManager):  # pragma: no cover
+    """Schedules the jobs pushed by the coordinator on the local cores.
+
+    Job ids are assigned by the coordinator. Completed jobs and requests for
+    more work are sent as events on a separate channel.
+    """
+    def __init__(self, events, queue_size=None, interval=1.0):
+        super(_RemoteAgent, self).__init__()
+        self.events = events
+        self.queue_size = queue_size if queue_size else int(total_cores())
+        self.interval = interval
+        self.queue = deque()
+        self.running = set()
+        self.finished = dict()
+        # Number of jobs asked for that have not yet been pushed.
+        self.requested = 0
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self._loop)
+        thread.daemon = True
+        thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                with self.lock:
+                    events = self._update()
+                for event in events:
+                    self.events.send(event)
+            except (IOError, EOFError):
+                # The coordinator has gone away.
+                break
+            time.sleep(self.interval)
+
+    def _update(self):
+        events = []
+        for job_id in list(self.running):
+            s = self.jobs[job_id].status()
+            if s != 'running':
+                self.running.discard(job_id)
+                self.finished[job_id] = s
+                events.append(('status', job_id, s))
+
+        total = total_cores()
+        used = sum(cores_required(self.jobs[i].n_core) for i in self.running)
+        while self.queue:
+            job_id, job_data = self.queue[0]
+            n_core = cores_required(job_data.get('n_core', 1))
+            if used > 0 and used + n_core > total:
+                break
+            self.queue.popleft()
+            self.run_with_id(job_id, job_data)
+            used += n_core
+
+        want = self.queue_size - len(self.queue) - self.requested
+        if want > 0:
+            self.requested += want
+            events.append(('want', want))
+        return events
+
+    def run_with_id(self, job_id, job_data):
+        job = Job(**job_data)
+        job.run()
+        self.jobs[job_id] = job
+        self.running.add(job_id)
+
+    def attach(self, job_data, job_id=None):
+        with self.lock:
+            job_id = super(_RemoteAgent, self).attach(job_data, job_id)
+            if job_id is not None:
+                self.running.add(job_id)
+            return job_id
+
+    def push(self, items):
+        with self.lock:
+            self.queue.extend(tuple(x) for x in items)
+            self.requested = max(self.requested - len(items), 0)
+
+    def _queued_ids(self):
+        return set(x[0] for x in self.queue)
+
+    def status(self, job_id):
+        with self.lock:
+            if job_id in self.finished:
+                return self.finished[job_id]
+            elif job_id in self.jobs:
+                return self.jobs[job_id].status()
+            elif job_id in self._queued_ids():
+                return 'running'
+            else:
+                return 'invalid job id %d' % job_id
+
+    def get_info(self, job_id):
+        with self.lock:
+            if job_id in self.jobs:
+                return self.jobs[job_id].get_info()
+            else:
+                return {'status': 'not started'}
+
+    def kill(self, job_id):
+        with self.lock:
+            if job_id in self._queued_ids():
+                self.queue = deque(x for x in self.queue if x[0] != job_id)
+                self.finished[job_id] = 'error'
+                self.events.send(('status', job_id, 'error'))
+            elif job_id in self.jobs:
+                self.jobs[job_id].kill()
+
+
+def serve_agent(channel):  # pragma: no cover
+    """Serve a remote agent via execnet.
+
+    The first message must be a tuple of (events_channel, queue_size,
+    interval) after which requests are handled as in `serve`.
+    """
+    events, queue_size, interval = channel.receive()
+    manager = _RemoteAgent(events, queue_size, interval)
+    while True:
+        req_id, method, data = channel.receive()
+        if method == 'free_cores':
+            result = free_cores()
+        elif method == 'total_cores':
+            result = total_cores()
         else:
-            channel.send(getattr(manager, msg)(*data))
+            result = getattr(manager, method)(*data)
+        channel.send((req_id, result))
 ############################################
 
 
@@ -266,8 +541,7 @@ class Worker(object):
         self._total_cores = None
 
     def _check_running_jobs(self):
-        for i in self.running_jobs.copy():
-            self.status(i)
+        self.status_many(list(self.running_jobs))
 
     def free_cores(self):
         return free_cores()
@@ -306,16 +580,30 @@ class Worker(object):
         """Runs the job and returns a JobProxy for the job."""
         raise NotImplementedError()
 
+    def reattach(self, job):
+        """Returns a JobProxy for a job that was started earlier, perhaps by
+        another process, and is still running or is done. Returns None if
+        this is not possible and the job should be run again.
+        """
+        return None
+
     def status(self, job_id):
         """Returns status of the job."""
         raise NotImplementedError()
 
+    def status_many(self, job_ids):
+        """Returns a list of the status of the given jobs."""
+        return [self.status(x) for x in job_ids]
+
     def copy_output(self, job_id, dest):
         raise NotImplementedError()
 
     def clean(self, job_id, force=False):
         raise NotImplementedError()
 
+    def kill(self, job_id):
+        raise NotImplementedError()
+
     def get_stdout(self, job_id):
         raise NotImplementedError()
 
@@ -331,6 +619,10 @@ class JobProxy(object):
         self.worker = worker
         self.job_id = job_id
         self.job = job
+        # Time at which the job was started on the worker.
+        self.start_time = time.time()
+        # A speculative duplicate of this job running elsewhere.
+        self.duplicate = None
 
     def free_cores(self):
         return self.worker.free_cores()
@@ -342,7 +634,42 @@ class JobProxy(object):
         print("JobProxy cannot be run")
 
     def status(self):
-        return self.worker.status(self.job_id)
+        status = self.worker.status(self.job_id)
+        dup = self.duplicate
+        if dup is None:
+            return status
+        elif status == 'done':
+            self.duplicate = None
+            dup.cancel()
+            return status
+        elif status == 'lost':
+            # The original worker is gone so continue with the duplicate.
+            self.worker, self.job_id = dup.worker, dup.job_id
+            self.start_time = dup.start_time
+            self.duplicate = None
+            return dup.status()
+
+        dup_status = dup.status()
+        if dup_status == 'done':
+            # The duplicate won, so this proxy now refers to it.
+            self.cancel()
+            self.worker, self.job_id = dup.worker, dup.job_id
+            self.start_time = dup.start_time
+            self.duplicate = None
+            return dup_status
+        elif dup_status in ('error', 'lost'):
+            self.duplicate = None
+            dup.cancel()
+            return status
+        else:
+            return 'running'
+
+    def cancel(self):
+        """Kill the job and remove its output.
+        """
+        self.worker.kill(self.job_id)
+        self.worker.status(self.job_id)
+        return self.worker.clean(self.job_id, force=True)
 
     def copy_output(self, dest):
         return self.worker.copy_output(self.job_id, dest)
@@ -378,6 +705,15 @@ class LocalWorker(Worker):
         self.job_count += 1
         return JobProxy(self, count, job)
 
+    def reattach(self, job):
+        if not _can_attach(job):
+            return None
+        count = self.job_count
+        self.jobs[count] = job
+        self.running_jobs.add(count)
+        self.job_count += 1
+        return JobProxy(self, count, job)
+
     def status(self, job_id):
         s = self.jobs[job_id].status()
         rj = self.running_jobs
@@ -392,6 +728,9 @@ class LocalWorker(Worker):
         if force:
             self.jobs[job_id].clean(force)
 
+    def kill(self, job_id):
+        self.jobs[job_id].kill()
+
     def get_stdout(self, job_id):
         return self.jobs[job_id].get_stdout()
 
@@ -403,36 +742,216 @@ class LocalWorker(Worker):
 
 
 class RemoteWorker(Worker):
+    """Worker that runs jobs on a remote host via an execnet gateway.
+
+    The connection is checked with a heartbeat when nothing has been received
+    for `heartbeat_interval` seconds and any request that is not answered
+    within `heartbeat_timeout` seconds marks the worker as dead. The jobs that
+    were running on a dead worker have the status ``'lost'`` and the worker
+    is reconnected in the background every `reconnect_interval` seconds.
+    """
+
+    # Code executed on the remote gateway to serve the requests.
+    SERVE_CODE = "from automan import jobs; jobs.serve(channel)"
+
     def __init__(self, host, python, chdir=None, testing=False,
-                 nfs=False):
+                 nfs=False, copy_method='auto'):
+        """Constructor.
+
+        **Parameters**
+
+        host: str
+            Host to connect to with ssh.
+        python: str
+            Python executable to use on the remote host.
+        chdir: str
+            Directory on the remote host to run the jobs in.
+        testing: bool
+            Run the worker on this machine, used for testing.
+        nfs: bool
+            The output is on a filesystem shared with this machine, so it
+            need not be copied back.
+        copy_method: str
+            How the output is copied back, one of 'rsync', 'channel' (over
+            the execnet gateway) or 'auto' to use rsync if it is available.
+        """
         super(RemoteWorker, self).__init__()
         self.host = host
         self.python = python
         self.chdir = chdir
         self.testing = testing
         self.nfs = nfs
+        self.copy_method = copy_method
+        # Replies received for requests that were not yet asked for.
+        self._replies = dict()
+        self._request_count = 0
+        # Requests whose replies are not needed.
+        self._ignored_requests = set()
+        # Statuses fetched by status_many, keyed on the job id with values
+        # of (time, status). Each is used at most once by status.
+        self._status_cache = dict()
+        self.status_cache_time = 5.0
+        self.alive = True
+        self.heartbeat_interval = 15.0
+        self.heartbeat_timeout = 60.0
+        self.reconnect_interval = 30.0
+        self._last_contact = time.time()
+        # Jobs that were running when the connection was lost.
+        self._lost_jobs = set()
+        # Final status of the finished jobs.
+        self._finished = dict()
+        # Jobs with smaller ids were started on an earlier connection.
+        self._first_job_id = 0
         if testing:
             spec = 'popen//python={python}'.format(python=python)
         else:
-            spec = 'ssh={host}//python={python}'.format(
-                host=host, python=python
+            # The gateway shares the ssh connection to the host.
+            spec = 'ssh={ssh}//python={python}'.format(
+                ssh=' '.join(ssh_options() + [host]), python=python
             )
         if chdir is not None:
             spec += '//chdir={chdir}'.format(chdir=chdir)
+        self._spec = spec
+        self._connect()
 
+    def _connect(self):
         import execnet
-        self.gw = execnet.makegateway(spec)
-        self.channel = self.gw.remote_exec(
-            "from automan import jobs; jobs.serve(channel)"
-        )
+        self.gw = execnet.makegateway(self._spec)
+        self.channel = self.gw.remote_exec(self.SERVE_CODE)
 
     def get_config(self):
-        return dict(host=self.host, python=self.python, chdir=self.chdir)
+        config = dict(host=self.host, python=self.python, chdir=self.chdir)
+        if self.testing:
+            config['testing'] = True
+        if self.copy_method != 'auto':
+            config['copy_method'] = self.copy_method
+        return config
+
+    def _send_request(self, method, *data):
+        req_id = self._request_count
+        self._request_count += 1
+        self.channel.send((req_id, method, data))
+        return req_id
+
+    def _get_reply(self, req_id):
+        import execnet
+        replies = self._replies
+        ignored = self._ignored_requests
+        while req_id not in replies:
+            try:
+                rid, result = self.channel.receive(self.heartbeat_timeout)
+            except (execnet.TimeoutError, execnet.RemoteError, EOFError,
+                    IOError) as e:
+                self._mark_lost(e)
+                raise WorkerLostError(
+                    'Lost connection to %s: %s' % (self.host, e)
+                )
+            self._last_contact = time.time()
+            if rid in ignored:
+                ignored.discard(rid)
+            else:
+                replies[rid] = result
+        return replies.pop(req_id)
+
+    def _notify_remote(self, method, *data):
+        """Send a request without waiting for its reply, raising
+        `WorkerLostError` like `_send_checked`.
+        """
+        self._ignored_requests.add(self._send_checked(method, *data))
+
+    def _send_checked(self, method, *data):
+        """Send a request and return its id, raising `WorkerLostError` if
+        the worker is not connected or the connection is lost.
+        """
+        if not self.alive:
+            raise WorkerLostError('Worker on %s is not connected.' % self.host)
+        try:
+            return self._send_request(method, *data)
+        except (EOFError, IOError) as e:
+            self._mark_lost(e)
+            raise WorkerLostError(
+                'Lost connection to %s: %s' % (self.host, e)
+            )
 
     def _call_remote(self, method, *data):
-        ch = self.channel
-        ch.send((method, data))
-        return ch.receive()
+        return self._get_reply(self._send_checked(method, *data))
+
+    def _call_remote_many(self, calls):
+        """Send all the given (method, data) calls at once and then wait for
+        the replies, this needs a single round trip.
+        """
+        req_ids = [self._send_checked(method, *data)
+                   for method, data in calls]
+        return [self._get_reply(x) for x in req_ids]
+
+    def _update_running(self, job_id, status):
+        if status != 'running':
+            self.running_jobs.discard(job_id)
+            self._finished[job_id] = status
+
+    def _local_status(self, job_id):
+        """Return the status of a job that cannot be asked for on the current
+        connection and None otherwise.
+        """
+        if job_id in self._lost_jobs:
+            return 'lost'
+        elif not self.alive or job_id < self._first_job_id:
+            return self._finished.get(job_id, 'lost')
+        else:
+            return None
+
+    def _mark_lost(self, reason):
+        if not self.alive:
+            return
+        print("\nLost connection to %s (%s), reconnecting in the background."
+              % (self.host, reason))
+        self.alive = False
+        self._lost_jobs.update(self.running_jobs)
+        self.running_jobs.clear()
+        self._status_cache.clear()
+        thread = threading.Thread(target=self._reconnect, args=(self.gw,))
+        thread.daemon = True
+        thread.start()
+
+    def _reconnect(self, old_gateway):
+        try:
+            old_gateway.exit()
+        except Exception:
+            pass
+        while not self.alive:
+            time.sleep(self.reconnect_interval)
+            try:
+                self._connect()
+                self._replies.clear()
+                self._ignored_requests.clear()
+                next_id = max(self.jobs) + 1 if self.jobs else 0
+                self._get_reply(self._send_request('set_next_id', next_id))
+            except Exception:
+                continue
+            self._first_job_id = next_id
+            self._last_contact = time.time()
+            self.alive = True
+            print("\nReconnected to %s." % self.host)
+
+    def heartbeat(self):
+        """Check the connection if nothing was received from the remote host
+        for `heartbeat_interval` seconds. Returns True if the worker is alive.
+        """
+        if self.alive and \
+           time.time() - self._last_contact > self.heartbeat_interval:
+            try:
+                self._call_remote('ping')
+            except WorkerLostError:
+                pass
+        return self.alive
+
+    def can_run(self, req_core):
+        if not self.alive:
+            return False
+        try:
+            return super(RemoteWorker, self).can_run(req_core)
+        except WorkerLostError:
+            return False
 
     def free_cores(self):
         return self._call_remote('free_cores', None)
@@ -449,41 +968,180 @@ class RemoteWorker(Worker):
         self.running_jobs.add(job_id)
         return JobProxy(self, job_id, job)
 
+    def reattach(self, job):
+        try:
+            job_id = self._call_remote('attach', job.to_dict())
+        except WorkerLostError:
+            return None
+        if job_id is None:
+            return None
+        self.jobs[job_id] = job
+        self.running_jobs.add(job_id)
+        return JobProxy(self, job_id, job)
+
     def status(self, job_id):
-        s = self._call_remote('status', job_id)
-        rj = self.running_jobs
-        if s != 'running':
-            rj.discard(job_id)
+        # The final status of a job does not change.
+        s = self._finished.get(job_id) or self._local_status(job_id)
+        if s is not None:
+            return s
+        cached = self._status_cache.pop(job_id, None)
+        if cached is not None and \
+           time.time() - cached[0] < self.status_cache_time:
+            s = cached[1]
+        else:
+            try:
+                s = self._call_remote('status', job_id)
+            except WorkerLostError:
+                return self._local_status(job_id)
+        self._update_running(job_id, s)
         return s
 
-    def copy_output(self, job_id, dest):
-        job = self.jobs[job_id]
-        if self.testing:
-            src = os.path.join(self.chdir, job.output_dir)
-            real_dest = os.path.join(dest, job.output_dir)
-            args = [
-                sys.executable, '-c',
-                'import sys,shutil; shutil.copytree(sys.argv[1], sys.argv[2])',
-                src, real_dest
-            ]
-        elif not self.nfs:
-            src = '{host}:{path}'.format(
-                host=self.host, path=os.path.join(self.chdir, job.output_dir)
+    def status_many(self, job_ids):
+        """Get the status of all the given jobs with a single call.
+
+        The results are also cached so that a subsequent call to `status` for
+        any of these jobs does not need another round trip.
+        """
+        statuses = dict(
+            (x, self._finished[x]) for x in job_ids if x in self._finished
+        )
+        remote_ids = [x for x in job_ids if x not in statuses and
+                      self._local_status(x) is None]
+        if remote_ids:
+            try:
+                result = self._call_remote('status_many', remote_ids)
+            except WorkerLostError:
+                result = []
+            now = time.time()
+            for job_id, s in zip(remote_ids, result):
+                statuses[job_id] = s
+                self._status_cache[job_id] = (now, s)
+                self._update_running(job_id, s)
+        return [statuses.get(x) or self._local_status(x) for x in job_ids]
+
+    def _verify_copy(self, paths, dest, include=None, exclude=None):
+        """Returns True if every selected file in the given output directories
+        on the remote host has been copied into `dest` with the same size.
+        """
+        try:
+            listings = self._call_remote_many(
+                [('list_files', (x,)) for x in paths]
             )
-            real_dest = os.path.join(dest, os.path.dirname(job.output_dir))
-            args = ['scp', '-qr', src, real_dest]
+        except WorkerLostError:
+            return False
+        for path, remote in zip(paths, listings):
+            local = list_files(os.path.join(dest, path))
+            for rel, info in remote.items():
+                if not is_selected(rel, include, exclude):
+                    continue
+                if rel not in local or local[rel][0] != info[0]:
+                    return False
+        return True
+
+    def _use_rsync(self):
+        if self.testing or self.copy_method == 'channel':
+            return False
+        return self.copy_method == 'rsync' or find_rsync() is not None
+
+    def _rsync_outputs(self, paths, dest, include=None, exclude=None,
+                       bwlimit=None):
+        # rsync copies the listed paths relative to the source directory,
+        # absolute paths are copied relative to the root.
+        groups = defaultdict(list)
+        for path in paths:
+            if os.path.isabs(path):
+                groups[os.sep].append(path)
+            else:
+                groups[self.chdir or '.'].append(path)
+        selective = include is not None or bool(exclude)
+        if selective:
+            # rsync is given the selected files so that they are chosen
+            # exactly as by a `ChannelTransfer`.
+            listings = dict(zip(paths, self._call_remote_many(
+                [('list_files', (x,)) for x in paths]
+            )))
+        transfers = []
+        for base, group in groups.items():
+            if selective:
+                files = [
+                    os.path.join(x, rel).lstrip(os.sep)
+                    for x in group for rel in sorted(listings[x])
+                    if is_selected(rel, include, exclude)
+                ]
+            else:
+                files = [x.lstrip(os.sep) for x in group]
+            transfers.append(RsyncTransfer(
+                '{host}:{base}/'.format(host=self.host, base=base.rstrip('/')),
+                os.sep if base == os.sep else dest, files=files,
+                bwlimit=bwlimit, options=['-e', ssh_command()],
+                verify=lambda group=group: self._verify_copy(
+                    group, dest, include, exclude
+                )
+            ))
+        return transfers
+
+    def _copy_paths(self, paths, dest, include=None, exclude=None,
+                    bwlimit=None):
+        """Start copying the selected files of the given output directories
+        on the remote host into `dest` and return a list of the transfers.
+        """
+        if self._use_rsync():
+            return self._rsync_outputs(paths, dest, include, exclude, bwlimit)
         else:
-            args = []
+            return [ChannelTransfer(
+                self.gw, paths, [os.path.join(dest, x) for x in paths],
+                include=include, exclude=exclude, bwlimit=bwlimit
+            )]
+
+    def copy_outputs(self, job_ids, dest, bwlimit=None):
+        """Start copying the output of all the given jobs into `dest` with a
+        single transfer and return the `automan.transfer.Transfer`, or None if
+        nothing needs to be copied.
+
+        Only the files selected by `Job.copy_patterns` are copied, using at
+        most `bwlimit` KiB per second if it is given.
+        """
+        if self.nfs and not self.testing:
+            return None
+        groups = defaultdict(list)
+        for job_id in job_ids:
+            job = self.jobs[job_id]
+            include, exclude = job.copy_patterns()
+            key = (None if include is None else tuple(include),
+                   tuple(exclude or ()))
+            groups[key].append(os.path.normpath(job.output_dir))
+        transfers = []
+        for (include, exclude), paths in groups.items():
+            transfers.extend(
+                self._copy_paths(paths, dest, include, exclude, bwlimit)
+            )
+        return transfers[0] if len(transfers) == 1 else \
+            TransferGroup(transfers)
 
-        if args:
-            print("\n" + " ".join(args))
-            proc = subprocess.Popen(args)
-            return proc
-        else:
-            return
+    def fetch(self, output_dir, path, dest):
+        """Start copying the file or directory `path`, relative to the output
+        directory of a job on the remote host, into `dest` and return the
+        `automan.transfer.Transfer`.
+        """
+        pattern = glob.escape(path)
+        return self._copy_paths(
+            [os.path.normpath(output_dir)], dest,
+            include=[pattern, pattern + os.sep + '*']
+        )[0]
+
+    def copy_output(self, job_id, dest):
+        """Start copying the output of the job into `dest` and return the
+        `automan.transfer.Transfer`, or None if nothing needs to be copied.
+        """
+        return self.copy_outputs([job_id], dest)
 
     def clean(self, job_id, force=False):
-        return self._call_remote('clean', job_id, force)
+        if self._local_status(job_id) is None:
+            return self._call_remote('clean', job_id, force)
+
+    def kill(self, job_id):
+        if self._local_status(job_id) is None:
+            return self._call_remote('kill', job_id)
 
     def get_stdout(self, job_id):
         return self._call_remote('get_stdout', job_id)
@@ -495,63 +1153,545 @@ class RemoteWorker(Worker):
         return self._call_remote('get_info', job_id)
 
 
+class AgentWorker(RemoteWorker):
+    """A remote worker that runs a long-lived agent on the remote host.
+
+    Jobs are pushed to the agent without waiting for a reply and the agent
+    schedules them against its own cores. The agent sends the status of each
+    completed job and requests for more work as events, so checking the
+    status of a job and deciding if the worker can run a job need no round
+    trips. The worker accepts as many jobs as the agent has asked for, which
+    is `queue_size` jobs beyond those that are running (defaults to the
+    number of cores on the remote host).
+
+    To use this with the `automan.jobs.Scheduler`, add ``agent=True`` to the
+    configuration of a remote worker.
+    """
+
+    SERVE_CODE = "from automan import jobs; jobs.serve_agent(channel)"
+
+    def __init__(self, host, python, chdir=None, testing=False, nfs=False,
+                 copy_method='auto', queue_size=None, interval=1.0):
+        self.queue_size = queue_size
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._credit = 0
+        self._has_credit = threading.Event()
+        self._statuses = dict()
+        self.job_count = 0
+        super(AgentWorker, self).__init__(
+            host, python, chdir=chdir, testing=testing, nfs=nfs,
+            copy_method=copy_method
+        )
+
+    def _connect(self):
+        self._credit = 0
+        self._has_credit.clear()
+        super(AgentWorker, self)._connect()
+        self.events = self.gw.newchannel()
+        self.events.setcallback(self._on_event)
+        self.channel.send((self.events, self.queue_size, self.interval))
+        # Wait for the agent to ask for its first jobs.
+        self._has_credit.wait(timeout=30)
+
+    def _on_event(self, event):
+        with self._lock:
+            if event[0] == 'status':
+                self._statuses[event[1]] = event[2]
+            elif event[0] == 'want':
+                self._credit += event[1]
+                self._has_credit.set()
+
+    def get_config(self):
+        config = super(AgentWorker, self).get_config()
+        config.update(agent=True, queue_size=self.queue_size)
+        return config
+
+    def can_run(self, req_core):
+        """Returns True if the agent has asked for more jobs.
+        """
+        return self.alive and self._credit > 0
+
+    def run(self, job):
+        print("Running %s" % job.pretty_command())
+        with self._lock:
+            job_id = self.job_count
+            self.job_count += 1
+            self._credit -= 1
+            self._statuses[job_id] = 'running'
+        self.jobs[job_id] = job
+        self.running_jobs.add(job_id)
+        try:
+            self._notify_remote('push', [(job_id, job.to_dict())])
+        except WorkerLostError:
+            # The scheduler resubmits the lost job.
+            self.running_jobs.discard(job_id)
+            self._lost_jobs.add(job_id)
+        return JobProxy(self, job_id, job)
+
+    def reattach(self, job):
+        with self._lock:
+            job_id = self.job_count
+            self.job_count += 1
+            self._statuses[job_id] = 'running'
+        try:
+            result = self._call_remote('attach', job.to_dict(), job_id)
+        except WorkerLostError:
+            result = None
+        if result is None:
+            return None
+        self.jobs[job_id] = job
+        self.running_jobs.add(job_id)
+        return JobProxy(self, job_id, job)
+
+    def status(self, job_id):
+        if job_id in self._lost_jobs:
+            return 'lost'
+        with self._lock:
+            s = self._statuses[job_id]
+        self._update_running(job_id, s)
+        return s
+
+    def status_many(self, job_ids):
+        return [self.status(x) for x in job_ids]
+
+
+def _copies_output(worker):
+    """Return True if the output of the jobs on the worker is copied back.
+    """
+    return isinstance(worker, RemoteWorker) and \
+        (worker.testing or not worker.nfs)
+
+
+# Workers used by `fetch_file` keyed on the host.
+_fetch_workers = dict()
+
+# The journal used by `fetch_file` by default, see `set_fetch_journal`, and
+# the mtime of its file if it was loaded from one.
+_fetch_journal = None
+_fetch_journal_mtime = None
+
+# The paths `fetch_file` could not fetch, mapped to the version of the
+# journal at the time, they are tried again only if the journal changed.
+_fetch_misses = dict()
+
+
+def set_fetch_journal(journal):
+    """Set the journal used by `fetch_file` by default.
+
+    **Parameters**
+
+    journal: str or automan.journal.Journal
+        The journal or the path to its file. The
+        `automan.automation.Automator` sets this to the journal of its
+        scheduler.
+    """
+    global _fetch_journal, _fetch_journal_mtime
+    _fetch_journal_mtime = None
+    if not isinstance(journal, Journal):
+        journal = Journal(os.path.abspath(journal))
+        _fetch_journal_mtime = _mtime(journal.fname)
+    _fetch_journal = journal
+    _fetch_misses.clear()
+
+
+def _mtime(fname):
+    return os.stat(fname).st_mtime if os.path.exists(fname) else 0.0
+
+
+def _get_fetch_journal():
+    if _fetch_journal is None:
+        set_fetch_journal(os.path.join('.automan', 'journal.json'))
+    elif _fetch_journal_mtime is not None and \
+            _mtime(_fetch_journal.fname) != _fetch_journal_mtime:
+        # Written by another process, perhaps a run of the automation.
+        set_fetch_journal(_fetch_journal.fname)
+    return _fetch_journal
+
+
+def fetch_file(path, journal=None):
+    """Fetch the given file or directory from the worker that ran the job
+    whose output contains it, if the job was run in lazy mode and the file
+    was left on the worker. Returns True if the path was fetched.
+
+    **Parameters**
+
+    path: str
+        Path of the file to fetch, in the output directory of a job.
+    journal: str
+        Path to the job journal, defaults to the one set with
+        `set_fetch_journal` or else ``.automan/journal.json``, which is
+        loaded once.
+    """
+    if journal is not None:
+        return os.path.exists(journal) and _fetch(path, Journal(journal))
+    journal = _get_fetch_journal()
+    key = os.path.abspath(path)
+    if _fetch_misses.get(key) == journal.version:
+        return False
+    fetched = _fetch(path, journal)
+    if not fetched:
+        _fetch_misses[key] = journal.version
+    return fetched
+
+
+def _fetch(path, journal):
+    entry = journal.find(path)
+    if entry is None or entry.get('state') != 'lazy':
+        return False
+    config = entry['worker']
+    worker = _fetch_workers.get(config['host'])
+    if worker is None or not worker.alive:
+        kw = dict((k, config[k]) for k in
+                  ('host', 'python', 'chdir', 'testing', 'copy_method')
+                  if k in config)
+        try:
+            worker = RemoteWorker(**kw)
+        except Exception as e:
+            print("Unable to connect to %s to fetch %s: %s" % (
+                config['host'], path, e
+            ))
+            return False
+        _fetch_workers[config['host']] = worker
+    output_dir = entry['output_dir']
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(output_dir))
+    # The output is copied back relative to the current directory.
+    transfer = worker.fetch(output_dir, rel, '.')
+    return transfer.wait() == 0 and os.path.exists(path)
+
+
+def _shares_filesystem(worker):
+    return isinstance(worker, LocalWorker) or getattr(worker, 'nfs', False)
+
+
 class Scheduler(object):
-    def __init__(self, root='.', worker_config=(), wait=5):
+    def __init__(self, root='.', worker_config=(), wait=5,
+                 metrics_dir=None, metrics_interval=30.0, speculative=None,
+                 speculative_min_samples=2, copy_batch_window=2.0,
+                 copy_max_active=4, copy_max_per_host=2, copy_bwlimit=None,
+                 journal=None, journal_interval=5.0):
+        """Constructor.
+
+        **Parameters**
+
+        root: str
+            Root directory of the automation.
+        worker_config: sequence
+            Sequence of dictionaries with the configuration of each worker.
+        wait: float
+            Time to wait before checking for free workers again.
+        metrics_dir: str
+            Directory where the metrics are written, see `automan.metrics`.
+            If None, the metrics are only kept in memory.
+        metrics_interval: float
+            Minimum interval in seconds between writes of the metrics.
+        speculative: float
+            If set, a job running for longer than this multiple of the median
+            runtime of comparable jobs (those with the same parent output
+            directory and `n_core`) is duplicated on an idle worker. The first
+            of the two to finish is kept and the other is cancelled.
+        speculative_min_samples: int
+            Number of comparable jobs that must have finished before a job
+            is considered to be a straggler.
+        copy_batch_window: float
+            The outputs of jobs on a remote worker that finish within this
+            many seconds of each other are copied back in one transfer.
+        copy_max_active: int
+            Maximum number of outputs being copied back at the same time.
+        copy_max_per_host: int
+            Maximum number of outputs being copied back at the same time from
+            any one host.
+        copy_bwlimit: int
+            Limit in KiB per second on the total bandwidth used to copy back
+            the outputs.
+        journal: str
+            Path to the JSON file of the job journal, see
+            `automan.journal`. If None, the journal is only kept in memory
+            and the scheduler cannot reattach to jobs after a restart.
+        journal_interval: float
+            Minimum interval in seconds between saves of the journal.
+        """
         self.workers = deque()
         self.worker_config = list(worker_config)
         self.root = os.path.abspath(os.path.expanduser(root))
         self.wait = wait
         self._completed_jobs = []
         self.jobs = []
+        self.metrics = Metrics(
+            output_dir=metrics_dir, interval=metrics_interval
+        )
+        self.speculative = speculative
+        self.speculative_min_samples = speculative_min_samples
+        # Runtimes of the successfully completed jobs, keyed on the
+        # `_runtime_key` of the job.
+        self._runtimes = defaultdict(list)
+        # Indices of the worker configurations that have been started or
+        # that failed to start.
+        self._attempted = set()
+        # List of (config, error message) for the workers that failed to
+        # start, these are not used.
+        self.failed_workers = []
+        self.journal_fname = journal
+        self.journal_interval = journal_interval
+        self._journal = None
+        self.transfers = TransferManager(
+            batch_window=copy_batch_window, max_active=copy_max_active,
+            max_per_host=copy_max_per_host, bwlimit=copy_bwlimit
+        )
 
-    def _create_worker(self):
-        conf = self.worker_config[len(self.workers)]
+    @property
+    def journal(self):
+        """The `automan.journal.Journal` of the submitted jobs.
+        """
+        return self._get_journal()
+
+    def _get_journal(self):
+        if self._journal is None:
+            self._journal = Journal(
+                self.journal_fname, interval=self.journal_interval
+            )
+        return self._journal
+
+    def _worker_for_host(self, host):
+        for worker in self.workers:
+            if worker.host == host:
+                return worker
+        for index in self._pending_configs():
+            if self.worker_config[index].get('host') == host:
+                try:
+                    worker = self._make_worker(self.worker_config[index])
+                except Exception as e:
+                    self._add_worker(index, error=e)
+                    return None
+                self._add_worker(index, worker)
+                return worker
+        return None
+
+    def _reattach(self, job):
+        """Reattach to the given job if the journal says it was started
+        earlier and it is still running or its output was not collected.
+        Returns the `JobProxy` or None if the job must be run.
+        """
+        journal = self._get_journal()
+        entry = journal.get(job.output_dir)
+        if entry is None:
+            return None
+        proxy = None
+        # The output of a lazy job was collected, so it is submitted again
+        # only when it is to be re-run.
+        if entry.get('state') != 'lazy' and \
+           entry.get('command') == list(job.command):
+            worker = self._worker_for_host(entry.get('host'))
+            if worker is not None:
+                proxy = worker.reattach(job)
+        if proxy is None:
+            journal.remove(job.output_dir)
+            return None
+        print("Reattached to job on %s: %s" % (
+            proxy.worker.host, job.pretty_command()
+        ))
+        self.jobs.append(proxy)
+        journal.record(job.output_dir, job_id=proxy.job_id)
+        self.metrics.inc('jobs_reattached_total', host=proxy.worker.host)
+        return proxy
+
+    def _pending_configs(self):
+        return [
+            i for i in range(len(self.worker_config))
+            if i not in self._attempted
+        ]
+
+    def _make_worker(self, conf):
         host = conf.get('host')
         print("Starting worker on %s." % host)
         if host == 'localhost':
             w = LocalWorker()
+        elif conf.get('type') == 'slurm':
+            from .slurm import SlurmWorker
+            kw = dict(conf)
+            kw.pop('type')
+            w = SlurmWorker(**kw)
+        elif conf.get('agent'):
+            kw = dict(conf)
+            kw.pop('agent')
+            w = AgentWorker(**kw)
         else:
             w = RemoteWorker(**conf)
-        self.workers.append(w)
         return w
 
+    def _add_worker(self, index, worker=None, error=None):
+        conf = self.worker_config[index]
+        self._attempted.add(index)
+        if error is None:
+            self.workers.append(worker)
+        else:
+            msg = '%s: %s' % (error.__class__.__name__, error)
+            print("\nUnable to start worker on %s (%s), it will not be used."
+                  % (conf.get('host'), msg))
+            self.failed_workers.append((conf, msg))
+            self.metrics.inc('workers_failed_total', host=conf.get('host'))
+
+    def _create_worker(self):
+        """Start the next configured worker and return it. Workers that fail
+        to start are skipped and None is returned if none could be started.
+        """
+        for index in self._pending_configs():
+            try:
+                worker = self._make_worker(self.worker_config[index])
+            except Exception as e:
+                self._add_worker(index, error=e)
+            else:
+                self._add_worker(index, worker)
+                return worker
+        return None
+
     def _get_active_workers(self):
+        self._update_jobs()
+        return set(job.worker.host for job in self.jobs)
+
+    def _update_jobs(self):
+        # Fetch the status of all the jobs on each worker in one call.
+        by_worker = defaultdict(list)
+        for job in self.jobs:
+            by_worker[job.worker].append(job)
+        statuses = dict()
+        for worker, proxies in by_worker.items():
+            result = worker.status_many([x.job_id for x in proxies])
+            statuses.update(zip(proxies, result))
+
         completed = []
-        workers = set()
         for job in self.jobs:
-            if job.status() in ['error', 'done']:
-                completed.append(job)
+            if job.duplicate is None:
+                status = statuses[job]
             else:
-                workers.add(job.worker.host)
+                status = job.status()
+            if status in ['error', 'done', 'lost']:
+                completed.append((job, status))
 
-        for job in completed:
+        now = time.time()
+        journal = self._get_journal()
+        for job, status in completed:
             self.jobs.remove(job)
             self._completed_jobs.append(job)
+            host = job.worker.host
+            if status != 'lost':
+                journal.record(
+                    job.job.output_dir, host=host, job_id=job.job_id,
+                    state='finished'
+                )
+            runtime = now - job.start_time
+            if status == 'done':
+                self._runtimes[self._runtime_key(job.job)].append(runtime)
+            if status != 'lost':
+                self.metrics.observe(
+                    'job_runtime_seconds', runtime, host=host
+                )
+            self.metrics.inc('jobs_finished_total', host=host, status=status)
+
+    def _runtime_key(self, job):
+        parent = os.path.dirname(os.path.normpath(job.output_dir))
+        return parent, job.n_core
+
+    def _find_idle_worker(self, proxy):
+        """Find an idle worker that can run a duplicate of the given job.
+        """
+        workers = list(self.workers)
+        if self._pending_configs():
+            workers.append(None)
+        for w in workers:
+            if w is None:
+                w = self._create_worker()
+                if w is None:
+                    break
+            if w.host == proxy.worker.host or w.running_jobs or \
+               (_shares_filesystem(w) and _shares_filesystem(proxy.worker)):
+                continue
+            if w.can_run(proxy.job.n_core):
+                return w
+        return None
+
+    def _check_stragglers(self):
+        now = time.time()
+        for proxy in self.jobs:
+            if proxy.duplicate is not None:
+                continue
+            runtimes = self._runtimes[self._runtime_key(proxy.job)]
+            if len(runtimes) < self.speculative_min_samples:
+                continue
+            limit = self.speculative*statistics.median(runtimes)
+            if now - proxy.start_time < limit:
+                continue
+            worker = self._find_idle_worker(proxy)
+            if worker is not None:
+                print("\nJob %s is slow on %s, duplicating it on %s" % (
+                    proxy.job.pretty_command(), proxy.worker.host,
+                    worker.host
+                ))
+                proxy.duplicate = worker.run(proxy.job)
+                self.metrics.inc(
+                    'jobs_speculated_total', host=worker.host
+                )
+
+    def _check_heartbeats(self):
+        for worker in self.workers:
+            heartbeat = getattr(worker, 'heartbeat', None)
+            if heartbeat is not None and worker.alive and not heartbeat():
+                self.metrics.inc('workers_lost_total', host=worker.host)
+
+    def _update_worker_metrics(self):
+        metrics = self.metrics
+        for worker in self.workers:
+            alive = getattr(worker, 'alive', True)
+            metrics.set('worker_up', int(alive), host=worker.host)
+            if not alive:
+                continue
+            try:
+                reserved = sum(
+                    worker.cores_required(worker.jobs[i].n_core)
+                    for i in worker.running_jobs
+                )
+                total = worker.total_cores()
+            except WorkerLostError:
+                continue
+            metrics.set('worker_cores_reserved', reserved, host=worker.host)
+            metrics.set('worker_cores_total', total, host=worker.host)
+            metrics.set(
+                'worker_running_jobs', len(worker.running_jobs),
+                host=worker.host
+            )
 
-        return workers
+    def _record_submission(self, proxy, wait_time):
+        metrics = self.metrics
+        metrics.mark_submission()
+        metrics.inc('jobs_submitted_total', host=proxy.worker.host)
+        metrics.observe(
+            'queue_wait_seconds', wait_time, host=proxy.worker.host
+        )
 
     def _rotate_existing_workers(self):
+        if not self.workers:
+            hosts = ', '.join(x[0].get('host') for x in self.failed_workers)
+            raise RuntimeError(
+                'None of the workers could be started (%s).' % hosts
+            )
         worker = self.workers[0]
         self.workers.rotate(-1)
         return worker
 
-    def _get_worker(self, n_core):
-        n_configs = len(self.worker_config)
-        n_running = len(self.workers)
-        if n_running == n_configs:
-            worker = self._rotate_existing_workers()
-        else:
+    def _get_worker(self, n_core, avoid=()):
+        worker = None
+        if self._pending_configs():
             active_workers = self._get_active_workers()
-            if n_running > len(active_workers):
+            if len(self.workers) > len(active_workers):
                 for w in self.workers:
                     if (w.host not in active_workers) and \
-                       w.can_run(n_core):
+                       (w.host not in avoid) and w.can_run(n_core):
                         worker = w
                         break
-                else:
-                    worker = self._create_worker()
-            else:
+            if worker is None:
                 worker = self._create_worker()
+        if worker is None:
+            worker = self._rotate_existing_workers()
         return worker
 
     def save(self, fname):
@@ -569,12 +1709,139 @@ class Scheduler(object):
     def add_worker(self, conf):
         self.worker_config.append(conf)
 
-    def submit(self, job):
-        proxy = None
+    def start_workers(self, max_parallel=8):
+        """Start all the configured workers that are not yet running.
+
+        Connecting to a remote worker can take a while, so up to
+        `max_parallel` workers are started concurrently. Workers that fail to
+        start are reported, added to `failed_workers` and are not used.
+        """
+        pending = self._pending_configs()
+        if not pending:
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        n_threads = max(1, min(max_parallel, len(pending)))
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            futures = [
+                (i, pool.submit(self._make_worker, self.worker_config[i]))
+                for i in pending
+            ]
+            for index, future in futures:
+                try:
+                    worker = future.result()
+                except Exception as e:
+                    self._add_worker(index, error=e)
+                else:
+                    self._add_worker(index, worker)
+        if self.failed_workers:
+            print("\n%d of %d workers could not be started:" % (
+                len(self.failed_workers), len(self.worker_config)
+            ))
+            for conf, msg in self.failed_workers:
+                print("  %s: %s" % (conf.get('host'), msg))
+
+    def poll(self):
+        """Update the state of the running jobs and the metrics.
+
+        This is called periodically by the `automan.automation.TaskRunner`.
+        Remote workers that have not responded recently are checked with a
+        heartbeat and the jobs on any that have died get the status
+        ``'lost'``.
+        """
+        self._check_heartbeats()
+        self._update_jobs()
+        if self.speculative:
+            self._check_stragglers()
+        self._update_worker_metrics()
+        self._get_journal().maybe_save()
+        self.metrics.maybe_write()
+
+    def flush(self):
+        """Save the journal and write the metrics now.
+        """
+        self._get_journal().flush()
+        self.metrics.write()
+
+    def copy_output(self, proxy, dest, priority=0):
+        """Start copying the output of the job managed by the proxy into
+        `dest` and return the transfer or None if nothing is to be copied.
+
+        Outputs from remote workers are batched by the `transfers` manager
+        and those with a higher `priority` are copied first.
+        """
+        worker = proxy.worker
+        if _copies_output(worker):
+            return self.transfers.request(
+                worker, proxy.job_id, dest, priority=priority
+            )
+        return proxy.copy_output(dest)
+
+    def record_copy(self, proxy, seconds):
+        """Record the time taken to copy back the output of a job.
+        """
+        self.metrics.observe(
+            'copy_back_seconds', seconds, host=proxy.worker.host
+        )
+
+    def release(self, proxy):
+        """Forget the job managed by the given proxy once its output has been
+        collected, it will no longer be reattached to on a restart.
+
+        Jobs run in lazy mode that finished on a remote worker are instead
+        recorded with the worker's configuration so the files left there can
+        be fetched with `fetch_file`.
+        """
+        job = proxy.job
+        journal = self._get_journal()
+        if job.lazy and _copies_output(proxy.worker) and \
+           proxy.status() == 'done':
+            journal.record(
+                job.output_dir, state='lazy',
+                worker=proxy.worker.get_config()
+            )
+        else:
+            journal.remove(job.output_dir)
+
+    def retry_delay(self, proxy):
+        """Record the failure of the job managed by the given proxy and return
+        the delay in seconds after which it should be resubmitted. Returns None
+        if the job's retry policy does not allow another attempt.
+        """
+        job = proxy.job
+        info = proxy.get_info()
+        job.attempts.append(dict(
+            host=proxy.worker.host, exitcode=info.get('exitcode'),
+            start=info.get('start'), end=info.get('end')
+        ))
+        delay = job.retry_delay()
+        if delay is not None:
+            self.metrics.inc('jobs_retried_total', host=proxy.worker.host)
+        return delay
+
+    def submit(self, job, avoid=()):
+        """Submit the job to a worker that can run it and return a `JobProxy`.
+
+        Workers whose host is in `avoid` are only used if no other worker
+        becomes available on the first attempt. If the job was submitted
+        earlier, perhaps by a previous run of the automation, and is still
+        running or its output was not collected, the job is not run again and
+        a proxy to the existing job is returned.
+        """
+        proxy = self._reattach(job)
+        if proxy is not None:
+            return proxy
         slept = False
+        start = time.time()
+        avoid = set(avoid)
+        if set(c.get('host') for c in self.worker_config).issubset(avoid):
+            # Avoiding every host is pointless.
+            avoid = set()
         while proxy is None:
-            for i in range(len(self.worker_config)):
-                worker = self._get_worker(job.n_core)
+            n_workers = len(self.workers) + len(self._pending_configs())
+            for i in range(max(n_workers, 1)):
+                worker = self._get_worker(job.n_core, avoid)
+                if worker.host in avoid and not slept:
+                    continue
                 if worker.can_run(job.n_core):
                     if slept:
                         print()
@@ -582,6 +1849,12 @@ class Scheduler(object):
                     print("Job run by %s" % worker.host)
                     proxy = worker.run(job)
                     self.jobs.append(proxy)
+                    self._get_journal().record(
+                        job.output_dir, host=worker.host,
+                        job_id=proxy.job_id, command=list(job.command),
+                        state='running'
+                    )
+                    self._record_submission(proxy, time.time() - start)
                     break
             else:
                 time.sleep(self.wait)
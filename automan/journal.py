@@ -0,0 +1,127 @@
+"""A persistent record of the jobs submitted by the scheduler.
+
+The `automan.jobs.Scheduler` records every job it submits in a `Journal` that
+is saved as ``journal.json`` in the ``.automan`` directory. If the automation
+is interrupted and restarted, the scheduler uses the journal to reattach to
+jobs that are still running, or that finished but whose output was not yet
+collected, instead of running them again.
+
+Each entry is keyed on the output directory of the job and has the host of
+the worker, the id of the job on that worker, the command and its state. The
+state is ``'running'`` while the job runs and ``'finished'`` once it has ended
+but its output has not yet been collected. The entry is removed when the
+output has been collected. Whether a job is still alive is decided from the
+process id in its ``job_info.json`` on the worker.
+
+The entries of jobs run in lazy mode, see `automan.jobs.Job`, are instead
+kept with the state ``'lazy'`` and the configuration of the worker in
+``worker``, so the files left on the worker can be fetched later with
+`automan.jobs.fetch_file`.
+
+The journal is not saved on every change, which would rewrite the whole file
+each time, but at most once every `interval` seconds and when `flush` is
+called.
+
+"""
+import json
+import os
+import time
+
+
+class Journal(object):
+    def __init__(self, fname=None, interval=0.0):
+        """Constructor.
+
+        **Parameters**
+
+        fname: str
+            Path to the JSON file to save the journal in. Any existing
+            entries in this file are loaded. If None, the journal is only
+            kept in memory.
+        interval: float
+            Minimum interval in seconds between saves of the journal when it
+            changes.
+        """
+        self.fname = fname
+        self.interval = interval
+        self.entries = dict()
+        # Incremented whenever the entries change.
+        self.version = 0
+        self._dirty = False
+        self._last_save = 0.0
+        if fname is not None and os.path.exists(fname):
+            with open(fname) as fp:
+                try:
+                    self.entries = json.load(fp)
+                except ValueError:
+                    # A corrupt journal is no worse than no journal.
+                    self.entries = dict()
+
+    # #### Private protocol ###########################################
+
+    def _key(self, output_dir):
+        return os.path.normpath(output_dir)
+
+    # #### Public protocol ###########################################
+
+    def get(self, output_dir):
+        """Return the entry for the given output directory or None.
+        """
+        return self.entries.get(self._key(output_dir))
+
+    def find(self, path):
+        """Return the entry for the output directory containing the given
+        path or None.
+        """
+        path = os.path.abspath(path)
+        for key, entry in self.entries.items():
+            output_dir = os.path.abspath(key)
+            if path == output_dir or path.startswith(output_dir + os.sep):
+                return entry
+        return None
+
+    def record(self, output_dir, **data):
+        """Add or update the entry for the given output directory with the
+        given data.
+        """
+        entry = self.entries.setdefault(
+            self._key(output_dir), dict(output_dir=output_dir)
+        )
+        entry.update(data)
+        self.version += 1
+        self._dirty = True
+        self.maybe_save()
+
+    def remove(self, output_dir):
+        """Remove the entry for the given output directory if it exists.
+        """
+        if self.entries.pop(self._key(output_dir), None) is not None:
+            self.version += 1
+            self._dirty = True
+            self.maybe_save()
+
+    def maybe_save(self):
+        """Save the journal if it changed and it was last saved more than
+        `interval` seconds ago.
+        """
+        if self._dirty and time.time() - self._last_save >= self.interval:
+            self.save()
+
+    def flush(self):
+        """Save the journal if it changed since it was last saved.
+        """
+        if self._dirty:
+            self.save()
+
+    def save(self):
+        self._dirty = False
+        self._last_save = time.time()
+        if self.fname is None:
+            return
+        dirname = os.path.dirname(self.fname)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(self.entries, fp, indent=2)
+        os.replace(tmp, self.fname)
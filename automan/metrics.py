@@ -0,0 +1,229 @@
+"""Counters, gauges and histograms to monitor the use of the workers.
+
+A `Metrics` instance is kept by the `automan.jobs.Scheduler` and is updated
+by the scheduler and the `automan.automation.TaskRunner` as jobs are
+submitted, run and copied back. The metrics are periodically written as JSON
+and in the Prometheus text format so that they may be scraped by a
+node_exporter textfile collector. They are only written if an output
+directory is given, the `automan.automation.Automator` writes them to the
+``.automan`` directory of the project.
+
+"""
+from collections import deque
+import json
+import os
+import threading
+import time
+
+
+# Histogram buckets in seconds, from a second to a day.
+DEFAULT_BUCKETS = (
+    1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600, 86400
+)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    body = ','.join(
+        '{k}="{v}"'.format(k=k, v=str(v).replace('"', '\\"'))
+        for k, v in items
+    )
+    return '{%s}' % body
+
+
+class Histogram(object):
+    """A simple cumulative histogram similar to a Prometheus histogram.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0]*len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, edge in enumerate(self.buckets):
+            if value <= edge:
+                self.counts[i] += 1
+
+    def to_dict(self):
+        return dict(
+            buckets=list(self.buckets), counts=list(self.counts),
+            count=self.count, sum=self.sum
+        )
+
+
+class Metrics(object):
+    """Collection of named counters, gauges and histograms.
+
+    Each value may be qualified with any labels passed as keyword arguments,
+    for example ``metrics.inc('jobs_submitted_total', host='localhost')``.
+
+    """
+    def __init__(self, output_dir=None, interval=30.0,
+                 prefix='automan'):
+        """Constructor.
+
+        **Parameters**
+
+        output_dir: str
+            Directory where ``metrics.json`` and ``metrics.prom`` are written.
+            If None, the metrics are only kept in memory.
+        interval: float
+            Minimum interval in seconds between successive writes done by
+            `maybe_write`.
+        prefix: str
+            Prefix added to the names of the metrics.
+        """
+        self.output_dir = output_dir
+        self.interval = interval
+        self.prefix = prefix
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+        self._submissions = deque()
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+
+    # #### Private protocol ###########################################
+
+    def _full_name(self, name):
+        return '%s_%s' % (self.prefix, name) if self.prefix else name
+
+    def _submissions_per_minute(self):
+        now = time.time()
+        times = self._submissions
+        while times and now - times[0] > 60.0:
+            times.popleft()
+        return len(times)
+
+    def _write_atomic(self, fname, text):
+        tmp = fname + '.tmp'
+        with open(tmp, 'w') as fp:
+            fp.write(text)
+        os.replace(tmp, fname)
+
+    # #### Public protocol ###########################################
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter by the given value.
+        """
+        with self._lock:
+            values = self.counters.setdefault(name, dict())
+            key = _label_key(labels)
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge to the given value.
+        """
+        with self._lock:
+            self.gauges.setdefault(name, dict())[_label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram.
+        """
+        with self._lock:
+            values = self.histograms.setdefault(name, dict())
+            key = _label_key(labels)
+            if key not in values:
+                values[key] = Histogram()
+            values[key].observe(value)
+
+    def mark_submission(self):
+        """Note that a job was submitted, this is used to compute the
+        submissions per minute.
+        """
+        with self._lock:
+            self._submissions.append(time.time())
+
+    def get(self, name, **labels):
+        """Return the value of the given counter or gauge, None if it does
+        not exist.
+        """
+        key = _label_key(labels)
+        for kind in (self.counters, self.gauges):
+            if name in kind and key in kind[name]:
+                return kind[name][key]
+        return None
+
+    def to_dict(self):
+        self.set('submissions_per_minute', self._submissions_per_minute())
+        with self._lock:
+            result = dict(time=time.time())
+            for attr in ('counters', 'gauges'):
+                result[attr] = {
+                    name: [dict(labels=dict(k), value=v)
+                           for k, v in values.items()]
+                    for name, values in getattr(self, attr).items()
+                }
+            result['histograms'] = {
+                name: [dict(labels=dict(k), **h.to_dict())
+                       for k, h in values.items()]
+                for name, values in self.histograms.items()
+            }
+        return result
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format.
+        """
+        self.set('submissions_per_minute', self._submissions_per_minute())
+        lines = []
+        with self._lock:
+            for kind, attr in (('counter', 'counters'), ('gauge', 'gauges')):
+                for name, values in sorted(getattr(self, attr).items()):
+                    full = self._full_name(name)
+                    lines.append('# TYPE %s %s' % (full, kind))
+                    for key, value in sorted(values.items()):
+                        lines.append('%s%s %s' % (
+                            full, _format_labels(key), value
+                        ))
+            for name, values in sorted(self.histograms.items()):
+                full = self._full_name(name)
+                lines.append('# TYPE %s histogram' % full)
+                for key, h in sorted(values.items()):
+                    for edge, count in zip(h.buckets, h.counts):
+                        lines.append('%s_bucket%s %d' % (
+                            full, _format_labels(key, [('le', edge)]), count
+                        ))
+                    lines.append('%s_bucket%s %d' % (
+                        full, _format_labels(key, [('le', '+Inf')]), h.count
+                    ))
+                    lines.append('%s_sum%s %s' % (
+                        full, _format_labels(key), h.sum
+                    ))
+                    lines.append('%s_count%s %d' % (
+                        full, _format_labels(key), h.count
+                    ))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Write the metrics to ``metrics.json`` and ``metrics.prom`` in the
+        output directory, if there is one.
+        """
+        self._last_write = time.time()
+        if self.output_dir is None:
+            return
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        self._write_atomic(
+            os.path.join(self.output_dir, 'metrics.json'),
+            json.dumps(self.to_dict(), indent=2)
+        )
+        self._write_atomic(
+            os.path.join(self.output_dir, 'metrics.prom'),
+            self.to_prometheus()
+        )
+
+    def maybe_write(self):
+        """Write the metrics if `interval` seconds have elapsed since the
+        last write.
+        """
+        if time.time() - self._last_write >= self.interval:
+            self.write()
@@ -0,0 +1,478 @@
+"""Lazy access to the results of simulations.
+
+The results of a simulation may be saved either in a ``results.npz`` file or
+as a ``results`` directory with one uncompressed ``.npy`` file for each
+array, see `save_results`. The latter are memory mapped when they are read,
+so only the parts of the arrays that are used are read from the disk.
+
+The arrays are loaded one at a time when they are first asked for and kept
+in a cache that is shared by all the simulations in the process. When the
+total size of the cached arrays is more than the budget of the cache, the
+least recently used arrays are dropped. The budget can be changed with
+`set_cache_size`.
+
+The arrays read from a ``results.npz`` file are copies of the cached ones,
+so they may be modified as with ``numpy.load``. The memory mapped arrays
+read from a ``results`` directory are read-only, copy them if they need to
+be modified.
+
+`load_many` reads an array from the results of many simulations
+concurrently and a `ResultsStore` consolidates the results of many
+simulations into a single file.
+"""
+
+from __future__ import print_function
+
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+import json
+import numbers
+import os
+import tempfile
+import threading
+import time
+
+
+# Default budget of the cache in bytes.
+CACHE_SIZE = 1 << 30
+
+RESULTS_DIR = 'results'
+RESULTS_FILE = 'results.npz'
+
+
+class ResultsCache(object):
+    """A thread-safe least recently used cache of arrays that is bounded by
+    the total number of bytes of the arrays.
+    """
+    def __init__(self, max_bytes=CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, load):
+        """Return the cached array for the key, calling `load()` to get it
+        if it is not cached.
+        """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key]
+        value = load()
+        with self._lock:
+            if key not in self._data and value.nbytes <= self.max_bytes:
+                self._data[key] = value
+                self.n_bytes += value.nbytes
+                self._evict()
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.n_bytes = 0
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.n_bytes > self.max_bytes and self._data:
+            key, value = self._data.popitem(last=False)
+            self.n_bytes -= value.nbytes
+
+
+_cache = ResultsCache()
+
+
+def get_cache():
+    """Return the cache shared by all the `Results` in the process.
+    """
+    return _cache
+
+
+def set_cache_size(max_bytes):
+    """Set the budget in bytes of the shared cache of results.
+    """
+    _cache.resize(max_bytes)
+
+
+def save_results(output_dir, **arrays):
+    """Save the given arrays as uncompressed ``.npy`` files in the
+    ``results`` directory of the `output_dir`, so they can be memory mapped
+    when read with `Results`.
+    """
+    import numpy
+    path = os.path.join(output_dir, RESULTS_DIR)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for key, value in arrays.items():
+        numpy.save(os.path.join(path, key + '.npy'), value)
+
+
+class Results(Mapping):
+    """Read-only mapping of the arrays in the results of a simulation, which
+    are loaded lazily through the shared cache.
+    """
+    def __init__(self, path, cache=None):
+        """Constructor.
+
+        **Parameters**
+
+        path: str
+            Path to a ``results`` directory of ``.npy`` files or to a
+            ``.npz`` file.
+        cache: ResultsCache
+            The cache to use, defaults to the one shared in the process.
+        """
+        self.path = path
+        self.cache = _cache if cache is None else cache
+        self._files = None
+
+    def __repr__(self):
+        return 'Results(%r)' % self.path
+
+    @property
+    def files(self):
+        """The names of the arrays, as with ``numpy.load``.
+        """
+        if self._files is None:
+            if os.path.isdir(self.path):
+                self._files = sorted(
+                    x[:-4] for x in os.listdir(self.path) if x.endswith('.npy')
+                )
+            else:
+                import numpy
+                with numpy.load(self.path) as data:
+                    self._files = list(data.files)
+        return self._files
+
+    def __getitem__(self, key):
+        if key not in self.files:
+            raise KeyError(key)
+        if os.path.isdir(self.path):
+            fname = os.path.join(self.path, key + '.npy')
+        else:
+            fname = self.path
+        # The array is loaded again if the file was rewritten.
+        mtime = os.stat(fname).st_mtime
+        value = self.cache.get(
+            (os.path.abspath(fname), mtime, key),
+            lambda: self._load(fname, key)
+        )
+        if fname.endswith('.npy'):
+            return value
+        # Code written for numpy.load may change the array in place.
+        return value.copy()
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, key):
+        return key in self.files
+
+    def _load(self, fname, key):
+        import numpy
+        if fname.endswith('.npy'):
+            value = numpy.load(fname, mmap_mode='r')
+        else:
+            with numpy.load(fname) as data:
+                value = data[key]
+            value.flags.writeable = False
+        return value
+
+    def close(self):
+        """Does nothing, the files are closed after each array is read. This
+        is for compatibility with ``numpy.load``.
+        """
+        pass
+
+
+def load_many(sims, key, index=None, max_workers=None):
+    """Read the array named `key` from the results of each of the given
+    simulations concurrently in a pool of threads.
+
+    Returns an array with the arrays of the simulations stacked along the
+    first axis if all of them have the same shape, otherwise returns a dict
+    of the arrays keyed by the name of each simulation, or by its root if
+    the names are not unique.
+
+    **Parameters**
+
+    sims: sequence
+        Sequence of `automan.automation.Simulation` instances.
+    key: str
+        Name of the array to read.
+    index: slice, tuple or int
+        If given, only ``array[index]`` is read from each array. Only this
+        part is read from the disk for results saved with `save_results`.
+    max_workers: int
+        Number of threads to use, defaults to one for each simulation up to
+        a maximum of 32.
+    """
+    import numpy
+    sims = list(sims)
+    if max_workers is None:
+        max_workers = min(32, len(sims))
+
+    def _load(sim):
+        value = sim.data[key]
+        if index is not None:
+            value = value[index]
+        if isinstance(value, numpy.memmap):
+            # Read it in this thread.
+            value = numpy.array(value)
+        return value
+
+    if len(sims) == 0:
+        return numpy.array([])
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        values = list(pool.map(_load, sims))
+    if len(set(numpy.shape(x) for x in values)) == 1:
+        return numpy.stack(values)
+    names = [s.name for s in sims]
+    if len(set(names)) < len(names):
+        names = [s.root for s in sims]
+    return dict(zip(names, values))
+
+
+def _results_mtime(results):
+    """Return the time the given `Results` were last modified or None if
+    they do not exist.
+    """
+    path = results.path
+    if os.path.isdir(path):
+        mtimes = [
+            os.stat(os.path.join(path, x)).st_mtime
+            for x in os.listdir(path) if x.endswith('.npy')
+        ]
+        return max(mtimes) if mtimes else None
+    elif os.path.exists(path):
+        return os.stat(path).st_mtime
+    return None
+
+
+def _to_column(values):
+    """Return the values as an array, which is an array of objects if the
+    values are not all numbers or all of the same type.
+    """
+    import numpy
+    types = set(type(x) for x in values)
+    numeric = all(
+        isinstance(x, numbers.Number) and not isinstance(x, bool)
+        for x in values
+    )
+    if numeric or len(types) == 1:
+        try:
+            column = numpy.array(values)
+        except ValueError:
+            column = None
+        if column is not None and column.ndim == 1:
+            return column
+    column = numpy.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def _to_json(value):
+    """Convert the values that ``json`` does not handle, like NumPy scalars
+    and arrays, when saving the parameters.
+    """
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+def _json_params(params):
+    """Return the parameters as they are after being saved and loaded.
+    """
+    return json.loads(json.dumps(params, sort_keys=True, default=_to_json))
+
+
+class ResultsStore(object):
+    """A single file with the parameters and results of a collection of
+    simulations, for example all the cases of a `Problem`.
+
+    The store is a ``.npz`` file with a ``names`` column of the names of the
+    simulations, a ``params`` column with the parameters of each simulation
+    as JSON and a ``data/<key>`` column for each array in the results. The
+    arrays of the simulations are stacked along the first axis when they have
+    the same shape, otherwise each is saved as ``data/<key>/<index>``.
+
+    The store is updated with `update` which only reads the results of the
+    simulations that are new or changed since they were last added. As the
+    whole file is written each time it is saved, it is saved at most every
+    `interval` seconds and when `flush` is called.
+    """
+    def __init__(self, fname, interval=0.0):
+        """Constructor.
+
+        **Parameters**
+
+        fname: str
+            Path of the ``.npz`` file of the store.
+        interval: float
+            Minimum interval in seconds between saves of the store when it is
+            updated.
+        """
+        self.fname = fname
+        self.interval = interval
+        # Maps the name of each simulation to its mtime, params and data.
+        self._records = OrderedDict()
+        self._dirty = False
+        self._last_save = 0.0
+        self._load()
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    # #### Private protocol ###########################################
+
+    def _load(self):
+        import numpy
+        if not os.path.exists(self.fname):
+            return
+        with numpy.load(self.fname) as store:
+            names = [str(x) for x in store['names']]
+            mtimes = store['mtimes']
+            params = [json.loads(str(x)) for x in store['params']]
+            columns = dict((k, store[k]) for k in store.files)
+        for i, name in enumerate(names):
+            self._records[name] = dict(
+                mtime=float(mtimes[i]), params=params[i], data=dict()
+            )
+        for column, values in columns.items():
+            parts = column.split('/')
+            if parts[0] == 'data' and len(parts) == 2:
+                for i, name in enumerate(names):
+                    self._records[name]['data'][parts[1]] = values[i]
+            elif parts[0] == 'data':
+                name = names[int(parts[2])]
+                self._records[name]['data'][parts[1]] = values
+
+    def _save(self):
+        import numpy
+        names = list(self._records)
+        records = list(self._records.values())
+        columns = dict(
+            names=numpy.array(names, dtype=str),
+            mtimes=numpy.array([r['mtime'] for r in records]),
+            params=numpy.array([
+                json.dumps(r['params'], sort_keys=True) for r in records
+            ], dtype=str)
+        )
+        keys = set(k for r in records for k in r['data'])
+        for key in sorted(keys):
+            values = [r['data'].get(key) for r in records]
+            shapes = set(numpy.shape(x) for x in values if x is not None)
+            if all(x is not None for x in values) and len(shapes) == 1:
+                columns['data/' + key] = numpy.stack(values)
+            else:
+                for i, value in enumerate(values):
+                    if value is not None:
+                        columns['data/%s/%d' % (key, i)] = value
+        dirname = os.path.dirname(os.path.abspath(self.fname))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        fd, tmp = tempfile.mkstemp(suffix='.npz', dir=dirname)
+        with os.fdopen(fd, 'wb') as fp:
+            numpy.savez(fp, **columns)
+        os.replace(tmp, self.fname)
+        self._dirty = False
+        self._last_save = time.time()
+
+    # #### Public protocol ###########################################
+
+    @property
+    def names(self):
+        """The names of the simulations in the store.
+        """
+        return list(self._records)
+
+    def keys(self):
+        """Return the names of the arrays in the store.
+        """
+        return sorted(set(k for r in self._records.values()
+                          for k in r['data']))
+
+    def params(self, name):
+        """Return the parameters of the named simulation.
+        """
+        return dict(self._records[name]['params'])
+
+    def column(self, param):
+        """Return an array of the values of the given parameter for all the
+        simulations in the store.
+        """
+        return _to_column(
+            [r['params'].get(param) for r in self._records.values()]
+        )
+
+    def get(self, key, name=None):
+        """Return the array named `key` of the named simulation, or if no
+        name is given, the arrays of all the simulations as in `load_many`.
+        """
+        import numpy
+        if name is not None:
+            return self._records[name]['data'][key]
+        values = [r['data'].get(key) for r in self._records.values()]
+        if any(x is None for x in values):
+            raise KeyError(key)
+        if len(set(numpy.shape(x) for x in values)) == 1:
+            return numpy.stack(values)
+        return dict(zip(self._records, values))
+
+    def flush(self):
+        """Save the store if it changed since it was last saved.
+        """
+        if self._dirty:
+            self._save()
+
+    def update(self, sims, keys=None):
+        """Add the results of the given simulations that are new or changed
+        since they were last added. The store is saved if it was last saved
+        more than `interval` seconds ago. Simulations without results are
+        skipped. Returns True if the store changed.
+
+        **Parameters**
+
+        sims: sequence
+            Sequence of `automan.automation.Simulation` instances.
+        keys: sequence
+            Names of the arrays to add, defaults to all the arrays.
+        """
+        import numpy
+        changed = False
+        for sim in sims:
+            results = sim.data
+            mtime = _results_mtime(results)
+            record = self._records.get(sim.name)
+            if mtime is None or (record is not None and
+                                 record['mtime'] == mtime):
+                continue
+            names = results.files if keys is None else keys
+            self._records[sim.name] = dict(
+                mtime=mtime, params=_json_params(sim.params),
+                data=dict(
+                    (k, numpy.array(results[k])) for k in names if k in results
+                )
+            )
+            changed = True
+        if changed:
+            self._dirty = True
+        if self._dirty and time.time() - self._last_save >= self.interval:
+            self._save()
+        return changed
@@ -0,0 +1,248 @@
+"""A worker that runs jobs through a SLURM-style batch system.
+
+The `SlurmWorker` turns the resource requests of a `automan.jobs.Job` into a
+batch script which is submitted with ``sbatch``. The batch script runs the
+job such that it writes the usual ``job_info.json``, ``stdout.txt`` and
+``stderr.txt`` into the output directory, so the worker works with the
+regular `automan.jobs.JobProxy` and `automan.automation.CommandTask`. The
+state of all the submitted jobs is found with a single ``squeue`` call every
+`poll_interval` seconds.
+
+The worker assumes that the output directories are on a filesystem shared
+between the machine running the automation and the compute nodes, which is
+the common setup on clusters.
+
+For testing, `automan.fake_slurm` provides stand-in ``sbatch``, ``squeue`` and
+``scancel`` commands that run the jobs on the local machine.
+
+"""
+from __future__ import print_function
+
+import getpass
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from textwrap import dedent
+
+from .jobs import Job, JobProxy, Worker
+
+
+# States reported by squeue for jobs that have not yet finished.
+ACTIVE_STATES = (
+    'PENDING', 'CONFIGURING', 'RUNNING', 'COMPLETING', 'SUSPENDED',
+    'REQUEUED', 'RESIZING'
+)
+
+
+def _format_time(seconds):
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return '%d-%02d:%02d:%02d' % (days, hours, minutes, seconds)
+
+
+class SlurmWorker(Worker):
+    """Worker that submits jobs to a SLURM batch system.
+
+    To use this with the `automan.jobs.Scheduler`, add a worker configuration
+    with ``type='slurm'``, for example::
+
+        dict(host='cluster', type='slurm', partition='compute', max_jobs=50)
+
+    """
+
+    BATCH_SCRIPT = dedent("""\
+        #!/bin/bash
+        #SBATCH --job-name={name}
+        #SBATCH --output={output_dir}/slurm.out
+        #SBATCH --cpus-per-task={n_core}
+        {options}
+        cd {chdir}
+        {python} -m automan.slurm {job_file}
+        """)
+
+    def __init__(self, host='slurm', python=None, partition=None,
+                 max_jobs=100, cores_per_node=None, poll_interval=10.0,
+                 sbatch='sbatch', squeue='squeue', scancel='scancel',
+                 options=(), testing=False):
+        """Constructor.
+
+        **Parameters**
+
+        host: str
+            Name of the worker, used only for messages.
+        python: str
+            Python executable used on the compute nodes, defaults to the
+            current one.
+        partition: str
+            Partition to submit the jobs to.
+        max_jobs: int
+            Maximum number of jobs that are queued or running at a time.
+        cores_per_node: int
+            Number of cores on a compute node, used for negative `n_core`.
+            Defaults to the number of cores on this machine.
+        poll_interval: float
+            Minimum time in seconds between successive calls to squeue.
+        sbatch, squeue, scancel: str
+            Commands used to submit, query and cancel the jobs.
+        options: sequence
+            Additional options to pass to sbatch.
+        testing: bool
+            Use the `automan.fake_slurm` commands that run the jobs locally.
+        """
+        super(SlurmWorker, self).__init__()
+        self.host = host
+        self.python = python if python is not None else sys.executable
+        # The jobs are run from the current directory.
+        self.chdir = os.getcwd()
+        self.partition = partition
+        self.max_jobs = max_jobs
+        self.poll_interval = poll_interval
+        self.options = list(options)
+        self.testing = testing
+        # The output is on a shared filesystem and is never copied.
+        self.nfs = True
+        if cores_per_node is not None:
+            self._total_cores = cores_per_node
+        if testing:
+            fake = [sys.executable, '-m', 'automan.fake_slurm']
+            self._sbatch = fake + ['sbatch']
+            self._squeue = fake + ['squeue']
+            self._scancel = fake + ['scancel']
+        else:
+            self._sbatch = shlex.split(sbatch)
+            self._squeue = shlex.split(squeue)
+            self._scancel = shlex.split(scancel)
+        self.job_count = 0
+        self._batch_ids = dict()
+        self._submit_times = dict()
+        self._queue = set()
+        self._last_poll = 0.0
+
+    # #### Private protocol ###########################################
+
+    def _make_script(self, job, job_file):
+        options = ['--partition=%s' % self.partition] if self.partition \
+            else []
+        if job.memory is not None:
+            mem = job.memory
+            options.append('--mem=%s' % (mem if isinstance(mem, str)
+                                         else '%dM' % mem))
+        if job.timeout is not None:
+            options.append('--time=%s' % _format_time(job.timeout))
+        options.extend(self.options)
+        return self.BATCH_SCRIPT.format(
+            name='automan-%s' % os.path.basename(job.output_dir),
+            output_dir=os.path.abspath(job.output_dir),
+            n_core=max(1, self.cores_required(job.n_core)),
+            options='\n'.join('#SBATCH %s' % x for x in options),
+            chdir=shlex.quote(self.chdir), python=shlex.quote(self.python),
+            job_file=shlex.quote(job_file)
+        )
+
+    def _refresh_queue(self, force=False):
+        if not force and time.time() - self._last_poll < self.poll_interval:
+            return
+        cmd = self._squeue + ['-h', '-o', '%i %T', '-u', getpass.getuser()]
+        output = subprocess.check_output(cmd).decode()
+        queue = set()
+        for line in output.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[1] in ACTIVE_STATES:
+                queue.add(parts[0])
+        self._last_poll = time.time()
+        self._queue = queue
+
+    # #### Public protocol ###########################################
+
+    def get_config(self):
+        return dict(host=self.host, type='slurm', python=self.python,
+                    partition=self.partition, max_jobs=self.max_jobs)
+
+    def free_cores(self):
+        used = sum(self.cores_required(self.jobs[i].n_core)
+                   for i in self.running_jobs)
+        return max(self.total_cores() - used, 0)
+
+    def can_run(self, req_core):
+        """Returns True if fewer than `max_jobs` jobs are queued or running.
+        """
+        self._check_running_jobs()
+        return len(self.running_jobs) < self.max_jobs
+
+    def run(self, job):
+        print("Submitting %s" % job.pretty_command())
+        output_dir = job.output_dir
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        job_file = os.path.join(output_dir, 'batch_job.json')
+        with open(job_file, 'w') as fp:
+            json.dump(job.to_dict(), fp)
+        script = os.path.join(output_dir, 'batch_job.sh')
+        with open(script, 'w') as fp:
+            fp.write(self._make_script(job, job_file))
+        job._write_info(dict(status='running', pid=None))
+
+        output = subprocess.check_output(
+            self._sbatch + ['--parsable', script], cwd=self.chdir
+        ).decode().strip()
+        count = self.job_count
+        self._batch_ids[count] = output.split(';')[0]
+        self._submit_times[count] = time.time()
+        self.jobs[count] = job
+        self.running_jobs.add(count)
+        self.job_count += 1
+        return JobProxy(self, count, job)
+
+    def status(self, job_id):
+        self._refresh_queue()
+        job = self.jobs[job_id]
+        if self._batch_ids[job_id] in self._queue or \
+           self._submit_times[job_id] >= self._last_poll:
+            s = 'running'
+        else:
+            s = job.get_info().get('status')
+            if s in ('running', 'not started'):
+                # The job left the queue without finishing, it was either
+                # cancelled or killed by the batch system.
+                s = 'error'
+        if s != 'running':
+            self.running_jobs.discard(job_id)
+        return s
+
+    def copy_output(self, job_id, dest):
+        return
+
+    def clean(self, job_id, force=False):
+        if force:
+            self.jobs[job_id].clean(force)
+
+    def kill(self, job_id):
+        subprocess.check_call(self._scancel + [self._batch_ids[job_id]])
+        self._refresh_queue(force=True)
+
+    def get_stdout(self, job_id):
+        return self.jobs[job_id].get_stdout()
+
+    def get_stderr(self, job_id):
+        return self.jobs[job_id].get_stderr()
+
+    def get_info(self, job_id):
+        return self.jobs[job_id].get_info()
+
+
+def run_batch_job(job_file):
+    """Run the job stored in the given JSON file, this is what the batch script
+    executes on the compute node.
+    """
+    with open(job_file) as fp:
+        job = Job(**json.load(fp))
+    job._run()
+
+
+if __name__ == '__main__':
+    run_batch_job(sys.argv[1])
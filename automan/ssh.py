@@ -0,0 +1,108 @@
+"""Shared ssh connections to the remote hosts.
+
+Every ssh, scp and rsync command as well as the execnet gateways started by
+automan use OpenSSH's connection multiplexing, so that all the connections
+to a host go over a single master connection that is authenticated once.
+The first connection to a host starts the master connection in the
+background, later ones reuse it. The master connections are closed when the
+Python process exits.
+
+Set `MULTIPLEX` to False to disable this. It is also not used if the path
+of the sockets would be longer than the limit of `MAX_SOCKET_PATH` bytes.
+"""
+
+from __future__ import print_function
+
+import atexit
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+
+# Use a master connection for each host.
+MULTIPLEX = os.name == 'posix'
+
+# Time in seconds for which an idle master connection is kept open.
+PERSIST = 600
+
+# Maximum length of the path of a unix socket, this is 104 bytes on macOS
+# and the BSDs and 108 on Linux.
+MAX_SOCKET_PATH = 104
+
+# Length of the name of a socket, %C is a 40 character hash to which ssh
+# adds a 17 character random suffix while it sets up the master connection.
+_SOCKET_NAME_LEN = 40 + 17
+
+_control_dir = None
+# Used as `_control_dir` when no directory with a short enough path could be
+# made, so that this is only tried once.
+_NO_CONTROL_DIR = object()
+_lock = threading.Lock()
+
+
+def _get_control_dir():
+    """Return the directory for the sockets of the master connections or
+    None if no directory with a short enough path could be made.
+    """
+    global _control_dir
+    with _lock:
+        if _control_dir is None:
+            # The default temporary directory can be long, on macOS for
+            # example, so use /tmp.
+            base = '/tmp' if os.path.isdir('/tmp') else None
+            path = tempfile.mkdtemp(prefix='am-', dir=base)
+            if len(path.encode()) + 1 + _SOCKET_NAME_LEN >= MAX_SOCKET_PATH:
+                os.rmdir(path)
+                path = _NO_CONTROL_DIR
+            _control_dir = path
+        if _control_dir is _NO_CONTROL_DIR:
+            return None
+        return _control_dir
+
+
+def ssh_options():
+    """Return a list of the options to pass to ssh or scp to use the master
+    connection to the host.
+    """
+    if not MULTIPLEX:
+        return []
+    control_dir = _get_control_dir()
+    if control_dir is None:
+        return []
+    path = os.path.join(control_dir, '%C')
+    return [
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath=%s' % path,
+        '-o', 'ControlPersist=%d' % PERSIST,
+    ]
+
+
+def ssh_command():
+    """Return the ssh command, with its options, as a string that can be
+    passed to ``rsync -e``.
+    """
+    return ' '.join(['ssh'] + ssh_options())
+
+
+def close_connections():
+    """Close all the master connections and remove their sockets.
+    """
+    global _control_dir
+    with _lock:
+        control_dir, _control_dir = _control_dir, None
+    if control_dir in (None, _NO_CONTROL_DIR) or \
+            not os.path.isdir(control_dir):
+        return
+    for name in os.listdir(control_dir):
+        path = os.path.join(control_dir, name)
+        # The host is ignored as the control path is given explicitly.
+        subprocess.call(
+            ['ssh', '-o', 'ControlPath=%s' % path, '-O', 'exit', 'automan'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    shutil.rmtree(control_dir, ignore_errors=True)
+
+
+atexit.register(close_connections)
@@ -1,8 +1,11 @@
 from __future__ import print_function
 
+from io import StringIO
+import json
 import os
 import sys
 import tempfile
+import time
 import unittest
 
 try:
@@ -11,11 +14,11 @@ except ImportError:
     import mock
 
 from automan.automation import (
-    Automator, CommandTask, FileCommandTask, Problem, PySPHProblem, RunAll,
-    Simulation, SolveProblem, TaskRunner
+    Automator, CommandTask, FileCommandTask, PostProcessor, Problem,
+    PySPHProblem, RunAll, Simulation, SolveProblem, TaskRunner
 )
 try:
-    from automan.jobs import Scheduler, RemoteWorker
+    from automan.jobs import Scheduler, RemoteWorker, set_fetch_journal
 except ImportError:
     raise unittest.SkipTest('test_jobs requires psutil')
 
@@ -164,6 +167,29 @@ class TestTaskRunner(TestAutomationBase):
         self.assertTrue(os.path.exists(ct2_dir))
         self.assertFalse(os.path.exists(ct1_dir))
 
+    def test_journal_is_saved_when_task_runner_is_interrupted(self):
+        # Given
+        worker = dict(host='localhost')
+        journal = os.path.join('.automan', 'journal.json')
+        s = Scheduler(root='.', worker_config=[worker], wait=0.1,
+                      journal=journal, journal_interval=1000.0)
+        cmd = 'python -c "import time; time.sleep(0.5)"'
+        ct = CommandTask(cmd, output_dir=self.sim_dir)
+        t = TaskRunner(tasks=[ct], scheduler=s)
+        s.journal.save()
+
+        # When
+        with mock.patch('automan.automation.time.sleep',
+                        side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, t.run, wait=0.1)
+
+        # Then
+        with open(journal) as fp:
+            entries = json.load(fp)
+        self.assertEqual(list(entries.keys()), [self.sim_dir])
+        self.assertEqual(entries[self.sim_dir]['state'], 'running')
+        wait_until(lambda: not ct.complete())
+
     @mock.patch('automan.jobs.total_cores', return_value=2)
     def test_task_runner_doesnt_block_on_problem_with_error(self, m_t_cores):
         # Given
@@ -205,6 +231,30 @@ class TestTaskRunner(TestAutomationBase):
         # Then
         self.assertTrue(n_error > 0)
 
+    def test_task_runner_prioritizes_copies_for_ready_problems(self):
+        # Given
+        s = self._make_scheduler()
+        problem = EllipticalDrop(self.sim_dir, self.output_dir)
+        task = SolveProblem(problem)
+        t = TaskRunner(tasks=[task], scheduler=s)
+        t1, t2 = task.requires()
+        t1._copy_proc = mock.MagicMock(priority=0)
+
+        # When
+        t._prioritize_copies()
+
+        # Then
+        # The other case is not yet done.
+        self.assertEqual(t1.copy_priority, 0)
+
+        # When
+        t2._copy_proc = mock.MagicMock(priority=0)
+        t._prioritize_copies()
+
+        # Then
+        self.assertEqual([t1.copy_priority, t2.copy_priority], [1, 1])
+        self.assertEqual(t1._copy_proc.priority, 1)
+
     def test_task_runner_does_not_add_repeated_tasks(self):
         # Given
         s = self._make_scheduler()
@@ -337,6 +387,112 @@ class TestTaskRunner(TestAutomationBase):
         self.assertTrue(ct2_t > ct1_t)
         self.assertTrue(ct3_t > ct2_t)
 
+    def test_results_of_cases_are_consolidated_into_store(self):
+        # Given
+        try:
+            import numpy as np
+        except ImportError:
+            raise unittest.SkipTest('numpy is not installed')
+
+        class A(Problem):
+            results_keys = ['x']
+
+            def setup(self):
+                cmd = ('python -c "import sys, numpy; '
+                       'numpy.savez(\'$output_dir/results.npz\', '
+                       'x=numpy.ones(2)*float(sys.argv[1][4:]), '
+                       'y=numpy.ones(3))"')
+                self.cases = [
+                    Simulation(self.input_path(str(i)), cmd, n=i)
+                    for i in range(3)
+                ]
+
+            def run(self):
+                self.make_output_dir()
+
+        s = self._make_scheduler()
+        problem = A(self.sim_dir, self.output_dir)
+        task = SolveProblem(problem)
+        t = TaskRunner(tasks=[task], scheduler=s)
+
+        # When
+        t.run(wait=0.1)
+
+        # Then
+        store = problem.results_store
+        self.assertEqual(sorted(store.names), ['0', '1', '2'])
+        self.assertEqual(store.keys(), ['x'])
+        for i, name in enumerate(store.names):
+            np.testing.assert_array_equal(
+                store['x'][i], np.ones(2) * int(name)
+            )
+        self.assertTrue(
+            os.path.exists(problem.input_path('results_store.npz'))
+        )
+        self.assertFalse(store.update(problem.cases, ['x']))
+
+    @unittest.skipIf(not PostProcessor.can_fork(), 'needs fork')
+    def test_problems_are_post_processed_in_parallel(self):
+        # Given
+        class A(Problem):
+            def run(self):
+                self.make_output_dir()
+                start = time.time()
+                time.sleep(0.5)
+                with open(self.output_path('times.txt'), 'w') as fp:
+                    fp.write('%r %r' % (start, time.time()))
+
+        class B(A):
+            pass
+
+        s = self._make_scheduler()
+        problems = [A(self.sim_dir, self.output_dir),
+                    B(self.sim_dir, self.output_dir)]
+        tasks = [SolveProblem(p) for p in problems]
+        t = TaskRunner(tasks=tasks, scheduler=s,
+                       post_processor=PostProcessor(max_workers=2))
+
+        # When
+        n_errors = t.run(wait=0.1)
+
+        # Then
+        self.assertEqual(n_errors, 0)
+        times = []
+        for p in problems:
+            with open(p.output_path('times.txt')) as fp:
+                times.append([float(x) for x in fp.read().split()])
+        (start_a, end_a), (start_b, end_b) = times
+        self.assertTrue(start_b < end_a and start_a < end_b)
+
+    @unittest.skipIf(not PostProcessor.can_fork(), 'needs fork')
+    def test_errors_in_post_processing_are_reported(self):
+        # Given
+        class A(Problem):
+            def run(self):
+                raise ValueError('bad plot')
+
+        class B(Problem):
+            run_in_subprocess = False
+
+            def run(self):
+                self.make_output_dir()
+                self.ran = True
+
+        s = self._make_scheduler()
+        a = A(self.sim_dir, self.output_dir)
+        b = B(self.sim_dir, self.output_dir)
+        t = TaskRunner(tasks=[SolveProblem(a), SolveProblem(b)], scheduler=s,
+                       post_processor=PostProcessor(max_workers=2))
+
+        # When
+        with mock.patch('sys.stdout', new_callable=StringIO) as out:
+            n_errors = t.run(wait=0.1)
+
+        # Then
+        self.assertEqual(n_errors, 1)
+        self.assertIn("ValueError: bad plot", out.getvalue())
+        self.assertTrue(b.ran)
+
     def test_simulation_with_dependencies(self):
         # Given
         class A(Problem):
@@ -467,6 +623,38 @@ class TestRemoteAutomation(TestLocalAutomation):
             raise unittest.SkipTest('This test requires execnet')
         return Scheduler(root=self.sim_dir, worker_config=workers)
 
+    def test_lost_remote_job_is_resubmitted(self):
+        # Given
+        workers = [dict(host='test_remote', python=sys.executable,
+                        chdir=self.other_dir, testing=True)]
+        s = Scheduler(root=self.sim_dir, worker_config=workers, wait=0.1)
+        cmd = 'python -c "import time; time.sleep(0.5); print(1)"'
+        t = CommandTask(cmd, output_dir='job')
+        t.run(s)
+        worker = t.job_proxy.worker
+        worker.heartbeat_interval = 0.0
+        worker.reconnect_interval = 0.1
+
+        # When
+        worker.gw.remote_exec('import os; os._exit(1)')
+        wait_until(lambda: worker.heartbeat(), timeout=5)
+        s.poll()
+
+        # Then
+        self.assertEqual(s.jobs, [])
+        self.assertEqual(
+            s.metrics.get('jobs_finished_total', host='test_remote',
+                          status='lost'), 1
+        )
+
+        # When
+        wait_until(lambda: not t.complete(), timeout=20)
+
+        # Then
+        self.assertTrue(worker.alive)
+        with open(os.path.join('job', 'stdout.txt')) as fp:
+            self.assertEqual(fp.read().strip(), '1')
+
     def test_job_with_error_is_handled_correctly(self):
         # Given.
         problem = EllipticalDrop(self.sim_dir, self.output_dir)
@@ -572,6 +760,66 @@ class TestCommandTask(TestAutomationBase):
         # When/Then
         self.assertFalse(t.complete())
 
+    def test_command_task_retries_failed_job(self):
+        # Given
+        s = self._make_scheduler()
+        # Fails the first time it is run and succeeds after.
+        cmd = ('python -c "import os, sys; e = os.path.exists(\'marker\'); '
+               'open(\'marker\', \'w\').close(); sys.exit(0 if e else 3)"')
+        retry = dict(max_attempts=2, backoff=0, exitcodes=[3])
+        t = CommandTask(cmd, output_dir=self.sim_dir,
+                        job_info=dict(retry=retry))
+
+        # When
+        t.run(s)
+        wait_until(lambda: not t.complete(), timeout=5)
+
+        # Then
+        self.assertTrue(t.complete())
+        info = t.job_proxy.get_info()
+        self.assertEqual(info['status'], 'done')
+        attempts = info['attempts']
+        self.assertEqual(len(attempts), 1)
+        self.assertEqual(attempts[0]['host'], 'localhost')
+        self.assertEqual(attempts[0]['exitcode'], 3)
+
+    def test_command_task_does_not_retry_other_exit_codes(self):
+        # Given
+        s = self._make_scheduler()
+        cmd = 'python -c "import sys; sys.exit(2)"'
+        retry = dict(max_attempts=2, backoff=0, exitcodes=[3])
+        t = CommandTask(cmd, output_dir=self.sim_dir,
+                        job_info=dict(retry=retry))
+
+        # When
+        t.run(s)
+        try:
+            wait_until(lambda: not t.complete(), timeout=5)
+        except RuntimeError:
+            pass
+
+        # Then
+        self.assertRaises(RuntimeError, t.complete)
+        self.assertEqual(len(t.job.attempts), 1)
+
+    def test_command_task_releases_finished_job(self):
+        # Given
+        s = self._make_scheduler()
+        cmd = 'python -c "print(1)"'
+        t = CommandTask(cmd, output_dir=self.sim_dir)
+
+        # When
+        t.run(s)
+
+        # Then
+        self.assertNotEqual(s._get_journal().get(self.sim_dir), None)
+
+        # When
+        wait_until(lambda: not t.complete())
+
+        # Then
+        self.assertEqual(s._get_journal().get(self.sim_dir), None)
+
 
 class TestFileCommandTask(TestAutomationBase):
     def _make_scheduler(self):
@@ -609,7 +857,10 @@ class TestRemoteCommandTask(TestAutomationBase):
             host='test_remote', python=sys.executable,
             chdir=self.output_dir, testing=True
         )
-        s = Scheduler(root='.', worker_config=[worker])
+        s = Scheduler(
+            root='.', worker_config=[worker], copy_batch_window=0.1,
+            journal=os.path.join('.automan', 'journal.json')
+        )
         return s
 
     def test_remote_command_tasks_complete_method_works(self):
@@ -635,6 +886,69 @@ class TestRemoteCommandTask(TestAutomationBase):
         # Test that if we call it repeatedly that it does indeed return True
         self.assertTrue(t.complete())
 
+    def test_failed_copy_is_retried(self):
+        # Given
+        s = self._make_scheduler()
+        cmd = 'python -c "print(1)"'
+        t = CommandTask(cmd, output_dir=self.sim_dir)
+        failed = mock.MagicMock(returncode=1)
+        failed.poll.return_value = 1
+        original = RemoteWorker.copy_outputs
+        calls = []
+
+        def copy_outputs(worker, job_ids, dest, bwlimit=None):
+            calls.append(job_ids)
+            if len(calls) == 1:
+                return failed
+            return original(worker, job_ids, dest, bwlimit)
+
+        # When
+        with mock.patch.object(RemoteWorker, 'copy_outputs', copy_outputs):
+            t.run(s)
+            wait_until(lambda: not t.complete())
+
+        # Then
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.sim_dir, 'stdout.txt')
+        ))
+
+    def test_lazy_output_is_fetched_on_demand(self):
+        # Given
+        s = self._make_scheduler()
+        cmd = ('python -c "open(\'$output_dir/results.npz\', \'w\'); '
+               'open(\'$output_dir/big.hdf5\', \'w\')"')
+        t = CommandTask(
+            cmd, output_dir=self.sim_dir,
+            job_info=dict(copy_include=['*.npz'], lazy=True)
+        )
+
+        # When
+        t.run(s)
+        wait_until(lambda: not t.complete())
+        set_fetch_journal(s.journal)
+
+        # Then
+        self.assertTrue(os.path.exists(
+            os.path.join(self.sim_dir, 'results.npz')
+        ))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.sim_dir, 'big.hdf5')
+        ))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.output_dir, self.sim_dir, 'big.hdf5')
+        ))
+
+        # When
+        sim = Simulation(self.sim_dir, 'python')
+        with mock.patch.dict('automan.jobs._fetch_workers', clear=True):
+            path = sim.input_path('big.hdf5')
+            missing = sim.input_path('junk.txt')
+
+        # Then
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(missing))
+
 
 def test_simulation_get_labels():
     # Given
@@ -699,6 +1013,58 @@ class TestAutomator(TestAutomationBase):
         out_dir = os.path.basename(a.runner.todo[-1].output_dir)
         self.assertEqual(out_dir, 'no_update_h')
 
+    @mock.patch.object(TaskRunner, 'run')
+    @mock.patch.object(ClusterManager, '_update_sources')
+    @mock.patch.object(ClusterManager, '_rebuild')
+    def test_hosts_that_fail_to_update_are_not_used(self, mock_rebuild,
+                                                    mock_update_sources,
+                                                    mock_run):
+        # Given
+        cm = ClusterManager()
+        for host in ('h1', 'h2'):
+            cm.workers.append(dict(
+                host=host, home='/home/foo', nfs=False,
+                python='python', chdir='/home/foo/automan/project'
+            ))
+        cm._write_config()
+
+        def rebuild(host, home):
+            if host == 'h2':
+                raise RuntimeError('update failed')
+
+        mock_rebuild.side_effect = rebuild
+        a = Automator('sim', 'output', [EllipticalDrop])
+
+        # When
+        with mock.patch('sys.stdout', new_callable=StringIO) as out:
+            a.run(['-u'])
+
+        # Then
+        self.assertEqual(mock_update_sources.call_count, 2)
+        hosts = sorted(x['host'] for x in a.scheduler.worker_config)
+        self.assertEqual(hosts, ['h1', 'localhost'])
+        self.assertIn('could not be updated: h2', out.getvalue())
+
+    @mock.patch.object(TaskRunner, 'run')
+    def test_parallel_post_processing_is_opt_in(self, mock_run):
+        # Given
+        a = Automator('sim', 'output', [EllipticalDrop])
+
+        # When
+        a.run([])
+
+        # Then
+        self.assertIsNone(a.runner.post_processor)
+        task = [t for t in a.runner.todo if isinstance(t, SolveProblem)][0]
+        self.assertIsNone(task.post_processor)
+
+        # When
+        a = Automator('sim', 'output', [EllipticalDrop])
+        a.run(['--parallel-post-process'])
+
+        # Then
+        self.assertIsInstance(a.runner.post_processor, PostProcessor)
+
     @mock.patch.object(TaskRunner, 'run')
     def test_automates_only_tasks(self, mock_run):
         # Given
@@ -1,12 +1,16 @@
 from __future__ import print_function
 
+from io import StringIO
 import json
 import os
 from os.path import dirname
 import shutil
+import subprocess
 import sys
 import tempfile
 from textwrap import dedent
+import threading
+import time
 import unittest
 
 try:
@@ -15,7 +19,7 @@ except ImportError:
     import mock
 
 from automan.jobs import Job
-from automan.cluster_manager import ClusterManager
+from automan.cluster_manager import BootstrapError, ClusterManager
 from automan.conda_cluster_manager import CondaClusterManager
 from automan.edm_cluster_manager import EDMClusterManager
 from .test_jobs import wait_until
@@ -110,6 +114,35 @@ class TestClusterManager(unittest.TestCase):
         hosts = sorted([x['host'] for x in confs])
         self.assertEqual(hosts, ['host', 'localhost'])
 
+        # When
+        cm.workers[-1].update(agent=True, copy_method='channel')
+        s = cm.create_scheduler()
+
+        # Then
+        conf = [x for x in s.worker_config if x['host'] == 'host'][0]
+        self.assertEqual(conf['agent'], True)
+        self.assertEqual(conf['copy_method'], 'channel')
+
+        # When
+        cm.copy_config = dict(max_active=2, bwlimit=1000)
+        cm._write_config()
+        s = ClusterManager().create_scheduler()
+
+        # Then
+        self.assertEqual(self._get_config()['copy'], cm.copy_config)
+        self.assertEqual(s.transfers.max_active, 2)
+        self.assertEqual(s.transfers.bwlimit, 1000)
+        self.assertEqual(s.speculative, None)
+
+        # When
+        cm.speculative = 2.0
+        cm._write_config()
+        s = ClusterManager().create_scheduler()
+
+        # Then
+        self.assertEqual(self._get_config()['speculative'], 2.0)
+        self.assertEqual(s.speculative, 2.0)
+
     @mock.patch.object(ClusterManager, '_bootstrap')
     @mock.patch.object(ClusterManager, '_update_sources')
     @mock.patch.object(ClusterManager, '_rebuild')
@@ -125,9 +158,252 @@ class TestClusterManager(unittest.TestCase):
         mock_update_sources.assert_called_with('host', '/home/foo')
         mock_rebuild.assert_called_with('host', '/home/foo')
 
-    @mock.patch.object(ClusterManager, 'add_worker')
+    @mock.patch.object(ClusterManager, '_bootstrap')
+    def test_add_workers_bootstraps_hosts_concurrently(self, mock_bootstrap):
+        # Given
+        cm = MyClusterManager()
+        cm.max_parallel = 2
+        threads = set()
+
+        def bootstrap(host, home):
+            threads.add(threading.current_thread().name)
+            time.sleep(0.1)
+            if host == 'bad':
+                raise BootstrapError('Bootstrapping of bad failed.')
+            cm._print('done')
+
+        mock_bootstrap.side_effect = bootstrap
+
+        # When
+        with mock.patch('sys.stdout', new_callable=StringIO) as out:
+            with self.assertRaises(BootstrapError):
+                cm.add_workers(['h1', 'bad', 'h2'], home='/home/foo',
+                               nfs=False)
+
+        # Then
+        self.assertEqual(mock_bootstrap.call_count, 3)
+        self.assertEqual(len(threads), 2)
+        hosts = sorted(x['host'] for x in self._get_config()['workers'])
+        self.assertEqual(hosts, ['bad', 'h1', 'h2', 'localhost'])
+        output = out.getvalue()
+        self.assertIn('[h1] done', output)
+        self.assertIn('Summary of bootstrap', output)
+        self.assertRegex(output, r'bad +FAILED: Bootstrapping of bad failed')
+        self.assertRegex(output, r'h2 +ok')
+
+    @mock.patch.object(ClusterManager, '_bootstrap')
+    @mock.patch.object(ClusterManager, '_update_sources')
+    @mock.patch.object(ClusterManager, '_rebuild')
+    def test_update_reports_failed_hosts(self, mock_rebuild,
+                                         mock_update_sources, mock_bootstrap):
+        # Given
+        cm = MyClusterManager()
+        cm.add_workers(['h1', 'h2'], home='/home/foo', nfs=False)
+
+        def rebuild(host, home):
+            if host == 'h2':
+                raise subprocess.CalledProcessError(1, 'update.sh')
+
+        mock_rebuild.side_effect = rebuild
+
+        # When
+        failed = cm.update()
+
+        # Then
+        self.assertEqual(failed, ['h2'])
+        self.assertEqual(mock_update_sources.call_count, 2)
+
+    @mock.patch.object(ClusterManager, '_rebuild')
+    def test_update_syncs_only_changed_sources(self, mock_rebuild):
+        # Given
+        cm = MyClusterManager(exclude_paths=['outputs/'])
+        cm.workers.append(dict(host='h1', home='/home/foo'))
+        with open('a.py', 'w') as fp:
+            fp.write('a = 1')
+        os.makedirs('outputs')
+        commands = []
+
+        def run_command(cmd, **kw):
+            files = None
+            if '--files-from=' in cmd:
+                fname = cmd.split('--files-from=')[1].split()[0]
+                with open(fname) as fp:
+                    files = fp.read().splitlines()
+            commands.append((cmd.split()[0], files))
+
+        # When
+        with mock.patch.object(cm, '_run_command', run_command):
+            cm.update()
+
+        # Then
+        self.assertEqual(commands, [('rsync', None), ('scp', None)])
+        self.assertTrue(os.path.exists(
+            os.path.join('.automan', 'sync_state.json')
+        ))
+
+        # When
+        commands = []
+        with open(os.path.join('outputs', 'x.txt'), 'w') as fp:
+            fp.write('x')
+        with mock.patch.object(cm, '_run_command', run_command):
+            cm.update()
+
+        # Then
+        self.assertEqual(commands, [])
+
+        # When
+        with open('b.py', 'w') as fp:
+            fp.write('b = 1')
+        with mock.patch.object(cm, '_run_command', run_command):
+            cm.update()
+
+        # Then
+        name = os.path.basename(self.proj_root)
+        self.assertEqual(commands, [('rsync', [os.path.join(name, 'b.py')])])
+
+    def test_scan_uses_git_to_skip_ignored_files(self):
+        # Given
+        cm = MyClusterManager(exclude_paths=['outputs/'])
+        subprocess.check_call(['git', 'init', '-q', self.proj_root])
+        with open('.gitignore', 'w') as fp:
+            fp.write('*.log\nbuild/\n')
+        for path in ('a.py', 'run.log', os.path.join('build', 'x.so'),
+                     os.path.join('outputs', 'y.txt'),
+                     os.path.join('src', 'b.py')):
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as fp:
+                fp.write('1')
+
+        # When
+        fingerprint, files = cm._do_scan_source(self.proj_root)
+
+        # Then
+        name = os.path.basename(self.proj_root)
+        self.assertEqual(sorted(files), [
+            os.path.join(name, x)
+            for x in ('.gitignore', 'a.py', 'config.json',
+                      os.path.join('src', 'b.py'))
+        ])
+
+        # When
+        shutil.rmtree(os.path.join(self.proj_root, '.git'))
+        fingerprint, files = cm._do_scan_source(self.proj_root)
+
+        # Then
+        self.assertIn(os.path.join(name, 'run.log'), files)
+        self.assertNotIn(os.path.join(name, 'outputs', 'y.txt'), files)
+
+    @unittest.skipIf((sys.version_info < (3, 3)) or
+                     sys.platform.startswith('win'),
+                     'Test requires Python 3.x and a non-Windows system.')
+    def test_rebuild_is_skipped_when_environment_is_unchanged(self):
+        # Given
+        cm = MyClusterManager(testing=True)
+        home = os.path.join(self.root, 'home')
+        remote = os.path.join(home, 'automan', cm.project_name)
+        os.makedirs(os.path.join(remote, '.automan'))
+        log = os.path.join(self.root, 'updates.txt')
+        script = os.path.join(remote, '.automan', 'update.sh')
+        with open(script, 'w') as fp:
+            fp.write('#!/bin/bash\necho updated >> %s\n' % log)
+        os.chmod(script, 0o755)
+
+        def n_updates():
+            with open(log) as fp:
+                return len(fp.readlines())
+
+        # When
+        cm._rebuild('host', home)
+        cm._rebuild('host', home)
+
+        # Then
+        self.assertEqual(n_updates(), 1)
+
+        # When
+        with open('requirements.txt', 'w') as fp:
+            fp.write('numpy\n')
+        cm._rebuild('host', home)
+        cm._rebuild('host', home)
+
+        # Then
+        self.assertEqual(n_updates(), 2)
+
+    @mock.patch.object(MyClusterManager, '_check_call')
+    def test_wheelhouse_is_built_once_per_requirements(self, mock_check_call):
+        # Given
+        cm = MyClusterManager(testing=True)
+        cm.use_wheelhouse = True
+        with open('requirements.txt', 'w') as fp:
+            fp.write('numpy\n')
+
+        # When
+        cm._build_wheelhouse()
+        cm._build_wheelhouse()
+
+        # Then
+        self.assertEqual(mock_check_call.call_count, 1)
+        cmd = mock_check_call.call_args[0][0]
+        self.assertEqual(cmd[1:4], ['-m', 'pip', 'wheel'])
+        self.assertIn('automan', cmd)
+        self.assertIn(os.path.abspath('requirements.txt'), cmd)
+
+        # When
+        with open('requirements.txt', 'w') as fp:
+            fp.write('numpy\nscipy\n')
+        cm._build_wheelhouse()
+
+        # Then
+        self.assertEqual(mock_check_call.call_count, 2)
+
+    @unittest.skipIf((sys.version_info < (3, 3)) or
+                     sys.platform.startswith('win'),
+                     'Test requires Python 3.x and a non-Windows system.')
+    @mock.patch.object(MyClusterManager, '_sync_wheelhouse')
+    def test_rebuild_installs_from_wheelhouse(self, mock_sync_wheelhouse):
+        # Given
+        cm = MyClusterManager(testing=True)
+        cm.use_wheelhouse = True
+        home = os.path.join(self.root, 'home')
+        remote = os.path.join(home, 'automan', cm.project_name)
+        os.makedirs(os.path.join(remote, '.automan'))
+        log = os.path.join(self.root, 'env.txt')
+        script = os.path.join(remote, '.automan', 'update.sh')
+        with open(script, 'w') as fp:
+            fp.write(
+                '#!/bin/bash\necho $PIP_NO_INDEX $PIP_FIND_LINKS > %s\n' % log
+            )
+        os.chmod(script, 0o755)
+
+        # When
+        cm._rebuild('host', home)
+
+        # Then
+        mock_sync_wheelhouse.assert_called_once_with('host', home)
+        with open(log) as fp:
+            self.assertEqual(
+                fp.read().split(),
+                ['1', os.path.join(home, 'automan', 'wheelhouse')]
+            )
+
+    def test_command_output_is_prefixed_with_host(self):
+        # Given
+        cm = ClusterManager(testing=True)
+
+        def run(host, home):
+            cm._ssh_run_command(host, 'echo hello')
+
+        # When
+        with mock.patch('sys.stdout', new_callable=StringIO) as out:
+            failed = cm._run_on_hosts('test', run, [dict(host='h1')])
+
+        # Then
+        self.assertEqual(failed, [])
+        self.assertIn('[h1] echo hello\n[h1] hello\n', out.getvalue())
+
+    @mock.patch.object(ClusterManager, 'add_workers')
     @mock.patch.object(ClusterManager, 'update')
-    def test_cli(self, mock_update, mock_add_worker):
+    def test_cli(self, mock_update, mock_add_workers):
         # Given
         cm = ClusterManager()
 
@@ -135,7 +411,13 @@ class TestClusterManager(unittest.TestCase):
         cm.cli(['-a', 'host', '--home', 'home', '--nfs'])
 
         # Then
-        mock_add_worker.assert_called_with('host', 'home', True)
+        mock_add_workers.assert_called_with(['host'], 'home', True)
+
+        # When
+        cm.cli(['-a', 'h1,h2', '--home', 'home'])
+
+        # Then
+        mock_add_workers.assert_called_with(['h1', 'h2'], 'home', False)
 
     @unittest.skipIf((sys.version_info < (3, 3)) or
                      sys.platform.startswith('win'),
@@ -279,6 +561,85 @@ class TestCondaClusterManager(unittest.TestCase):
 
         self.assertEqual(cm._get_helper_scripts(), '')
 
+    @unittest.skipIf((sys.version_info < (3, 3)) or
+                     sys.platform.startswith('win'),
+                     'Test requires Python 3.x and a non-Windows system.')
+    def test_packed_environment_is_built_once_and_unpacked_on_hosts(self):
+        # Given
+        log = os.path.join(self.root, 'packs.txt')
+
+        class MyCondaClusterManager(CondaClusterManager):
+            # Pack a fake environment instead of using conda.
+            PACK = dedent("""\
+                set -e
+                mkdir -p {pack_dir}/env/bin
+                echo 'touch $(dirname $0)/unpacked' > {pack_dir}/env/bin/c
+                mv {pack_dir}/env/bin/c {pack_dir}/env/bin/conda-unpack
+                chmod +x {pack_dir}/env/bin/conda-unpack
+                tar -czf {pack_dir}/{project_name}.tar.gz -C {pack_dir}/env .
+                echo packed >> LOG
+                """).replace('LOG', log)
+
+        cm = MyCondaClusterManager(testing=True)
+        cm.conda_pack = True
+        cm._get_script_files()
+        homes = [os.path.join(self.root, x) for x in ('h1', 'h2')]
+        for home in homes:
+            remote = os.path.join(home, 'automan', cm.project_name, '.automan')
+            os.makedirs(remote)
+            shutil.copy(os.path.join('.automan', 'update.sh'), remote)
+
+        # When
+        cm._prepare_env()
+        failed = cm._run_on_hosts('update', cm._rebuild, [
+            dict(host='h1', home=homes[0]), dict(host='h2', home=homes[1])
+        ])
+
+        # Then
+        self.assertEqual(failed, [])
+        with open(log) as fp:
+            self.assertEqual(fp.read().split(), ['packed'])
+        for home in homes:
+            python = cm._get_python('h', home)
+            self.assertEqual(python, os.path.join(
+                home, 'automan', 'envs', cm.project_name, 'bin', 'python'
+            ))
+            self.assertTrue(os.path.exists(
+                os.path.join(os.path.dirname(python), 'unpacked')
+            ))
+
+
+    def test_scripts_are_created_again_when_conda_pack_changes(self):
+        # Given
+        cm = CondaClusterManager()
+        cm._get_script_files()
+        bootstrap = os.path.join('.automan', 'bootstrap.sh')
+        with open(bootstrap, 'a') as fp:
+            fp.write('# edited\n')
+
+        # When
+        cm._get_script_files()
+
+        # Then
+        with open(bootstrap) as fp:
+            self.assertTrue('# edited' in fp.read())
+
+        # When
+        cm.conda_pack = True
+        cm._get_script_files()
+
+        # Then
+        for script in ('bootstrap.sh', 'update.sh'):
+            with open(os.path.join('.automan', script)) as fp:
+                self.assertEqual(fp.read(), cm._get_bootstrap_code())
+
+        # When
+        cm.conda_pack = False
+        cm._get_script_files()
+
+        # Then
+        with open(bootstrap) as fp:
+            self.assertEqual(fp.read(), cm._get_bootstrap_code())
 
 class TestEDMClusterManager(unittest.TestCase):
     def setUp(self):
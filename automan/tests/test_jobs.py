@@ -15,6 +15,7 @@ try:
     from automan import jobs
 except ImportError:
     raise unittest.SkipTest('test_jobs requires psutil')
+from automan.journal import Journal
 
 
 def safe_rmtree(*args, **kw):
@@ -60,6 +61,41 @@ class TestJob(unittest.TestCase):
         if os.path.exists(self.root):
             safe_rmtree(self.root)
 
+    def test_lazy_job_copies_back_info_files(self):
+        # Given
+        lazy = jobs.Job(['echo'], output_dir=self.root, lazy=True)
+        selected = jobs.Job(['echo'], output_dir=self.root, lazy=True,
+                            copy_include=['*.npz'])
+
+        # When/Then
+        self.assertEqual(lazy.copy_patterns(), (['*.info'], None))
+        self.assertEqual(selected.copy_patterns(), (['*.npz'], None))
+
+    @mock.patch.object(jobs, '_fetch_journal_mtime', None)
+    @mock.patch.object(jobs, '_fetch_journal', None)
+    @mock.patch.dict(jobs._fetch_misses, clear=True)
+    def test_fetch_file_remembers_misses_until_journal_changes(self):
+        # Given
+        journal = Journal()
+        jobs.set_fetch_journal(journal)
+        path = os.path.join(self.root, 'sim', 'big.hdf5')
+
+        # When
+        with mock.patch.object(jobs, '_fetch', return_value=False) as m:
+            jobs.fetch_file(path)
+            jobs.fetch_file(path)
+
+            # Then
+            self.assertEqual(m.call_count, 1)
+            self.assertIs(m.call_args[0][1], journal)
+
+            # When
+            journal.record(os.path.join(self.root, 'sim'), state='lazy')
+            jobs.fetch_file(path)
+
+            # Then
+            self.assertEqual(m.call_count, 2)
+
     def test_job_can_handle_string_command(self):
         # Given
         command = '''\
@@ -254,6 +290,28 @@ class TestJob(unittest.TestCase):
         # Then
         self.assertEqual(j.env.get('OMP_NUM_THREADS'), '4')
 
+    def test_retry_delay(self):
+        # Given
+        retry = dict(max_attempts=3, backoff=2, exitcodes=[1, 2])
+        j = jobs.Job([sys.executable, '-c', 'print(1)'],
+                     output_dir=self.root, retry=retry)
+
+        # When/Then
+        self.assertIsNone(j.retry_delay())
+        j.attempts.append(dict(host='h1', exitcode=1))
+        self.assertEqual(j.retry_delay(), 2)
+        j.attempts.append(dict(host='h2', exitcode=2))
+        self.assertEqual(j.retry_delay(), 4)
+        j.attempts.append(dict(host='h1', exitcode=1))
+        self.assertIsNone(j.retry_delay())
+
+        # Given
+        j.attempts = [dict(host='h1', exitcode=5)]
+
+        # When/Then
+        self.assertIsNone(j.retry_delay())
+        self.assertEqual(j.to_dict()['attempts'], j.attempts)
+
     def test_free_cores(self):
         n = jobs.free_cores()
         self.assertTrue(n >= 0)
@@ -402,7 +460,9 @@ class TestLocalWorker(unittest.TestCase):
     @mock.patch('automan.jobs.free_cores', return_value=2.0)
     def test_scheduler_works_with_local_worker(self, mock_free_cores):
         # Given
-        s = jobs.Scheduler(worker_config=[dict(host='localhost')])
+        s = jobs.Scheduler(
+            root=self.root, worker_config=[dict(host='localhost')]
+        )
 
         # When
         j = jobs.Job(
@@ -464,6 +524,148 @@ class TestRemoteWorker(unittest.TestCase):
         self.assertEqual(info['status'], 'done')
         self.assertEqual(info['exitcode'], 0)
 
+    def test_batched_and_pipelined_calls(self):
+        # Given
+        r = jobs.RemoteWorker(
+            host='localhost', python=sys.executable, testing=True
+        )
+        cmd = [sys.executable, '-c', 'import time; time.sleep(0.05); print(1)']
+        j1 = jobs.Job(cmd, output_dir=os.path.join(self.root, '1'))
+        j2 = jobs.Job(cmd, output_dir=os.path.join(self.root, '2'))
+
+        # When
+        p1, p2 = r.run(j1), r.run(j2)
+
+        # Then
+        self.assertEqual(r.running_jobs, set([p1.job_id, p2.job_id]))
+        wait_until(
+            lambda: r.status_many([p1.job_id, p2.job_id]) != ['done']*2
+        )
+        self.assertEqual(r.running_jobs, set())
+
+        # When
+        with mock.patch.object(r, '_call_remote') as m_call:
+            s1 = p1.status()
+
+        # Then
+        # The status was cached by the status_many call.
+        self.assertEqual(s1, 'done')
+        self.assertEqual(m_call.call_count, 0)
+
+        # When
+        with mock.patch.object(r, '_call_remote') as m_call:
+            statuses = [p1.status(), p2.status(), p1.status()]
+            many = r.status_many([p1.job_id, p2.job_id])
+
+        # Then
+        # The final status of finished jobs is not asked for again.
+        self.assertEqual(statuses, ['done']*3)
+        self.assertEqual(many, ['done']*2)
+        self.assertEqual(m_call.call_count, 0)
+
+        # When
+        out = r._call_remote_many([('get_stdout', (p1.job_id,)),
+                                   ('get_stdout', (p2.job_id,))])
+
+        # Then
+        self.assertEqual([x.strip() for x in out], ['1', '1'])
+
+        # When
+        with mock.patch.object(r, '_reconnect'):
+            with mock.patch.object(r.channel, 'send',
+                                   side_effect=IOError('closed')):
+                self.assertRaises(
+                    jobs.WorkerLostError, r._call_remote_many,
+                    [('get_stdout', (p1.job_id,))]
+                )
+
+        # Then
+        self.assertFalse(r.alive)
+        self.assertEqual(p1.status(), 'done')
+        self.assertRaises(jobs.WorkerLostError, r._call_remote_many,
+                          [('get_stdout', (p1.job_id,))])
+
+    def test_lost_worker_is_detected_and_reconnected(self):
+        # Given
+        r = jobs.RemoteWorker(
+            host='localhost', python=sys.executable, testing=True
+        )
+        r.heartbeat_interval = 0.0
+        r.reconnect_interval = 0.1
+        cmd = [sys.executable, '-c', 'import time; time.sleep(1)']
+        proxy = r.run(jobs.Job(cmd, output_dir=os.path.join(self.root, '1')))
+        self.assertEqual(proxy.status(), 'running')
+
+        # When
+        r.gw.remote_exec('import os; os._exit(1)')
+        wait_until(lambda: r.heartbeat(), timeout=5)
+
+        # Then
+        self.assertFalse(r.alive)
+        self.assertEqual(proxy.status(), 'lost')
+        self.assertEqual(r.status_many([proxy.job_id]), ['lost'])
+        self.assertEqual(r.running_jobs, set())
+        self.assertFalse(r.can_run(1))
+        self.assertRaises(jobs.WorkerLostError, r.get_info, proxy.job_id)
+        proxy.cancel()
+
+        # When
+        wait_until(lambda: not r.alive, timeout=10)
+        cmd = [sys.executable, '-c', 'print(1)']
+        p2 = r.run(jobs.Job(cmd, output_dir=os.path.join(self.root, '2')))
+
+        # Then
+        self.assertTrue(p2.job_id > proxy.job_id)
+        wait_until(lambda: p2.status() != 'done')
+        self.assertEqual(p2.get_stdout().strip(), '1')
+        self.assertEqual(proxy.status(), 'lost')
+
+    @mock.patch('automan.jobs.RsyncTransfer')
+    def test_outputs_are_copied_with_one_rsync(self, m_rsync):
+        # Given
+        r = jobs.RemoteWorker(
+            host='remote', python=sys.executable, testing=True,
+            chdir='work', copy_method='rsync'
+        )
+        r.testing = False
+        cmd = ['echo']
+        r.jobs[0] = jobs.Job(cmd, output_dir=os.path.join('out', '1'))
+        r.jobs[1] = jobs.Job(cmd, output_dir=os.path.join('out', '2') + '/')
+
+        # When
+        r.copy_outputs([0, 1], '.')
+
+        # Then
+        self.assertEqual(m_rsync.call_count, 1)
+        args, kw = m_rsync.call_args
+        self.assertEqual(args, ('remote:work/', '.'))
+        self.assertEqual(kw['files'], ['out/1', 'out/2'])
+
+    @mock.patch('automan.jobs.RsyncTransfer')
+    def test_selected_outputs_are_copied_with_rsync(self, m_rsync):
+        # Given
+        r = jobs.RemoteWorker(
+            host='remote', python=sys.executable, testing=True,
+            chdir='work', copy_method='rsync'
+        )
+        r.testing = False
+        r.jobs[0] = jobs.Job(
+            ['echo'], output_dir='out', copy_include=['*.npz'], lazy=True
+        )
+        listing = {'job_info.json': (1, 0), 'results.npz': (1, 0),
+                   'sim_0.hdf5': (1, 0)}
+
+        # When
+        with mock.patch.object(r, '_call_remote_many',
+                               return_value=[listing]):
+            r.copy_outputs([0], '.')
+
+        # Then
+        self.assertEqual(m_rsync.call_count, 1)
+        args, kw = m_rsync.call_args
+        self.assertEqual(args, ('remote:work/', '.'))
+        self.assertEqual(kw['files'], ['out/job_info.json', 'out/results.npz'])
+
     def test_remote_worker_does_not_copy_when_nfs_is_set(self):
         # Given
         r = jobs.RemoteWorker(
@@ -486,6 +688,87 @@ class TestRemoteWorker(unittest.TestCase):
         self.assertEqual(ret, None)
 
 
+class TestAgentWorker(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        try:
+            import execnet
+        except ImportError:
+            raise unittest.SkipTest('This test requires execnet')
+
+    def tearDown(self):
+        safe_rmtree(self.root)
+
+    def test_agent_runs_pushed_jobs(self):
+        # Given
+        r = jobs.AgentWorker(
+            host='localhost', python=sys.executable, testing=True,
+            queue_size=2, interval=0.05
+        )
+
+        # Then
+        self.assertEqual(r._credit, 2)
+        self.assertTrue(r.can_run(1))
+
+        # When
+        cmd = [sys.executable, '-c', 'import time; time.sleep(0.1); print(1)']
+        proxies = [
+            r.run(jobs.Job(cmd, output_dir=os.path.join(self.root, str(i))))
+            for i in range(2)
+        ]
+
+        # Then
+        self.assertFalse(r.can_run(1))
+        for proxy in proxies:
+            wait_until(lambda: proxy.status() != 'done', timeout=10)
+            self.assertEqual(proxy.status(), 'done')
+            self.assertEqual(proxy.get_stdout().strip(), '1')
+        self.assertEqual(r.running_jobs, set())
+        wait_until(lambda: not r.can_run(1), timeout=2)
+        self.assertTrue(r.can_run(1))
+
+    def test_job_is_lost_when_agent_connection_is_closed(self):
+        # Given
+        r = jobs.AgentWorker(
+            host='localhost', python=sys.executable, testing=True,
+            queue_size=2, interval=0.05
+        )
+        r.reconnect_interval = 100.0
+        r.channel.close()
+
+        # When
+        cmd = [sys.executable, '-c', 'print(1)']
+        proxy = r.run(jobs.Job(cmd, output_dir=os.path.join(self.root, '1')))
+
+        # Then
+        self.assertFalse(r.alive)
+        self.assertEqual(proxy.status(), 'lost')
+        self.assertEqual(r.running_jobs, set())
+
+        # When
+        p2 = r.run(jobs.Job(cmd, output_dir=os.path.join(self.root, '2')))
+
+        # Then
+        self.assertEqual(p2.status(), 'lost')
+
+    def test_scheduler_creates_agent_worker(self):
+        # Given
+        config = [dict(host='remote', python=sys.executable, testing=True,
+                       agent=True, queue_size=1, interval=0.05)]
+        s = jobs.Scheduler(root=self.root, worker_config=config)
+        j = jobs.Job([sys.executable, '-c', 'import sys; sys.exit(1)'],
+                     output_dir=os.path.join(self.root, 'job'))
+
+        # When
+        proxy = s.submit(j)
+
+        # Then
+        self.assertTrue(isinstance(proxy.worker, jobs.AgentWorker))
+        wait_until(lambda: proxy.status() != 'error', timeout=10)
+        self.assertEqual(proxy.status(), 'error')
+        self.assertEqual(proxy.get_info()['exitcode'], 1)
+
+
 class TestScheduler(unittest.TestCase):
     def setUp(self):
         self.root = tempfile.mkdtemp()
@@ -515,7 +798,7 @@ class TestScheduler(unittest.TestCase):
         config = [dict(host='localhost')]
 
         # When
-        s = jobs.Scheduler(worker_config=config)
+        s = jobs.Scheduler(root=self.root, worker_config=config)
 
         # Then
         self.assertEqual(mock_lw.call_count, 0)
@@ -523,12 +806,13 @@ class TestScheduler(unittest.TestCase):
 
     @mock.patch('automan.jobs.LocalWorker')
     def test_scheduler_starts_worker_on_submit(self, mock_lw):
-        attrs = {'host': 'localhost', 'free_cores.return_value': 2}
+        attrs = {'host': 'localhost', 'free_cores.return_value': 2,
+                 'run.return_value.job_id': 0}
         mock_lw.return_value = mock.MagicMock(**attrs)
 
         # Given
         config = [dict(host='localhost')]
-        s = jobs.Scheduler(worker_config=config)
+        s = jobs.Scheduler(root=self.root, worker_config=config)
         j = jobs.Job(
             [sys.executable, '-c', 'print(1)'],
             output_dir=self.root
@@ -541,6 +825,143 @@ class TestScheduler(unittest.TestCase):
         self.assertEqual(mock_lw.call_count, 1)
         self.assertEqual(len(s.workers), 1)
 
+    def test_start_workers_starts_all_and_excludes_failures(self):
+        # Given
+        config = [
+            dict(host='host1', python=sys.executable, testing=True),
+            dict(host='bad', python='/nonexistent/python', testing=True),
+            dict(host='localhost'),
+        ]
+        s = jobs.Scheduler(root=self.root, worker_config=config)
+
+        # When
+        s.start_workers(max_parallel=3)
+
+        # Then
+        self.assertEqual(
+            sorted(w.host for w in s.workers), ['host1', 'localhost']
+        )
+        self.assertEqual(len(s.failed_workers), 1)
+        self.assertEqual(s.failed_workers[0][0]['host'], 'bad')
+        self.assertEqual(
+            s.metrics.get('workers_failed_total', host='bad'), 1
+        )
+
+        # When
+        s.start_workers()
+        proxy = s.submit(self._make_dummy_job())
+
+        # Then
+        self.assertEqual(len(s.workers), 2)
+        self._wait_while_not_done(proxy, 15)
+        self.assertEqual(proxy.status(), 'done')
+
+    @mock.patch.object(jobs.RemoteWorker, 'free_cores', return_value=2.0)
+    def test_scheduler_reattaches_to_jobs_from_journal(self, m_free_cores):
+        # Given
+        config = [
+            dict(host='remote', python=sys.executable, testing=True),
+            dict(host='localhost'),
+        ]
+        journal = os.path.join(self.root, 'journal.json')
+        s = jobs.Scheduler(
+            root=self.root, worker_config=config, journal=journal
+        )
+        remote = self._make_dummy_job(sleep=1.0)
+        local = self._make_dummy_job(sleep=1.0)
+        p2 = s.submit(remote)
+        p1 = s.submit(local)
+        self.assertEqual(p2.worker.host, 'remote')
+        self.assertEqual(p1.worker.host, 'localhost')
+        for job in (local, remote):
+            wait_until(lambda: job.get_info().get('pid') is None)
+        s.flush()
+
+        # When
+        # A new scheduler is created as when the automation is restarted.
+        s = jobs.Scheduler(
+            root=self.root, worker_config=config, journal=journal
+        )
+        with mock.patch.object(jobs.Job, 'run') as m_run:
+            p1 = s.submit(jobs.Job(local.command, local.output_dir))
+            p2 = s.submit(jobs.Job(remote.command, remote.output_dir))
+
+        # Then
+        self.assertEqual(m_run.call_count, 0)
+        self.assertEqual(p1.worker.host, 'localhost')
+        self.assertEqual(p2.worker.host, 'remote')
+        self.assertEqual(
+            s.metrics.get('jobs_reattached_total', host='remote'), 1
+        )
+        self.assertEqual(p1.status(), 'running')
+        self._wait_while_not_done(p1, 15)
+        self._wait_while_not_done(p2, 15)
+        self.assertEqual(p1.status(), 'done')
+        self.assertEqual(p2.status(), 'done')
+        self.assertEqual(p2.get_stdout().strip(), '1')
+        s.poll()
+        entry = s._get_journal().get(remote.output_dir)
+        self.assertEqual(entry['state'], 'finished')
+
+        # When
+        s.release(p1)
+        s.release(p2)
+        s.flush()
+        s = jobs.Scheduler(
+            root=self.root, worker_config=config, journal=journal
+        )
+
+        # Then
+        self.assertEqual(s._get_journal().entries, {})
+        self.assertEqual(
+            s._reattach(jobs.Job(local.command, local.output_dir)), None
+        )
+
+    def test_scheduler_does_not_reattach_to_released_lazy_job(self):
+        # Given
+        config = [dict(host='remote', python=sys.executable, testing=True)]
+        s = jobs.Scheduler(root=self.root, worker_config=config)
+        job = self._make_dummy_job()
+        job.lazy = True
+        proxy = s.submit(job)
+        self._wait_while_not_done(proxy, 15)
+        s.release(proxy)
+        self.assertEqual(s.journal.get(job.output_dir)['state'], 'lazy')
+
+        # When
+        # The task is run again after its local output was removed.
+        p2 = s.submit(jobs.Job(job.command, job.output_dir, lazy=True))
+
+        # Then
+        self.assertNotEqual(p2.job_id, proxy.job_id)
+        self.assertIsNone(
+            s.metrics.get('jobs_reattached_total', host='remote')
+        )
+        self.assertEqual(s.journal.get(job.output_dir)['state'], 'running')
+        self._wait_while_not_done(p2, 15)
+        self.assertEqual(p2.status(), 'done')
+
+    def test_scheduler_skips_workers_that_fail_to_start(self):
+        # Given
+        config = [
+            dict(host='bad', python='/nonexistent/python', testing=True),
+            dict(host='localhost'),
+        ]
+        s = jobs.Scheduler(root=self.root, worker_config=config)
+
+        # When
+        proxy = s.submit(self._make_dummy_job())
+
+        # Then
+        self.assertEqual(proxy.worker.host, 'localhost')
+        self.assertEqual(len(s.failed_workers), 1)
+
+        # Given
+        s = jobs.Scheduler(root=self.root, worker_config=config[:1])
+
+        # When/Then
+        self.assertRaises(RuntimeError, s.submit, self._make_dummy_job())
+
     @mock.patch.object(jobs.RemoteWorker, 'free_cores', return_value=2.0)
     def test_scheduler_only_creates_required_workers(self, mock_remote_worker):
         # Given
@@ -548,7 +969,7 @@ class TestScheduler(unittest.TestCase):
             dict(host='host1', python=sys.executable, testing=True),
             dict(host='host2', python=sys.executable, testing=True),
         ]
-        s = jobs.Scheduler(worker_config=config)
+        s = jobs.Scheduler(root=self.root, worker_config=config)
         j = self._make_dummy_job()
 
         # When
@@ -603,7 +1024,9 @@ class TestScheduler(unittest.TestCase):
         # Given
         n_core = jobs.total_cores()
         config = [dict(host='localhost')]
-        s = jobs.Scheduler(worker_config=config, wait=0.5)
+        s = jobs.Scheduler(
+            root=self.root, worker_config=config, wait=0.5
+        )
 
         j1 = self._make_dummy_job(n_core, sleep=0.5)
         j2 = self._make_dummy_job(n_core, sleep=0.5)
@@ -632,6 +1055,54 @@ class TestScheduler(unittest.TestCase):
         self._wait_while_not_done(proxy4, 15)
         self.assertEqual(proxy4.status(), 'done')
 
+    @mock.patch('automan.jobs.total_cores', return_value=2.0)
+    @mock.patch('automan.jobs.free_cores', return_value=2.0)
+    @mock.patch.object(jobs.RemoteWorker, 'free_cores', return_value=2.0)
+    def test_scheduler_duplicates_straggler_jobs(self, m_r_free_cores,
+                                                 m_free_cores, m_total_cores):
+        # Given
+        other_dir = tempfile.mkdtemp()
+        self.addCleanup(safe_rmtree, other_dir)
+        config = [
+            dict(host='remote', python=sys.executable, chdir=other_dir,
+                 testing=True),
+            dict(host='localhost'),
+        ]
+        s = jobs.Scheduler(
+            root=self.root, worker_config=config, wait=0.1, speculative=2.0
+        )
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        self.addCleanup(os.chdir, cwd)
+        output = os.path.join('sim', 'job')
+        # The job is slow on the remote worker alone.
+        cmd = ('import os, time; '
+               'time.sleep(20 if os.getcwd() == %r else 0.1)' % other_dir)
+        j = jobs.Job([sys.executable, '-c', cmd], output_dir=output)
+        s._runtimes[s._runtime_key(j)] = [0.1, 0.1]
+
+        # When
+        proxy = s.submit(j)
+        remote = proxy.worker
+        wait_until(lambda: proxy.duplicate is None and s.poll() is None,
+                   timeout=5)
+
+        # Then
+        self.assertEqual(remote.host, 'remote')
+        self.assertIsNotNone(proxy.duplicate)
+        self.assertEqual(proxy.duplicate.worker.host, 'localhost')
+
+        # When
+        self._wait_while_not_done(proxy, 50)
+
+        # Then
+        self.assertEqual(proxy.status(), 'done')
+        self.assertEqual(proxy.worker.host, 'localhost')
+        self.assertIsNone(proxy.duplicate)
+        # The slow job is killed and its output removed.
+        self.assertEqual(remote.running_jobs, set())
+        self.assertFalse(os.path.exists(os.path.join(other_dir, output)))
+
     def _wait_while_not_done(self, proxy, n_count, sleep=0.1):
         count = 0
         while proxy.status() != 'done' and count < n_count:
@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from automan.journal import Journal
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.fname = os.path.join(self.root, '.automan', 'journal.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_entries_are_saved_and_loaded(self):
+        # Given
+        j = Journal(self.fname)
+
+        # When
+        j.record('out/sim/', host='remote', job_id=1, state='running')
+        j.record('out/sim', state='finished')
+        j.record('out/other', host='localhost', job_id=0)
+
+        # Then
+        with open(self.fname) as fp:
+            data = json.load(fp)
+        self.assertEqual(len(data), 2)
+
+        # When
+        j1 = Journal(self.fname)
+
+        # Then
+        self.assertEqual(
+            j1.get('out/sim'),
+            dict(output_dir='out/sim/', host='remote', job_id=1,
+                 state='finished')
+        )
+
+        # When
+        j1.remove('out/sim')
+        j1.remove('out/missing')
+
+        # Then
+        self.assertEqual(j1.get('out/sim'), None)
+        self.assertEqual(list(Journal(self.fname).entries), ['out/other'])
+
+    def test_saves_are_batched_within_the_interval(self):
+        # Given
+        j = Journal(self.fname, interval=60.0)
+
+        # When
+        j.record('out/a', state='running')
+        j.record('out/b', state='running')
+        j.remove('out/a')
+
+        # Then
+        self.assertEqual(list(Journal(self.fname).entries), ['out/a'])
+
+        # When
+        j.flush()
+
+        # Then
+        self.assertEqual(list(Journal(self.fname).entries), ['out/b'])
+
+    def test_journal_without_a_file_is_kept_in_memory(self):
+        # Given
+        j = Journal()
+
+        # When
+        j.record('out/a', state='running')
+        j.flush()
+
+        # Then
+        self.assertEqual(j.get('out/a')['state'], 'running')
+        self.assertFalse(os.path.exists(os.path.dirname(self.fname)))
+
+    def test_corrupt_journal_is_ignored(self):
+        # Given
+        os.makedirs(os.path.dirname(self.fname))
+        with open(self.fname, 'w') as fp:
+            fp.write('{"junk')
+
+        # When
+        j = Journal(self.fname)
+
+        # Then
+        self.assertEqual(j.entries, {})
@@ -0,0 +1,140 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from automan.metrics import Histogram, Metrics
+from automan import jobs
+from .test_jobs import wait_until
+
+
+def test_histogram_counts_are_cumulative():
+    # Given
+    h = Histogram(buckets=(1, 10))
+
+    # When
+    h.observe(0.5)
+    h.observe(5)
+    h.observe(50)
+
+    # Then
+    assert h.counts == [1, 2]
+    assert h.count == 3
+    assert h.sum == 55.5
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_counters_gauges_and_histograms(self):
+        # Given
+        m = Metrics(output_dir=self.root)
+
+        # When
+        m.inc('jobs_submitted_total', host='h1')
+        m.inc('jobs_submitted_total', host='h1')
+        m.set('worker_cores_total', 4, host='h1')
+        m.observe('job_runtime_seconds', 2.0, host='h1')
+        m.mark_submission()
+
+        # Then
+        self.assertEqual(m.get('jobs_submitted_total', host='h1'), 2)
+        self.assertEqual(m.get('worker_cores_total', host='h1'), 4)
+        self.assertIsNone(m.get('worker_cores_total', host='h2'))
+        text = m.to_prometheus()
+        self.assertIn('# TYPE automan_jobs_submitted_total counter', text)
+        self.assertIn('automan_jobs_submitted_total{host="h1"} 2', text)
+        self.assertIn(
+            'automan_job_runtime_seconds_bucket{host="h1",le="5"} 1', text
+        )
+        self.assertIn(
+            'automan_job_runtime_seconds_bucket{host="h1",le="+Inf"} 1', text
+        )
+        self.assertIn('automan_job_runtime_seconds_count{host="h1"} 1', text)
+        self.assertIn('automan_submissions_per_minute 1', text)
+
+    def test_write_creates_json_and_prometheus_files(self):
+        # Given
+        out = os.path.join(self.root, '.automan')
+        m = Metrics(output_dir=out, interval=100)
+        m.inc('jobs_submitted_total', host='h1')
+
+        # When
+        m.maybe_write()
+
+        # Then
+        with open(os.path.join(out, 'metrics.json')) as fp:
+            data = json.load(fp)
+        counter = data['counters']['jobs_submitted_total'][0]
+        self.assertEqual(counter, dict(labels=dict(host='h1'), value=1))
+        self.assertTrue(os.path.exists(os.path.join(out, 'metrics.prom')))
+
+        # When
+        os.remove(os.path.join(out, 'metrics.prom'))
+        m.maybe_write()
+
+        # Then
+        self.assertFalse(os.path.exists(os.path.join(out, 'metrics.prom')))
+
+    def test_metrics_without_output_dir_are_not_written(self):
+        # Given
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        m = Metrics()
+        m.inc('jobs_submitted_total', host='h1')
+
+        # When
+        try:
+            m.write()
+        finally:
+            os.chdir(cwd)
+
+        # Then
+        self.assertEqual(os.listdir(self.root), [])
+
+
+class TestSchedulerMetrics(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    @mock.patch('automan.jobs.free_cores', return_value=2.0)
+    def test_scheduler_records_metrics(self, mock_free_cores):
+        # Given
+        out = os.path.join(self.root, '.automan')
+        s = jobs.Scheduler(
+            root=self.root, worker_config=[dict(host='localhost')],
+            metrics_dir=out
+        )
+        j = jobs.Job(
+            [sys.executable, '-c', 'print(1)'],
+            output_dir=os.path.join(self.root, 'job')
+        )
+
+        # When
+        proxy = s.submit(j)
+        wait_until(lambda: proxy.status() != 'done', timeout=2)
+        s.poll()
+
+        # Then
+        m = s.metrics
+        self.assertEqual(m.get('jobs_submitted_total', host='localhost'), 1)
+        self.assertEqual(
+            m.get('jobs_finished_total', host='localhost', status='done'), 1
+        )
+        self.assertEqual(m.get('worker_running_jobs', host='localhost'), 0)
+        self.assertEqual(m.get('worker_cores_reserved', host='localhost'), 0)
+        self.assertTrue(os.path.exists(os.path.join(out, 'metrics.prom')))
@@ -0,0 +1,229 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from automan.automation import Simulation
+from automan.results import (
+    Results, ResultsCache, ResultsStore, load_many, save_results
+)
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestResults(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_npy_results_are_memory_mapped(self):
+        # Given
+        save_results(self.root, x=np.arange(10.0), y=np.ones(3))
+        results = Results(os.path.join(self.root, 'results'),
+                          cache=ResultsCache())
+
+        # When
+        x = results['x']
+
+        # Then
+        self.assertEqual(sorted(results), ['x', 'y'])
+        self.assertIn('y', results)
+        self.assertIsInstance(x, np.memmap)
+        np.testing.assert_array_equal(x, np.arange(10.0))
+        self.assertIs(results['x'], x)
+        self.assertRaises(KeyError, lambda: results['z'])
+
+    def test_npz_results_are_loaded_lazily_and_reloaded_when_changed(self):
+        # Given
+        fname = os.path.join(self.root, 'results.npz')
+        np.savez(fname, x=np.arange(5), y=np.zeros(2))
+        cache = ResultsCache()
+        results = Results(fname, cache=cache)
+
+        # When
+        x = results['x']
+
+        # Then
+        self.assertEqual(results.files, ['x', 'y'])
+        self.assertEqual(len(cache), 1)
+
+        # When
+        x[0] = 10
+
+        # Then
+        self.assertEqual(results['x'][0], 0)
+
+        # When
+        np.savez(fname, x=np.arange(6), y=np.zeros(2))
+        os.utime(fname, (time.time() + 10, time.time() + 10))
+
+        # Then
+        self.assertEqual(len(results['x']), 6)
+
+    def test_cache_evicts_least_recently_used_across_results(self):
+        # Given
+        cache = ResultsCache(max_bytes=200)
+        all_results = []
+        for i in range(3):
+            path = os.path.join(self.root, 'sim%d' % i)
+            save_results(path, x=np.zeros(10))
+            all_results.append(Results(os.path.join(path, 'results'), cache))
+
+        # When
+        all_results[0]['x']
+        all_results[1]['x']
+        all_results[0]['x']
+        all_results[2]['x']
+
+        # Then
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.n_bytes, 200)
+        keys = [k[0] for k in cache._data]
+        self.assertEqual(keys, [
+            os.path.join(self.root, 'sim%d' % i, 'results', 'x.npy')
+            for i in (0, 2)
+        ])
+
+    def test_simulation_data_prefers_npy_results(self):
+        # Given
+        s = Simulation(self.root, 'echo')
+        np.savez(os.path.join(self.root, 'results.npz'), x=np.zeros(2))
+        save_results(self.root, x=np.ones(2))
+
+        # When
+        x = s.data['x']
+
+        # Then
+        np.testing.assert_array_equal(x, np.ones(2))
+        self.assertIs(s.data, s.data)
+
+    @mock.patch('automan.automation.fetch_file')
+    def test_simulation_data_looks_for_local_results_first(self, m_fetch):
+        # Given
+        s = Simulation(self.root, 'echo')
+        np.savez(os.path.join(self.root, 'results.npz'), x=np.zeros(2))
+
+        # When
+        x = s.data['x']
+
+        # Then
+        np.testing.assert_array_equal(x, np.zeros(2))
+        self.assertFalse(m_fetch.called)
+
+    def test_store_saves_are_batched(self):
+        # Given
+        sims = []
+        for i in range(3):
+            s = Simulation(os.path.join(self.root, str(i)), 'echo', n=i)
+            save_results(s.root, x=np.ones(2) * i)
+            sims.append(s)
+        fname = os.path.join(self.root, 'store.npz')
+        store = ResultsStore(fname, interval=60.0)
+
+        # When
+        with mock.patch.object(ResultsStore, '_save',
+                               wraps=store._save) as mock_save:
+            for sim in sims:
+                self.assertTrue(store.update([sim]))
+
+            # Then
+            self.assertEqual(mock_save.call_count, 1)
+
+            # When
+            store.flush()
+            store.flush()
+
+            # Then
+            self.assertEqual(mock_save.call_count, 2)
+        self.assertEqual(ResultsStore(fname).names, ['0', '1', '2'])
+
+    def test_load_many_stacks_arrays_of_the_same_shape(self):
+        # Given
+        sims = []
+        for i in range(4):
+            s = Simulation(os.path.join(self.root, str(i)), 'echo')
+            save_results(s.root, x=np.arange(5) * i)
+            sims.append(s)
+
+        # When
+        x = load_many(sims, 'x')
+        part = load_many(sims, 'x', index=slice(1, 3))
+
+        # Then
+        self.assertEqual(x.shape, (4, 5))
+        np.testing.assert_array_equal(x[2], np.arange(5) * 2)
+        self.assertNotIsInstance(part, np.memmap)
+        np.testing.assert_array_equal(part[:, 0], [0, 1, 2, 3])
+        self.assertEqual(part.shape, (4, 2))
+
+    def test_load_many_returns_dict_when_shapes_differ(self):
+        # Given
+        sims = []
+        for i in range(1, 3):
+            s = Simulation(os.path.join(self.root, str(i)), 'echo')
+            os.makedirs(s.root)
+            np.savez(s.input_path('results.npz'), x=np.ones(i))
+            sims.append(s)
+
+        # When
+        x = load_many(sims, 'x', max_workers=2)
+
+        # Then
+        self.assertEqual(sorted(x), ['1', '2'])
+        np.testing.assert_array_equal(x['2'], np.ones(2))
+
+    def test_store_is_updated_incrementally_and_reloaded(self):
+        # Given
+        sims = []
+        for i in range(1, 4):
+            s = Simulation(os.path.join(self.root, str(i)), 'echo',
+                           n=i, scheme='a' if i < 3 else None,
+                           sizes=[i, 2*i], dt=np.float64(0.1))
+            save_results(s.root, x=np.ones(i), t=np.array(i * 0.5))
+            sims.append(s)
+        fname = os.path.join(self.root, 'store.npz')
+        store = ResultsStore(fname)
+
+        # When
+        changed = store.update(sims[:2])
+
+        # Then
+        self.assertTrue(changed)
+        self.assertEqual(store.names, ['1', '2'])
+        self.assertEqual(store.keys(), ['t', 'x'])
+
+        # When
+        store.update(sims)
+        save_results(sims[0].root, t=np.array(10.0))
+        os.utime(os.path.join(sims[0].root, 'results', 't.npy'),
+                 (time.time() + 10, time.time() + 10))
+        with mock.patch.object(ResultsStore, '_save') as mock_save:
+            store.update(sims[1:])
+        self.assertFalse(mock_save.called)
+        store.update(sims)
+        store = ResultsStore(fname)
+
+        # Then
+        self.assertEqual(store.names, ['1', '2', '3'])
+        np.testing.assert_array_equal(store['t'], [10.0, 1.0, 1.5])
+        np.testing.assert_array_equal(store.column('n'), [1, 2, 3])
+        self.assertEqual(list(store.column('scheme')), ['a', 'a', None])
+        self.assertEqual(
+            store.params('3'), dict(n=3, scheme=None, sizes=[3, 6], dt=0.1)
+        )
+        x = store['x']
+        self.assertEqual(sorted(x), ['1', '2', '3'])
+        np.testing.assert_array_equal(x['3'], np.ones(3))
+        np.testing.assert_array_equal(store.get('x', '2'), np.ones(2))
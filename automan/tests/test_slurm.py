@@ -0,0 +1,182 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from automan import jobs
+from automan.cluster_manager import ClusterManager
+from automan.slurm import SlurmWorker, _format_time
+from .test_jobs import safe_rmtree, wait_until
+
+
+def test_format_time():
+    assert _format_time(59) == '0-00:00:59'
+    assert _format_time(3661) == '0-01:01:01'
+    assert _format_time(2*86400 + 60) == '2-00:01:00'
+
+
+@unittest.skipIf(sys.platform.startswith('win'),
+                 'The fake SLURM commands require a POSIX system.')
+class TestSlurmWorker(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        os.chdir(self.root)
+        patch = mock.patch.dict(
+            os.environ,
+            {'AUTOMAN_FAKE_SLURM_DIR': os.path.join(self.root, 'state')}
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        safe_rmtree(self.root)
+
+    def _make_worker(self):
+        return SlurmWorker(testing=True, poll_interval=0.1, max_jobs=2)
+
+    def _wait_while_running(self, proxy, timeout=10):
+        wait_until(lambda: proxy.status() == 'running', timeout=timeout)
+
+    def test_batch_script_has_resource_requests(self):
+        # Given
+        w = SlurmWorker(partition='compute', cores_per_node=8)
+        job = jobs.Job(['python', '-c', 'print(1)'], output_dir='out',
+                       n_core=-2, memory='4G', timeout=90)
+
+        # When
+        script = w._make_script(job, 'out/batch_job.json')
+
+        # Then
+        self.assertIn('#SBATCH --cpus-per-task=4', script)
+        self.assertIn('#SBATCH --partition=compute', script)
+        self.assertIn('#SBATCH --mem=4G', script)
+        self.assertIn('#SBATCH --time=0-00:01:30', script)
+        self.assertIn('-m automan.slurm out/batch_job.json', script)
+
+    def test_batch_script_quotes_paths(self):
+        # Given
+        w = SlurmWorker()
+        w.chdir = '/tmp/my project; rm -rf x'
+        job = jobs.Job(['python', '-c', 'print(1)'], output_dir='out')
+
+        # When
+        script = w._make_script(job, 'out dir/batch_job.json')
+
+        # Then
+        self.assertIn("cd '/tmp/my project; rm -rf x'\n", script)
+        self.assertIn("-m automan.slurm 'out dir/batch_job.json'", script)
+
+    def test_simple_job(self):
+        # Given
+        w = self._make_worker()
+        job = jobs.Job([sys.executable, '-c', 'print(1)'], output_dir='out')
+
+        # When
+        proxy = w.run(job)
+        self._wait_while_running(proxy)
+
+        # Then
+        self.assertEqual(proxy.status(), 'done')
+        self.assertEqual(proxy.get_stdout().strip(), '1')
+        info = proxy.get_info()
+        self.assertEqual(info['status'], 'done')
+        self.assertEqual(info['exitcode'], 0)
+        self.assertEqual(w.running_jobs, set())
+
+    def test_failed_and_cancelled_jobs_are_errors(self):
+        # Given
+        w = self._make_worker()
+        bad = jobs.Job([sys.executable, '--junk'], output_dir='bad')
+
+        # When
+        proxy = w.run(bad)
+        self._wait_while_running(proxy)
+
+        # Then
+        self.assertEqual(proxy.status(), 'error')
+
+        # Given
+        cmd = [sys.executable, '-c', 'import time; time.sleep(20)']
+        slow1 = jobs.Job(cmd, output_dir='slow1')
+        slow2 = jobs.Job(cmd, output_dir='slow2')
+
+        # When
+        p1 = w.run(slow1)
+        p2 = w.run(slow2)
+
+        # Then
+        self.assertFalse(w.can_run(1))
+
+        # When
+        time.sleep(0.2)
+        w.kill(p1.job_id)
+        w.kill(p2.job_id)
+
+        # Then
+        self._wait_while_running(p1)
+        self.assertEqual(p1.status(), 'error')
+        self.assertEqual(p2.status(), 'error')
+        self.assertTrue(w.can_run(1))
+
+    def test_scheduler_creates_slurm_worker(self):
+        # Given
+        config = [dict(host='cluster', type='slurm', testing=True,
+                       poll_interval=0.1)]
+        s = jobs.Scheduler(root=self.root, worker_config=config)
+        job = jobs.Job([sys.executable, '-c', 'print(1)'], output_dir='out')
+
+        # When
+        proxy = s.submit(job)
+        self._wait_while_running(proxy)
+
+        # Then
+        self.assertTrue(isinstance(proxy.worker, SlurmWorker))
+        self.assertEqual(proxy.status(), 'done')
+
+    @mock.patch.object(ClusterManager, '_update_sources')
+    @mock.patch.object(ClusterManager, '_rebuild')
+    def test_cluster_manager_creates_slurm_worker(self, mock_rebuild,
+                                                  mock_update_sources):
+        # Given
+        cm = ClusterManager(testing=True)
+        cm.workers.append(dict(
+            host='cluster', type='slurm', partition='compute', max_jobs=5,
+            poll_interval=0.1
+        ))
+        cm._write_config()
+        cm = ClusterManager(testing=True)
+
+        # When
+        failed = cm.update()
+        s = cm.create_scheduler()
+
+        # Then
+        self.assertEqual(failed, [])
+        self.assertEqual(mock_update_sources.call_count, 0)
+        self.assertEqual(mock_rebuild.call_count, 0)
+        conf = [x for x in s.worker_config if x['host'] == 'cluster'][0]
+        self.assertEqual(conf, dict(
+            host='cluster', type='slurm', partition='compute', max_jobs=5,
+            poll_interval=0.1, testing=True
+        ))
+
+        # When
+        with mock.patch('automan.jobs.free_cores', return_value=0.0):
+            proxy = s.submit(
+                jobs.Job([sys.executable, '-c', 'print(1)'], output_dir='out')
+            )
+        self._wait_while_running(proxy)
+
+        # Then
+        self.assertTrue(isinstance(proxy.worker, SlurmWorker))
+        self.assertEqual(proxy.worker.partition, 'compute')
+        self.assertEqual(proxy.worker.max_jobs, 5)
+        self.assertEqual(proxy.status(), 'done')
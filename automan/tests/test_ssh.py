@@ -0,0 +1,87 @@
+import os
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from automan import ssh
+from automan.cluster_manager import ClusterManager
+
+
+class TestSSH(unittest.TestCase):
+    def tearDown(self):
+        ssh.close_connections()
+
+    @mock.patch('automan.ssh.MULTIPLEX', True)
+    def test_connections_share_a_control_path(self):
+        # When
+        options = ssh.ssh_options()
+
+        # Then
+        self.assertIn('ControlMaster=auto', options)
+        paths = [x for x in options if x.startswith('ControlPath=')]
+        self.assertEqual(len(paths), 1)
+        control_dir = os.path.dirname(paths[0][len('ControlPath='):])
+        self.assertTrue(os.path.isdir(control_dir))
+        self.assertEqual(ssh.ssh_options(), options)
+        self.assertEqual(ssh.ssh_command(), ' '.join(['ssh'] + options))
+
+        # When
+        # A stale socket must not stop the cleanup.
+        open(os.path.join(control_dir, 'socket'), 'w').close()
+        ssh.close_connections()
+
+        # Then
+        self.assertFalse(os.path.exists(control_dir))
+
+    @mock.patch('automan.ssh.MULTIPLEX', True)
+    def test_control_path_fits_in_a_socket_path(self):
+        # When
+        options = ssh.ssh_options()
+
+        # Then
+        path = [x for x in options if x.startswith('ControlPath=')][0]
+        control_dir = os.path.dirname(path[len('ControlPath='):])
+        self.assertTrue(os.path.basename(control_dir).startswith('am-'))
+        self.assertLess(len(control_dir) + 1 + 40 + 17, ssh.MAX_SOCKET_PATH)
+
+    @mock.patch('automan.ssh.MULTIPLEX', True)
+    @mock.patch('automan.ssh.MAX_SOCKET_PATH', 20)
+    def test_multiplexing_is_not_used_if_socket_path_is_too_long(self):
+        # When
+        with mock.patch('tempfile.mkdtemp', wraps=ssh.tempfile.mkdtemp) as m:
+            options = ssh.ssh_options()
+            command = ssh.ssh_command()
+
+        # Then
+        self.assertEqual(options, [])
+        self.assertEqual(command, 'ssh')
+        # The directory is only tried once.
+        self.assertEqual(m.call_count, 1)
+
+    @mock.patch('automan.ssh.MULTIPLEX', False)
+    def test_multiplexing_can_be_disabled(self):
+        self.assertEqual(ssh.ssh_options(), [])
+        self.assertEqual(ssh.ssh_command(), 'ssh')
+
+    @mock.patch('automan.ssh.MULTIPLEX', True)
+    @mock.patch.object(ClusterManager, '_check_call')
+    def test_cluster_manager_commands_use_shared_connection(self,
+                                                            mock_check_call):
+        # Given
+        cm = ClusterManager.__new__(ClusterManager)
+        cm.testing = False
+        cm._local = mock.Mock(host=None)
+
+        # When
+        cm._ssh_run_command('host', 'ls')
+
+        # Then
+        cmd = mock_check_call.call_args[0][0]
+        self.assertEqual(cmd[0], 'ssh')
+        self.assertEqual(cmd[1:-2], ssh.ssh_options())
+        self.assertEqual(cmd[-2:], ['host', 'ls'])
+        self.assertEqual(cm._scp_command().split()[1:], ssh.ssh_options())
+        self.assertIn(ssh.ssh_command(), cm._rsync_command())
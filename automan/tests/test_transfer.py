@@ -0,0 +1,382 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from automan.transfer import (
+    ChannelTransfer, PARTIAL_SUFFIX, RsyncTransfer, Transfer,
+    TransferManager, is_selected, list_files
+)
+from .test_jobs import safe_rmtree
+
+
+def _write(path, data):
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+
+
+def _read(path):
+    with open(path, 'rb') as fp:
+        return fp.read()
+
+
+def test_rsync_command():
+    # When
+    cmd = RsyncTransfer.make_command('host:out/sim', 'out', bwlimit=100)
+
+    # Then
+    assert cmd == ['rsync', '-az', '--partial', '--bwlimit=100',
+                   'host:out/sim', 'out']
+
+    # When
+    cmd = RsyncTransfer.make_command('host:work/', '.', files=['a', 'b'])
+
+    # Then
+    assert cmd == ['rsync', '-az', '--partial', '-r', '--files-from=-',
+                   'host:work/', '.']
+
+
+def test_is_selected():
+    # Given
+    include = ['results.npz', '*.info']
+    exclude = ['*.hdf5']
+
+    # Then
+    assert is_selected('a.hdf5')
+    assert is_selected('a.hdf5', include=None, exclude=[]) is True
+    assert is_selected('results.npz', include)
+    assert is_selected('sim.info', include)
+    assert is_selected('sub/sim.info', include)
+    assert not is_selected('sim_100.hdf5', include)
+    assert not is_selected('sim_100.hdf5', exclude=exclude)
+    assert is_selected('sim.log', exclude=exclude)
+    assert not is_selected('sim.log', include=[])
+    # The files written by automan are always copied.
+    assert is_selected('job_info.json', include=[], exclude=['*'])
+    assert is_selected('stdout.txt', include=[])
+
+
+class FakeTransfer(Transfer):
+    def poll(self):
+        return self.returncode
+
+
+class FakeWorker(object):
+    host = 'fake'
+
+    def __init__(self, result=FakeTransfer):
+        self.calls = []
+        self.result = result
+
+    def copy_outputs(self, job_ids, dest, bwlimit=None):
+        self.calls.append((list(job_ids), dest))
+        transfer = self.result()
+        if transfer is not None:
+            transfer.bwlimit = bwlimit
+        return transfer
+
+
+class TestTransferManager(unittest.TestCase):
+    def test_requests_are_batched_per_worker(self):
+        # Given
+        m = TransferManager(batch_window=0.2)
+        w1, w2 = FakeWorker(), FakeWorker()
+
+        # When
+        r1 = m.request(w1, 1, '.')
+        r2 = m.request(w1, 2, '.')
+        r3 = m.request(w2, 1, '.')
+
+        # Then
+        self.assertEqual(r1.poll(), None)
+        self.assertEqual(w1.calls, [])
+
+        # When
+        time.sleep(0.25)
+
+        # Then
+        self.assertEqual(r1.poll(), None)
+        self.assertEqual(w1.calls, [([1, 2], '.')])
+        self.assertEqual(w2.calls, [([1], '.')])
+
+        # When
+        transfer = m._active[0][0]
+        transfer.returncode = 0
+
+        # Then
+        self.assertEqual(r1.poll(), 0)
+        self.assertEqual(r2.poll(), 0)
+        self.assertEqual(r3.poll(), None)
+
+    def test_full_batch_starts_at_once(self):
+        # Given
+        m = TransferManager(batch_window=100, max_batch=2)
+        w = FakeWorker(result=lambda: None)
+
+        # When
+        r1 = m.request(w, 1, '.')
+        r2 = m.request(w, 2, '.')
+
+        # Then
+        self.assertEqual(w.calls, [([1, 2], '.')])
+        self.assertEqual(r1.poll(), 0)
+        self.assertEqual(r2.wait(), 0)
+
+    def test_concurrency_is_limited(self):
+        # Given
+        m = TransferManager(batch_window=0, max_active=2, max_per_host=1,
+                            bwlimit=1000)
+        w1, w2, w3 = FakeWorker(), FakeWorker(), FakeWorker()
+        w3.host = 'other'
+
+        # When
+        r1 = m.request(w1, 1, '.')
+        r2 = m.request(w2, 1, '.')
+        r3 = m.request(w3, 1, '.')
+        m.update()
+
+        # Then
+        # Only one transfer from the host 'fake' at a time.
+        self.assertEqual(len(w1.calls), 1)
+        self.assertEqual(w2.calls, [])
+        self.assertEqual(len(w3.calls), 1)
+        self.assertEqual([x[2] for x in m._active], [[r1], [r3]])
+        # The bandwidth is shared by the active transfers.
+        self.assertEqual(m._active[0][0].bwlimit, 500)
+
+        # When
+        m._active[0][0].returncode = 0
+        m.update()
+
+        # Then
+        self.assertEqual(r1.poll(), 0)
+        self.assertEqual(len(w2.calls), 1)
+        self.assertEqual(r2.poll(), None)
+
+    def test_higher_priority_is_copied_first(self):
+        # Given
+        m = TransferManager(batch_window=100, max_active=1)
+        w1, w2, w3 = FakeWorker(), FakeWorker(), FakeWorker()
+
+        # When
+        m.request(w1, 1, '.')
+        m.request(w2, 1, '.', priority=1)
+        r3 = m.request(w3, 1, '.')
+        m.update()
+
+        # Then
+        # The batch with a priority does not wait for the window.
+        self.assertEqual(w1.calls, [])
+        self.assertEqual(len(w2.calls), 1)
+
+        # When
+        r3.priority = 2
+        m._active[0][0].returncode = 0
+        m.update()
+
+        # Then
+        self.assertEqual(w1.calls, [])
+        self.assertEqual(len(w3.calls), 1)
+
+    def test_failure_to_start_fails_requests(self):
+        # Given
+        m = TransferManager(batch_window=0)
+
+        def fail():
+            raise IOError('no connection')
+
+        # When
+        r = m.request(FakeWorker(result=fail), 1, '.')
+
+        # Then
+        self.assertEqual(r.wait(), 1)
+
+
+@unittest.skipIf(sys.platform.startswith('win'),
+                 'This test requires a POSIX system.')
+class TestRsyncTransfer(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        safe_rmtree(self.root)
+
+    def test_transfer_is_verified(self):
+        # Given
+        dest = os.path.join(self.root, 'dest')
+
+        # When
+        # The 'true' command stands in for rsync.
+        t = RsyncTransfer('src', dest, verify=lambda: True, rsync='true')
+
+        # Then
+        self.assertEqual(t.wait(), 0)
+        self.assertTrue(os.path.isdir(dest))
+
+        # When
+        t = RsyncTransfer('src', dest, verify=lambda: False, rsync='true')
+
+        # Then
+        self.assertEqual(t.wait(), 1)
+
+        # When
+        t = RsyncTransfer('src', dest, verify=lambda: True, rsync='false')
+
+        # Then
+        self.assertEqual(t.wait(), 1)
+
+
+class TestChannelTransfer(unittest.TestCase):
+    def setUp(self):
+        try:
+            import execnet
+        except ImportError:
+            raise unittest.SkipTest('This test requires execnet')
+        self.root = tempfile.mkdtemp()
+        self.src = os.path.join(self.root, 'src')
+        self.dest = os.path.join(self.root, 'dest')
+        _write(os.path.join(self.src, 'a.txt'), b'a'*10)
+        _write(os.path.join(self.src, 'sub', 'b.dat'), b'b'*100000)
+        os.makedirs(os.path.join(self.src, 'empty'))
+        self.gw = execnet.makegateway(
+            'popen//python={python}'.format(python=sys.executable)
+        )
+
+    def tearDown(self):
+        self.gw.exit()
+        safe_rmtree(self.root)
+
+    def test_copies_directory(self):
+        # When
+        t = ChannelTransfer(self.gw, self.src, self.dest)
+
+        # Then
+        self.assertEqual(t.wait(), 0)
+        self.assertEqual(list_files(self.src), list_files(self.dest))
+        self.assertTrue(os.path.isdir(os.path.join(self.dest, 'empty')))
+
+    def test_skips_copied_files_and_resumes_partial_ones(self):
+        # Given
+        self.assertEqual(ChannelTransfer(self.gw, self.src, self.dest).wait(),
+                         0)
+        a = os.path.join(self.dest, 'a.txt')
+        b = os.path.join(self.dest, 'sub', 'b.dat')
+        # Same size and time as the source so it should not be copied.
+        st = os.stat(a)
+        _write(a, b'x'*10)
+        os.utime(a, (st.st_mtime, st.st_mtime))
+        os.remove(b)
+        _write(b + PARTIAL_SUFFIX, b'b'*5000)
+
+        # When
+        t = ChannelTransfer(self.gw, self.src, self.dest)
+
+        # Then
+        self.assertEqual(t.wait(), 0)
+        self.assertEqual(_read(a), b'x'*10)
+        self.assertEqual(_read(b), b'b'*100000)
+        self.assertFalse(os.path.exists(b + PARTIAL_SUFFIX))
+
+    def test_corrupt_partial_file_fails_checksum(self):
+        # Given
+        b = os.path.join(self.dest, 'sub', 'b.dat')
+        _write(b + PARTIAL_SUFFIX, b'c'*5000)
+
+        # When
+        t = ChannelTransfer(self.gw, self.src, self.dest)
+
+        # Then
+        self.assertEqual(t.wait(), 1)
+        self.assertFalse(os.path.exists(b))
+        self.assertFalse(os.path.exists(b + PARTIAL_SUFFIX))
+
+        # When
+        t = ChannelTransfer(self.gw, self.src, self.dest, compress=False)
+
+        # Then
+        self.assertEqual(t.wait(), 0)
+        self.assertEqual(list_files(self.src), list_files(self.dest))
+        self.assertEqual(_read(b), b'b'*100000)
+
+    def test_copies_many_directories(self):
+        # Given
+        other = os.path.join(self.root, 'other')
+        _write(os.path.join(other, 'c.txt'), b'c')
+        dests = [os.path.join(self.dest, 'src'), os.path.join(self.dest, 'o')]
+
+        # When
+        t = ChannelTransfer(self.gw, [self.src, other], dests)
+
+        # Then
+        self.assertEqual(t.wait(), 0)
+        self.assertEqual(list_files(self.src), list_files(dests[0]))
+        self.assertEqual(list_files(other), list_files(dests[1]))
+
+    def test_copies_selected_files(self):
+        # When
+        t = ChannelTransfer(self.gw, self.src, self.dest, include=['*.dat'])
+
+        # Then
+        self.assertEqual(t.wait(), 0)
+        self.assertEqual(list(list_files(self.dest)), ['sub/b.dat'])
+
+        # When
+        t = ChannelTransfer(self.gw, self.src, self.dest, exclude=['sub/*'])
+
+        # Then
+        self.assertEqual(t.wait(), 0)
+        self.assertEqual(sorted(list_files(self.dest)),
+                         ['a.txt', 'sub/b.dat'])
+
+    def test_bandwidth_is_limited(self):
+        # When
+        start = time.time()
+        t = ChannelTransfer(self.gw, self.src, self.dest, bwlimit=200,
+                            compress=False)
+
+        # Then
+        self.assertEqual(t.wait(), 0)
+        # About 100 KB at 200 KiB/s.
+        self.assertTrue(time.time() - start > 0.4)
+        self.assertEqual(list_files(self.src), list_files(self.dest))
+
+    @mock.patch('automan.transfer.WINDOW', 1)
+    def test_chunks_in_flight_are_limited(self):
+        # Given
+        # Several chunks of random data that does not compress.
+        data = os.urandom(3*(1 << 20) + 10)
+        _write(os.path.join(self.src, 'big.dat'), data)
+
+        # When
+        t = ChannelTransfer(self.gw, self.src, self.dest)
+
+        # Then
+        self.assertEqual(t.wait(), 0)
+        self.assertEqual(_read(os.path.join(self.dest, 'big.dat')), data)
+
+    def test_data_outside_a_file_is_a_protocol_error(self):
+        # Given
+        channel = mock.Mock()
+        channel.receive.side_effect = [('dir', '.'), b'junk']
+        t = ChannelTransfer.__new__(ChannelTransfer)
+
+        # When/Then
+        with self.assertRaisesRegex(IOError, 'Protocol error'):
+            t._receive(channel, self.dest)
+
+    def test_missing_directory_fails(self):
+        # When
+        t = ChannelTransfer(self.gw, os.path.join(self.root, 'junk'),
+                            self.dest)
+
+        # Then
+        self.assertEqual(t.wait(), 1)
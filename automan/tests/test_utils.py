@@ -1,7 +1,7 @@
 from unittest import mock
-from automan.automation import Simulation
-from automan.utils import (compare_runs, dprod, filter_cases, mdict,
-                           opts2path)
+from automan.automation import Problem, Simulation
+from automan.utils import (CaseSet, compare_runs, dprod, filter_by_name,
+                           filter_cases, mdict, opts2path)
 
 
 def test_compare_runs_calls_methods_when_given_names():
@@ -153,6 +153,94 @@ def test_filter_cases_works_with_predicate():
     assert result[0].params['predicate'] == 2
 
 
+def test_filter_by_name_keeps_order_of_names():
+    # Given
+    sims = [Simulation(root=str(i), base_command='python') for i in range(5)]
+
+    # When
+    result = filter_by_name(sims, ['3', '1', '7', '3'])
+
+    # Then
+    assert [x.name for x in result] == ['3', '1']
+    assert [x.name for x in filter_by_name(sims, '2')] == ['2']
+    assert filter_by_name(CaseSet(sims), ['3', '1']) == result
+
+
+def test_case_set_matches_filter_cases():
+    # Given
+    sims = [Simulation(root=str(i), base_command='python', param1=i % 3,
+                       param2=i % 2, scheme=[i % 2])
+            for i in range(12)]
+    sims.append(Simulation(root='x', base_command='python', param2=0))
+    cases = CaseSet(sims)
+
+    # When/Then
+    for kw in (dict(param1=2), dict(param1=1, param2=0), dict(param2=0),
+               dict(param1=5), dict(scheme=[1]), dict(param1=0, scheme=[0]),
+               dict(predicate=lambda x: x.params.get('param1') == 1)):
+        expected = filter_cases(sims, **kw)
+        assert list(cases.filter(**kw)) == expected
+        assert filter_cases(cases, **kw) == expected
+    assert len(cases.filter()) == len(sims)
+
+
+def test_case_set_range_groupby_and_names():
+    # Given
+    sims = [Simulation(root=str(i), base_command='python', dt=0.1 * i,
+                       scheme='abc'[i % 3])
+            for i in range(10)]
+    cases = CaseSet(reversed(sims))
+
+    # When
+    result = cases.filter_range('dt', 0.15, 0.45)
+
+    # Then
+    assert isinstance(result, CaseSet)
+    assert [x.name for x in result] == ['4', '3', '2']
+    assert len(cases.filter_range('dt', high=0.25)) == 3
+    assert len(cases.filter_range('scheme', low='b')) == 6
+
+    # When
+    groups = cases.groupby('scheme')
+
+    # Then
+    assert list(groups) == [('a',), ('c',), ('b',)]
+    assert [x.name for x in groups[('a',)]] == ['9', '6', '3', '0']
+    assert cases.values('scheme') == ['a', 'c', 'b']
+
+    # When/Then
+    assert cases.get('4') is sims[4]
+    assert cases.get('42') is None
+    assert [x.name for x in cases.by_name(['1', '8'])] == ['1', '8']
+    assert [x.name for x in cases[:2]] == ['9', '8']
+
+
+def test_problem_case_set_follows_cases():
+    # Given
+    class A(Problem):
+        def setup(self):
+            self.cases = [
+                Simulation(self.input_path(str(i)), 'python', n=i)
+                for i in range(3)
+            ]
+
+    problem = A('sim', 'out')
+
+    # When
+    case_set = problem.case_set
+
+    # Then
+    assert problem.case_set is case_set
+    assert case_set.get('1') is problem.cases[1]
+
+    # When
+    problem.cases.append(Simulation(problem.input_path('3'), 'python', n=3))
+
+    # Then
+    assert len(problem.case_set) == 4
+    assert len(problem.case_set.filter(n=3)) == 1
+
+
 def test_mdict():
     exp = [{'a': 1, 'b': 'x'},
            {'a': 1, 'b': 'y'},
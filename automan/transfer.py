@@ -0,0 +1,567 @@
+"""Copying the output of jobs back from remote workers.
+
+A transfer runs in the background and, like a `subprocess.Popen` instance,
+has `poll` and `wait` methods and a `returncode` that is None while the
+transfer is in progress, zero once all the files have been copied and
+verified and non-zero if the transfer failed.
+
+Two kinds of transfers are provided:
+
+- `RsyncTransfer` uses ``rsync`` with compression and keeps partially copied
+  files so an interrupted copy is resumed. Once rsync is done, the copied
+  files are verified against a listing of the files on the remote host.
+
+- `ChannelTransfer` is a pure Python fallback which copies the files over a
+  dedicated channel of an existing execnet gateway, so no separate ssh login
+  is needed. The files are streamed in compressed chunks and checked with a
+  SHA-256 checksum once copied. Files that are already present with the same
+  size and modification time are skipped and partially copied files are
+  resumed. The receiver acknowledges every chunk and at most `WINDOW` chunks
+  are in flight, so a slow receiver does not pile up data in memory.
+
+Both can copy several directories in one go. The `TransferManager` uses this
+to collect the outputs of the jobs that finish on a host within a short
+window into a single transfer.
+
+The files that are copied may be selected with shell-style include and
+exclude patterns, see `is_selected`.
+
+"""
+from __future__ import print_function
+
+from collections import defaultdict
+from fnmatch import fnmatch
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
+import time
+import zlib
+
+
+# Size of the chunks in which files are sent over a channel.
+CHUNK_SIZE = 1 << 20
+
+# Maximum number of chunks sent over a channel that the receiver has not yet
+# acknowledged.
+WINDOW = 8
+
+# Suffix of files that are still being copied by a `ChannelTransfer`.
+PARTIAL_SUFFIX = '.automan-partial'
+
+# zlib compression level of the chunks sent by a `ChannelTransfer`.
+COMPRESS_LEVEL = 1
+
+# Files with these extensions are already compressed and are sent as is.
+COMPRESSED_EXTENSIONS = (
+    '.gz', '.bz2', '.xz', '.zip', '.zst', '.png', '.jpg', '.jpeg', '.mp4'
+)
+
+# Files written by automan in the output directory of every job, these are
+# always copied as the status of the job is read from them.
+ALWAYS_COPY = ('job_info.json', 'stdout.txt', 'stderr.txt')
+
+
+def list_files(path):
+    """Return a dictionary mapping the path of each file inside the given
+    directory, relative to it, to a tuple of (size, mtime).
+    """
+    result = dict()
+    for root, dirs, files in os.walk(path):
+        for fname in files:
+            full = os.path.join(root, fname)
+            st = os.stat(full)
+            rel = os.path.relpath(full, path)
+            result[rel] = (st.st_size, int(st.st_mtime))
+    return result
+
+
+def _matches(rel, patterns):
+    name = os.path.basename(rel)
+    return any(fnmatch(rel, p) or fnmatch(name, p) for p in patterns)
+
+
+def is_selected(rel, include=None, exclude=None):
+    """Return True if the file with the given path relative to the output
+    directory is to be copied.
+
+    A file is selected if it matches any of the `include` patterns, or if
+    `include` is None, and none of the `exclude` patterns. The patterns are
+    shell-style wildcards matched against the relative path and the name of
+    the file. The files in `ALWAYS_COPY` are always selected.
+    """
+    if rel in ALWAYS_COPY:
+        return True
+    if include is not None and not _matches(rel, include):
+        return False
+    return not _matches(rel, exclude or ())
+
+
+def _hash_prefix(fp, n_bytes, digest):
+    """Update the digest with the first `n_bytes` of the open file.
+    """
+    fp.seek(0)
+    while n_bytes > 0:
+        data = fp.read(min(CHUNK_SIZE, n_bytes))
+        if not data:
+            break
+        digest.update(data)
+        n_bytes -= len(data)
+
+
+def find_rsync():
+    """Return the path to the rsync executable or None if it is not found.
+    """
+    return shutil.which('rsync')
+
+
+class Transfer(object):
+    """Base class for the transfers.
+    """
+    def __init__(self):
+        self.returncode = None
+
+    def poll(self):
+        """Return None while the transfer is in progress and the return code
+        once it is done.
+        """
+        raise NotImplementedError()
+
+    def wait(self, interval=0.1):
+        while self.poll() is None:
+            time.sleep(interval)
+        return self.returncode
+
+
+class TransferGroup(Transfer):
+    """A transfer made of several transfers that is done when all of them
+    are done and fails if any of them fails.
+    """
+    def __init__(self, transfers):
+        super(TransferGroup, self).__init__()
+        self.transfers = list(transfers)
+
+    def poll(self):
+        if self.returncode is None:
+            codes = [x.poll() for x in self.transfers]
+            if None not in codes:
+                self.returncode = max(codes + [0])
+        return self.returncode
+
+
+class RsyncTransfer(Transfer):
+    def __init__(self, src, dest, verify=None, bwlimit=None, rsync='rsync',
+                 options=(), files=None):
+        """Constructor.
+
+        **Parameters**
+
+        src: str
+            Source of the copy in a form understood by rsync, for example
+            ``host:path``.
+        dest: str
+            Local directory to copy into.
+        verify: callable
+            Called without arguments once rsync succeeds, should return True
+            if the copied files are correct.
+        bwlimit: int
+            Bandwidth limit in KiB per second.
+        rsync: str
+            The rsync executable.
+        options: sequence
+            Additional options to pass to rsync.
+        files: sequence
+            If given, only these paths inside `src` are copied into `dest`,
+            keeping their path relative to `src`.
+        """
+        super(RsyncTransfer, self).__init__()
+        self.verify = verify
+        self.command = self.make_command(
+            src, dest, bwlimit, rsync, options, files
+        )
+        if not os.path.exists(dest):
+            os.makedirs(dest)
+        print("\n" + " ".join(self.command))
+        if files is None:
+            self.proc = subprocess.Popen(self.command)
+        else:
+            self.proc = subprocess.Popen(self.command, stdin=subprocess.PIPE)
+            self.proc.stdin.write('\n'.join(files).encode())
+            self.proc.stdin.close()
+
+    @staticmethod
+    def make_command(src, dest, bwlimit=None, rsync='rsync', options=(),
+                     files=None):
+        cmd = [rsync, '-az', '--partial']
+        if bwlimit:
+            cmd.append('--bwlimit=%d' % bwlimit)
+        if files is not None:
+            cmd.extend(['-r', '--files-from=-'])
+        cmd.extend(options)
+        cmd.extend([src, dest])
+        return cmd
+
+    def poll(self):
+        if self.returncode is None:
+            code = self.proc.poll()
+            if code == 0 and self.verify is not None and not self.verify():
+                print("\nVerification of %s failed." % ' '.join(self.command))
+                code = 1
+            self.returncode = code
+        return self.returncode
+
+
+class ChannelTransfer(Transfer):
+    """Copy remote directories over a dedicated channel of an execnet gateway
+    in a background thread.
+    """
+
+    SERVE_CODE = "from automan import transfer; transfer.serve_files(channel)"
+
+    def __init__(self, gateway, src, dest, include=None, exclude=None,
+                 bwlimit=None, compress=True):
+        """Constructor.
+
+        **Parameters**
+
+        gateway: execnet.Gateway
+            Gateway to the remote host.
+        src: str or list
+            Path of the directory on the remote host or a list of these.
+        dest: str or list
+            Local directory that the contents of `src` are copied into or a
+            list of these, one for each source.
+        include: list
+            Patterns of the files to copy, see `is_selected`.
+        exclude: list
+            Patterns of the files not to copy, see `is_selected`.
+        bwlimit: int
+            Bandwidth limit in KiB per second.
+        compress: bool
+            Compress the files that are not already compressed.
+        """
+        super(ChannelTransfer, self).__init__()
+        self.gateway = gateway
+        if isinstance(src, str):
+            src, dest = [src], [dest]
+        self.items = list(zip(src, dest))
+        self.include = None if include is None else list(include)
+        self.exclude = list(exclude or ())
+        self.bwlimit = bwlimit
+        self.compress = compress
+        for s, d in self.items:
+            print("\nCopying %s into %s" % (s, d))
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _local_state(self, dest):
+        have, partial = dict(), dict()
+        if os.path.isdir(dest):
+            for rel, info in list_files(dest).items():
+                if rel.endswith(PARTIAL_SUFFIX):
+                    partial[rel[:-len(PARTIAL_SUFFIX)]] = info[0]
+                else:
+                    have[rel] = info
+        return have, partial
+
+    def _receive(self, channel, dest):
+        fp = None
+        n_bytes = 0
+        rel = size = mtime = partial = digest = None
+        compressed = False
+        while True:
+            msg = channel.receive()
+            if isinstance(msg, bytes):
+                if fp is None:
+                    raise IOError('Protocol error: data received outside a '
+                                  'file from %s' % dest)
+                if compressed:
+                    msg = zlib.decompress(msg)
+                digest.update(msg)
+                fp.write(msg)
+                n_bytes += len(msg)
+                # Let the sender send another chunk.
+                channel.send(1)
+                continue
+            kind = msg[0]
+            if kind == 'dir':
+                path = os.path.join(dest, msg[1])
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+            elif kind == 'file':
+                rel, size, mtime, offset, compressed = msg[1:]
+                path = os.path.join(dest, rel)
+                partial = path + PARTIAL_SUFFIX
+                fp = open(partial, 'r+b' if offset else 'wb')
+                fp.truncate(offset)
+                digest = hashlib.sha256()
+                _hash_prefix(fp, offset, digest)
+                fp.seek(offset)
+                n_bytes = offset
+            elif kind == 'end':
+                if fp is None:
+                    raise IOError('Protocol error: end of a file that was '
+                                  'not started in %s' % dest)
+                fp.close()
+                fp = None
+                if n_bytes != size:
+                    raise IOError(
+                        'Copied %d of %d bytes of %s' % (n_bytes, size, rel)
+                    )
+                if msg[2] != digest.hexdigest():
+                    # Do not resume from a corrupt partial file.
+                    os.remove(partial)
+                    raise IOError('Checksum of %s does not match' % rel)
+                os.replace(partial, path)
+                os.utime(path, (mtime, mtime))
+            elif kind == 'error':
+                raise IOError(msg[1])
+            elif kind == 'done':
+                break
+
+    def _run(self):
+        try:
+            state = [(s,) + self._local_state(d) for s, d in self.items]
+            channel = self.gateway.remote_exec(self.SERVE_CODE)
+            channel.send(dict(
+                items=state, include=self.include, exclude=self.exclude,
+                bwlimit=self.bwlimit, compress=self.compress, window=WINDOW
+            ))
+            for s, d in self.items:
+                self._receive(channel, d)
+            channel.close()
+            code = 0
+        except Exception as e:
+            print("\nCopying %s failed: %s" % (
+                ', '.join(x[0] for x in self.items), e
+            ))
+            code = 1
+        self.returncode = code
+
+    def poll(self):
+        return self.returncode
+
+
+class _Request(Transfer):
+    def __init__(self, manager, job_id, priority=0):
+        super(_Request, self).__init__()
+        self.manager = manager
+        self.job_id = job_id
+        # Requests with a higher priority are copied first and those with a
+        # positive priority do not wait for the batching window.
+        self.priority = priority
+
+    def poll(self):
+        if self.returncode is None:
+            self.manager.update()
+        return self.returncode
+
+
+class TransferManager(object):
+    """Collects the requests to copy the output of jobs and copies the
+    outputs of all the jobs of a worker requested within `batch_window`
+    seconds of each other in one transfer.
+
+    At most `max_active` transfers are in progress at any time, and at most
+    `max_per_host` of these from the same host. The batches that are ready
+    are started in the order of the highest priority of their requests and
+    then in the order they were requested.
+
+    The workers must have a ``copy_outputs(job_ids, dest, bwlimit=None)``
+    method that starts a single `Transfer` for all the given jobs or returns
+    None if nothing needs to be copied.
+    """
+    def __init__(self, batch_window=2.0, max_batch=100, max_active=4,
+                 max_per_host=2, bwlimit=None):
+        """Constructor.
+
+        **Parameters**
+
+        batch_window: float
+            Time in seconds to wait for more requests for a worker before
+            starting the transfer.
+        max_batch: int
+            Maximum number of jobs in one transfer.
+        max_active: int
+            Maximum number of transfers in progress.
+        max_per_host: int
+            Maximum number of transfers in progress from the same host.
+        bwlimit: int
+            Limit in KiB per second on the total bandwidth used by the
+            transfers, it is shared equally by `max_active` transfers.
+        """
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_active = max_active
+        self.max_per_host = max_per_host
+        self.bwlimit = bwlimit
+        # Pending requests keyed on (worker, dest).
+        self._pending = defaultdict(list)
+        self._pending_since = dict()
+        # List of (transfer, host, requests) in progress.
+        self._active = []
+
+    # #### Private protocol ###########################################
+
+    def _is_ready(self, key, now):
+        requests = self._pending[key]
+        return (now - self._pending_since[key] >= self.batch_window or
+                len(requests) >= self.max_batch or
+                any(x.priority > 0 for x in requests))
+
+    def _start_ready(self):
+        now = time.time()
+        ready = [key for key in self._pending if self._is_ready(key, now)]
+        ready.sort(key=lambda key: (
+            -max(x.priority for x in self._pending[key]),
+            self._pending_since[key]
+        ))
+        for key in ready:
+            if len(self._active) >= self.max_active:
+                break
+            host = key[0].host
+            n_host = sum(1 for x in self._active if x[1] == host)
+            if n_host < self.max_per_host:
+                self._start(key)
+
+    def _start(self, key):
+        worker, dest = key
+        pending = sorted(self._pending.pop(key), key=lambda x: -x.priority)
+        requests = pending[:self.max_batch]
+        if len(pending) > len(requests):
+            self._pending[key] = pending[len(requests):]
+        else:
+            del self._pending_since[key]
+        bwlimit = None
+        if self.bwlimit:
+            bwlimit = max(self.bwlimit // self.max_active, 1)
+        try:
+            transfer = worker.copy_outputs(
+                [x.job_id for x in requests], dest, bwlimit=bwlimit
+            )
+        except Exception as e:
+            print("\nUnable to copy output from %s: %s" % (worker.host, e))
+            transfer, code = None, 1
+        else:
+            code = 0
+        if transfer is None:
+            for request in requests:
+                request.returncode = code
+        else:
+            self._active.append((transfer, worker.host, requests))
+
+    # #### Public protocol ###########################################
+
+    def request(self, worker, job_id, dest, priority=0):
+        """Request a copy of the output of the given job on the worker into
+        `dest` and return a `Transfer` for it.
+
+        The `priority` of the returned request may be changed until the
+        transfer starts.
+        """
+        key = (worker, dest)
+        request = _Request(self, job_id, priority)
+        if key not in self._pending_since:
+            self._pending_since[key] = time.time()
+        self._pending[key].append(request)
+        if len(self._pending[key]) >= self.max_batch:
+            self._start_ready()
+        return request
+
+    def update(self):
+        """Update the requests of the finished transfers and start the
+        transfers that are ready if there is capacity for them.
+        """
+        for item in list(self._active):
+            transfer, host, requests = item
+            code = transfer.poll()
+            if code is not None:
+                self._active.remove(item)
+                for request in requests:
+                    request.returncode = code
+        self._start_ready()
+
+
+def serve_files(channel):  # pragma: no cover
+    """Send the files requested by a `ChannelTransfer` over the channel.
+
+    The first message is a dictionary with the keys `items`, `include`,
+    `exclude`, `bwlimit`, `compress` and `window`. The items are a list of
+    tuples of (path, have, partial) where `have` maps the relative paths of
+    the files in the directory `path` that are already copied to their (size,
+    mtime) and `partial` maps those partially copied to the number of bytes
+    copied. Only the files selected by the `include` and `exclude` patterns
+    are sent.
+
+    The files of each directory are sent in turn, each followed by a
+    ``('done',)`` message. Every file is sent as a ``('file', rel, size,
+    mtime, offset, compressed)`` message, the chunks of its contents from
+    `offset`, compressed with zlib if `compressed` is True, and an ``('end',
+    rel, sha256)`` message with the checksum of the whole file. If `bwlimit`
+    is given, the files are sent at no more than that many KiB per second.
+
+    If `window` is given, the receiver sends a message for every chunk that
+    it has written and no more than `window` chunks are sent before these
+    are received. All of these are received before each ``('done',)``.
+    """
+    request = channel.receive()
+    include, exclude = request['include'], request['exclude']
+    bwlimit = request['bwlimit']
+    window = request.get('window')
+    in_flight = 0
+    chunk_size = CHUNK_SIZE
+    if bwlimit:
+        rate = bwlimit*1024.0
+        chunk_size = int(max(min(CHUNK_SIZE, rate/4), 1024))
+    start, sent = time.time(), 0
+    for path, have, partial in request['items']:
+        if not os.path.isdir(path):
+            channel.send(('error', 'No such directory: %s' % path))
+            return
+        for root, dirs, files in os.walk(path):
+            channel.send(('dir', os.path.relpath(root, path)))
+            for fname in files:
+                full = os.path.join(root, fname)
+                rel = os.path.relpath(full, path)
+                if not is_selected(rel, include, exclude):
+                    continue
+                st = os.stat(full)
+                size, mtime = st.st_size, int(st.st_mtime)
+                if tuple(have.get(rel, ())) == (size, mtime):
+                    continue
+                offset = partial.get(rel, 0)
+                if offset > size:
+                    offset = 0
+                compress = request['compress'] and \
+                    not fname.lower().endswith(COMPRESSED_EXTENSIONS)
+                channel.send(('file', rel, size, mtime, offset, compress))
+                digest = hashlib.sha256()
+                with open(full, 'rb') as fp:
+                    _hash_prefix(fp, offset, digest)
+                    fp.seek(offset)
+                    while True:
+                        data = fp.read(chunk_size)
+                        if not data:
+                            break
+                        digest.update(data)
+                        if compress:
+                            data = zlib.compress(data, COMPRESS_LEVEL)
+                        if window:
+                            while in_flight >= window:
+                                channel.receive()
+                                in_flight -= 1
+                            in_flight += 1
+                        channel.send(data)
+                        if bwlimit:
+                            sent += len(data)
+                            delay = sent/rate - (time.time() - start)
+                            if delay > 0:
+                                time.sleep(delay)
+                channel.send(('end', rel, digest.hexdigest()))
+        # The receiver must not be left sending to a closed channel.
+        while in_flight > 0:
+            channel.receive()
+            in_flight -= 1
+        channel.send(('done',))
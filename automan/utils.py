@@ -1,6 +1,8 @@
 """Utility functions for automation scripts.
 """
+import bisect
 import collections
+from collections.abc import Iterable, Sequence
 import itertools as IT
 
 
@@ -69,7 +71,7 @@ def compare_runs(sims, method, labels, exact=None, styles=styles):
         Defaults to the ``styles`` function defined in this module.
     """
     ls = styles(sims)
-    if isinstance(ls, collections.abc.Iterable):
+    if isinstance(ls, Iterable):
         ls = iter(ls)
     if exact is not None:
         if isinstance(exact, str):
@@ -94,6 +96,8 @@ def filter_cases(runs, predicate=None, **params):
     If `predicate` is passed though, the other keyword arguments are ignored.
 
     """
+    if isinstance(runs, CaseSet):
+        return list(runs.filter(predicate, **params))
     if predicate is not None:
         if callable(predicate):
             return list(filter(predicate, runs))
@@ -115,12 +119,186 @@ def filter_by_name(cases, names):
     """
     if isinstance(names, str):
         names = [names]
+    if isinstance(cases, CaseSet):
+        return list(cases.by_name(names))
+    order = dict()
+    for i, name in enumerate(names):
+        order.setdefault(name, i)
     return sorted(
-        [x for x in cases if x.name in names],
-        key=lambda x: names.index(x.name)
+        [x for x in cases if x.name in order],
+        key=lambda x: order[x.name]
     )
 
 
+class CaseSet(Sequence):
+    """An immutable sequence of Simulations with indexes on their names and
+    parameters, for fast repeated filtering of a large number of cases.
+
+    It may be used wherever a list of cases is used, including with
+    `filter_cases` and `filter_by_name` which then use its indexes. The
+    indexes on a parameter are built when it is first queried.
+
+    **Example**
+
+    >>> cases = CaseSet(problem.cases)
+    >>> cases.filter(re=100, scheme='tvf')
+    >>> cases.filter_range('dt', 1e-4, 1e-3)
+    >>> for (re,), group in cases.groupby('re').items():
+    ...     compare_runs(group, 'plot', labels=['scheme'])
+    >>> cases.by_name(['1', '4'])
+
+    """
+    def __init__(self, cases):
+        self._cases = list(cases)
+        # Maps the name of each case to its positions.
+        self._names = collections.defaultdict(list)
+        for i, case in enumerate(self._cases):
+            self._names[case.name].append(i)
+        # Maps each parameter to a dict mapping each value to the positions
+        # of the cases with that value.
+        self._index = dict()
+        # Positions of the cases with unhashable values of each parameter.
+        self._unhashable = dict()
+        # Sorted (value, position) of each parameter for range queries.
+        self._sorted = dict()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return CaseSet(self._cases[i])
+        return self._cases[i]
+
+    def __len__(self):
+        return len(self._cases)
+
+    def __repr__(self):
+        return 'CaseSet(%r)' % self._cases
+
+    # #### Private protocol ###########################################
+
+    def _get_index(self, param):
+        if param not in self._index:
+            index = collections.defaultdict(list)
+            unhashable = []
+            for i, case in enumerate(self._cases):
+                if param not in case.params:
+                    continue
+                try:
+                    index[case.params[param]].append(i)
+                except TypeError:
+                    unhashable.append(i)
+            self._index[param] = index
+            self._unhashable[param] = unhashable
+        return self._index[param], self._unhashable[param]
+
+    def _find(self, param, value):
+        """Return the positions of the cases whose parameter equals `value`.
+        """
+        index, unhashable = self._get_index(param)
+        try:
+            found = set(index.get(value, ()))
+        except TypeError:
+            found = set()
+        for i in unhashable:
+            if self._cases[i].params[param] == value:
+                found.add(i)
+        return found
+
+    def _get_sorted(self, param):
+        if param not in self._sorted:
+            index, unhashable = self._get_index(param)
+            values = [(v, i) for v, pos in index.items() for i in pos]
+            values.extend(
+                (self._cases[i].params[param], i) for i in unhashable
+            )
+            try:
+                values.sort(key=lambda x: x[0])
+            except TypeError:
+                # The values cannot be ordered.
+                values = None
+            self._sorted[param] = values
+        return self._sorted[param]
+
+    def _select(self, positions):
+        return CaseSet(self._cases[i] for i in sorted(positions))
+
+    # #### Public protocol ###########################################
+
+    def filter(self, predicate=None, **params):
+        """Return a CaseSet of the cases having exactly the given parameter
+        values, with the same semantics as `filter_cases`.
+        """
+        if predicate is not None:
+            if callable(predicate):
+                return CaseSet(filter(predicate, self._cases))
+            else:
+                params['predicate'] = predicate
+        if not params:
+            return CaseSet(self._cases)
+        matches = sorted(
+            (self._find(p, v) for p, v in params.items()), key=len
+        )
+        return self._select(set.intersection(*matches))
+
+    def filter_range(self, param, low=None, high=None):
+        """Return a CaseSet of the cases whose parameter is between `low`
+        and `high`, both inclusive. Either limit may be None.
+        """
+        values = self._get_sorted(param)
+        if values is None:
+            return CaseSet(
+                x for x in self._cases if param in x.params and
+                (low is None or x.params[param] >= low) and
+                (high is None or x.params[param] <= high)
+            )
+        keys = [v for v, i in values]
+        start = 0 if low is None else bisect.bisect_left(keys, low)
+        end = len(keys) if high is None else bisect.bisect_right(keys, high)
+        return self._select(i for v, i in values[start:end])
+
+    def groupby(self, *params):
+        """Return an ordered dict mapping the tuple of the values of the given
+        parameters to a CaseSet of the cases with those values. Only cases
+        that have all the parameters are included.
+        """
+        groups = collections.OrderedDict()
+        for case in self._cases:
+            if all(p in case.params for p in params):
+                key = tuple(case.params[p] for p in params)
+                groups.setdefault(key, []).append(case)
+        return collections.OrderedDict(
+            (k, CaseSet(v)) for k, v in groups.items()
+        )
+
+    def values(self, param):
+        """Return the distinct values of the parameter in the order they
+        first appear.
+        """
+        index, unhashable = self._get_index(param)
+        first = [(pos[0], v) for v, pos in index.items()]
+        first.extend((i, self._cases[i].params[param]) for i in unhashable)
+        return [v for i, v in sorted(first, key=lambda x: x[0])]
+
+    def by_name(self, names):
+        """Return a CaseSet of the cases with the given names, ordered as the
+        names, with the same semantics as `filter_by_name`.
+        """
+        if isinstance(names, str):
+            names = [names]
+        seen = set()
+        positions = []
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                positions.extend(self._names.get(name, ()))
+        return CaseSet(self._cases[i] for i in positions)
+
+    def get(self, name):
+        """Return the case with the given name or None if there is none.
+        """
+        positions = self._names.get(name)
+        return self._cases[positions[0]] if positions else None
+
+
 def mdict(**kw):
     '''Expands out the passed kwargs into a list of dictionaries.
 